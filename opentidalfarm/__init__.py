@@ -29,8 +29,7 @@ from turbine_function import *
 
 from dolfin import *
 from dolfin import parameters
-from dolfin_adjoint import minimize, maximize, Function, solve, Control, \
-                           Constant
+from dolfin_adjoint import Function, solve, Control, Constant
 
 parameters["form_compiler"]["representation"] = "uflacs"
 
@@ -5,6 +5,22 @@ from ..optimisation_helpers import MinimumDistanceConstraints
 from ..optimisation_helpers import MinimumDistanceConstraintsLargeArrays
 from ..turbine_cache import TurbineCache
 
+
+class FarmParameters(dict):
+    """The turbine parameters of a farm. The version counter is increased on
+    every assignment, which allows the turbine cache to cheaply check if it is
+    outdated. In-place modifications need to be followed by a call to
+    :meth:`modified`."""
+
+    def __setitem__(self, key, value):
+        super(FarmParameters, self).__setitem__(key, value)
+        self.modified()
+
+    def modified(self):
+        """Marks the parameters as modified."""
+        self.version = getattr(self, "version", 0) + 1
+
+
 class BaseFarm(object):
     """A base Farm class from which other Farm classes should be derived."""
     def __init__(self, domain=None, turbine=None, site_ids=None, 
@@ -14,7 +30,7 @@ class BaseFarm(object):
         # (as their computation is very expensive)
         # n_time_steps is only used with dynamic friction.
         self.turbine_cache = TurbineCache()
-        self._parameters = {"friction": [], "position": []}
+        self._parameters = FarmParameters(friction=[], position=[])
 
         self._dynamic_friction_t_0 = []
         self.n_time_steps = n_time_steps
@@ -33,7 +49,8 @@ class BaseFarm(object):
 
     @property
     def friction_function(self):
-        self.update()
+        if self.turbine_cache.outdated(self):
+            self.update()
         return self.turbine_cache["turbine_field"]
 
 
@@ -144,6 +161,7 @@ class BaseFarm(object):
                                            (self.n_time_steps + 1)
         else:
             self._parameters["friction"].append(turbine.friction)
+        self._parameters.modified()
 
         dolfin.info("Turbine added at (%.2f, %.2f)." % (coordinates[0],
                                                         coordinates[1]))
@@ -352,8 +370,8 @@ class BaseFarm(object):
         :param list positions: List of tuples containint x-y coordinates of
             turbines to be added.
         """
-        self.turbine_cache["position"] = positions
-        self.turbine_cache["friction"] = (
+        self._parameters["position"] = positions
+        self._parameters["friction"] = (
             self._turbine_specification.friction*numpy.ones(len(positions)))
         self.update()
 
@@ -364,11 +382,17 @@ class BaseFarm(object):
                                    "boundaries.")
 
 
-    def minimum_distance_constraints(self, large=False):
+    def minimum_distance_constraints(self, large=False, cutoff=None,
+                                     smooth=False):
         """Returns an instance of MinimumDistanceConstraints.
 
         :param bool large: Use a minimum distance implementation that is
             suitable for large farms (i.e. many turbines). Default: False
+        :param float cutoff: Only constrain pairs of turbines that are closer
+            than this distance (ignored if large=True). Default: None, i.e.
+            all pairs are constrained.
+        :param bool smooth: Use a continuously differentiable penalty (only
+            used if large=True). Default: False
         :returns: An instance of dolfin_adjoint.InequalityConstraint that
             enforces a minimum distance between turbines.
         :rtype: :py:class:`MinimumDistanceConstraints`
@@ -386,6 +410,10 @@ class BaseFarm(object):
         minimum_distance = self._turbine_specification.minimum_distance
         positions = self.turbine_positions
         if large:
-            return MinimumDistanceConstraintsLargeArrays(positions, minimum_distance, controls)
+            return MinimumDistanceConstraintsLargeArrays(positions,
+                                                         minimum_distance,
+                                                         controls,
+                                                         smooth=smooth)
         else:
-            return MinimumDistanceConstraints(positions, minimum_distance, controls)
+            return MinimumDistanceConstraints(positions, minimum_distance,
+                                              controls, cutoff=cutoff)
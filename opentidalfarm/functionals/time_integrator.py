@@ -2,6 +2,7 @@ import numpy
 from dolfin import *
 from dolfin_adjoint import *
 from ..problems import MultiSteadySWProblem
+from prototype_functional import CombinedFunctional
 
 
 class TimeIntegrator(object):
@@ -11,41 +12,64 @@ class TimeIntegrator(object):
         self.functional = functional
         self.final_only = final_only
 
+        # The components of a combined functional are accumulated
+        # individually, so that their values can be reported separately.
+        if isinstance(functional, CombinedFunctional):
+            self.components = functional.functional_list
+        else:
+            self.components = [functional]
+
         self.vals = []
+        self.component_vals = []
         self.times = []
 
     def add(self, time, state, tf, is_final):
         if not self.final_only or (self.final_only and is_final):
-            val = assemble(self.functional.Jt(state, tf))
-            self.vals.append(val)
+            vals = [assemble(component.Jt(state, tf))
+                    for component in self.components]
+            self.vals.append(sum(vals))
+            self.component_vals.append(vals)
             self.times.append(time)
 
     def integrate(self):
-        """ Integrats the functional with a second order scheme. """
+        """ Integrates the functional with a second order scheme. """
+        return self._integrate(self.vals)
+
+    def integrate_components(self):
+        """ Integrates each component of the functional with a second order
+        scheme. For a :class:`CombinedFunctional`, the components are the
+        combined functionals, otherwise the functional itself. """
+        if len(self.component_vals) == 0:
+            raise ValueError("Cannot integrate empty set.")
+
+        return [self._integrate(vals)
+                for vals in numpy.transpose(self.component_vals)]
 
-        if len(self.vals) == 0:
+    def _integrate(self, vals):
+        if len(vals) == 0:
             raise ValueError("Cannot integrate empty set.")
 
         if self.final_only:
-            return self.vals[-1]
+            return vals[-1]
 
-        # FIXME: Don't assume constant timesteps
-        dt = self.times[1]-self.times[0]
-
-        # Compute quadrature weights
-        w = numpy.ones(len(self.times))
+        times = numpy.array([float(t) for t in self.times])
+        vals = numpy.asarray(vals)
 
         # The multi-steady state case is special in that we want to integrate
         # over time, but without the initial guess.
-        w[-1] = 0.0
         if type(self.problem) == MultiSteadySWProblem:
-            w[0] = 0.
-            w[1] = 0.5
-        else:
-            w[0] = 0.5
-        w[-1] += 0.5
-
-        return sum(w * dt * self.vals)
+            if len(times) == 2:
+                return (times[1] - times[0]) * vals[1]
+            times, vals = times[1:], vals[1:]
+
+        # Compute the quadrature weights of the trapezoidal rule, which
+        # supports non-uniform timesteps
+        dts = numpy.diff(times)
+        w = numpy.zeros(len(times))
+        w[:-1] += 0.5 * dts
+        w[1:] += 0.5 * dts
+
+        return sum(w * vals)
 
     def dolfin_adjoint_functional(self, state):
         """ Constructs the dolfin-adjoint.Functional """
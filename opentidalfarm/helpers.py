@@ -1,6 +1,12 @@
 import random
 import yaml
 import os.path
+import sys
+import shutil
+import tempfile
+import subprocess
+import cPickle
+import multiprocessing
 import dolfin
 import numpy
 from dolfin import *
@@ -44,12 +50,19 @@ def get_rank():
 
 
 def test_gradient_array(J, dJ, x, seed=0.01, perturbation_direction=None,
-                        number_of_tests=5, plot_file=None):
+                        number_of_tests=5, plot_file=None,
+                        evaluate_async=None):
     '''Checks the correctness of the derivative dJ.
        x must be an array that specifies at which point in the parameter space
        the gradient is to be checked. The functions J(x) and dJ(x) must return
        the functional value and the functional derivative respectivaly.
 
+       If evaluate_async is given, the perturbed functionals are evaluated
+       with evaluate_async(xs) while dJ is computed. It must start the
+       evaluations at the list of points xs and return an object whose get()
+       method waits for and returns the functional values (see e.g.
+       spawn_map_async and ReducedFunctional.evaluate_many_async).
+
        This function returns the order of convergence of the Taylor
        series remainder, which should be 2 if the gradient is correct.'''
 
@@ -70,22 +83,28 @@ def test_gradient_array(J, dJ, x, seed=0.01, perturbation_direction=None,
         for i in range(len(x)):
             perturbation_direction[i] = random.random()
 
-    # Run the forward problem for various perturbed initial conditions
-    functional_values = []
+    # Run the forward problem for various perturbed initial conditions. The
+    # concurrent evaluations are started after the unperturbed run, so that
+    # they can use its state (e.g. an automatic scaling factor).
     perturbations = []
     perturbation_sizes = [seed / (2 ** i) for i in range(number_of_tests)]
     for perturbation_size in perturbation_sizes:
         perturbation = perturbation_direction.copy() * perturbation_size
         perturbations.append(perturbation)
 
-        perturbed_x = x.copy() + perturbation
-        functional_values.append(J(perturbed_x))
+    perturbed_xs = [x.copy() + perturbation for perturbation in perturbations]
+    if evaluate_async is not None:
+        pending = evaluate_async(perturbed_xs)
+        dj = dJ(x, forget=True)
+        functional_values = pending.get()
+    else:
+        functional_values = [J(perturbed_x) for perturbed_x in perturbed_xs]
+        dj = dJ(x, forget=True)
 
     # First-order Taylor remainders (not using adjoint)
     no_gradient = [abs(perturbed_j - j_direct) for perturbed_j in
                    functional_values]
 
-    dj = dJ(x, forget=True)
     log(INFO, "Absolute functional evaluation differences: %s" % no_gradient)
     log(INFO, "Convergence orders for Taylor remainder without adjoint \
                information (should all be 1): %s" %
@@ -135,6 +154,7 @@ class StateWriter:
         self.M_p_out, self.q_out, self.p_out_state = self.p_output_projector(
             solver.function_space.mesh())
         self.callback = callback
+        self.turbine_probes = None
 
     def write(self, state):
         log(PROGRESS, "Projecting velocity and pressure to CG1 for visualisation")
@@ -149,15 +169,21 @@ class StateWriter:
         self.p_out << self.p_out_state
 
         if self.solver.parameters.output_abs_u_at_turbine_positions:
-            u_at_turbines = []
-            for position in self.solver.problem.parameters\
-                            .tidal_farm.turbine_positions:
-                u_at_turbines.append((state[0](position)**2
-                                      +state[1](position)**2)**0.5)
-                dir = self.solver.get_optimisation_and_search_directory()
-                filename = os.path.join(dir, "abs_u_at_turb_pos_t_{}.txt"\
-                                        .format(self.timestep))
-                numpy.savetxt(filename, u_at_turbines)
+            positions = numpy.asarray(self.solver.problem.parameters\
+                                      .tidal_farm.turbine_positions)
+            # The turbine positions only change between optimisation
+            # iterations, so that the probes can be reused for all timesteps.
+            if (self.turbine_probes is None or
+                not numpy.array_equal(self.turbine_probes.points, positions)):
+                self.turbine_probes = PointProbes(
+                    self.solver.function_space.mesh(), positions)
+
+            values = self.turbine_probes(state)
+            u_at_turbines = (values[:, 0]**2 + values[:, 1]**2)**0.5
+            dir = self.solver.get_optimisation_and_search_directory()
+            filename = os.path.join(dir, "abs_u_at_turb_pos_t_{}.txt"\
+                                    .format(self.timestep))
+            numpy.savetxt(filename, u_at_turbines)
 
         if self.callback is not None:
             self.callback(state, self.u_out_state, self.p_out_state,
@@ -208,6 +234,203 @@ def cpu0only(f):
     return decorator
 
 
+# The function and items of the running parallel_map, which the forked worker
+# processes inherit.
+_parallel_map_task = None
+
+
+def _parallel_map_worker(i):
+    f, items = _parallel_map_task
+    return f(items[i])
+
+
+def parallel_map(f, items, workers=1, initializer=None):
+    """ Returns the list [f(item) for item in items], where the items are
+    evaluated concurrently in forked worker processes if workers > 1.
+
+    Since the workers are forked from the current process, neither f nor the
+    items need to be picklable, and each worker starts with a copy of the
+    current state. Only the results are sent back to the calling process,
+    hence changes that f makes to the state are lost. In parallel runs with
+    MPI the items are evaluated in serial.
+
+    .. warning::
+
+        dolfin, PETSc and MPI do not support forking a process once they have
+        been initialised. Only use workers > 1 if f does not call into them,
+        or at your own risk. Use :func:`spawn_map` to evaluate items that
+        need a solver.
+
+    :param f: The function to evaluate.
+    :param items: The list of arguments.
+    :param workers: The number of worker processes. Default: 1, i.e. the
+        items are evaluated in serial.
+    :param initializer: A function that is called once in each worker process
+        (but not if the items are evaluated in serial).
+    :returns: list -- the results in the order of the items.
+    """
+    return parallel_map_async(f, items, workers, initializer).get()
+
+
+def parallel_map_async(f, items, workers=1, initializer=None):
+    """ A variant of :func:`parallel_map` that returns immediately, so that
+    the calling process can continue working while the items are evaluated.
+
+    :returns: :class:`ParallelMapResult` -- the pending results. If the items
+        are evaluated in serial, they are evaluated when the results are
+        requested.
+    """
+    global _parallel_map_task
+
+    items = list(items)
+    workers = min(workers, len(items))
+
+    if workers < 2 or MPI.size(mpi_comm_world()) > 1:
+        return ParallelMapResult(f, items)
+
+    # The workers are forked when the pool is created, hence the task only
+    # needs to be set until then.
+    _parallel_map_task = (f, items)
+    try:
+        pool = multiprocessing.Pool(workers, initializer=initializer)
+    finally:
+        _parallel_map_task = None
+
+    result = pool.map_async(_parallel_map_worker, range(len(items)),
+                            chunksize=1)
+    return ParallelMapResult(f, items, pool, result)
+
+
+class ParallelMapResult(object):
+    """ The pending results of :func:`parallel_map_async`. """
+
+    def __init__(self, f, items, pool=None, result=None):
+        self._f = f
+        self._items = items
+        self._pool = pool
+        self._result = result
+        self._values = None
+
+    def get(self):
+        """ Waits for and returns the list of results. """
+        if self._values is not None:
+            return self._values
+
+        if self._pool is None:
+            self._values = [self._f(item) for item in self._items]
+            return self._values
+
+        try:
+            self._values = self._result.get()
+            self._pool.close()
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+        return self._values
+
+
+# The environment variables with which MPI launchers tell a process that it
+# belongs to a parallel job. They are removed for the spawned workers.
+_mpi_environment_prefixes = ("OMPI_", "PMI_", "PMIX_", "HYDRA_", "MPIR_")
+
+
+def spawn_map(factory, f, items, workers=1):
+    """ Returns the list [f(state, item) for item in items], where the items
+    are evaluated concurrently in worker processes.
+
+    In contrast to :func:`parallel_map`, each worker is a new Python process
+    (not a fork of the current one), which calls factory() once to build its
+    own state, e.g. a solver, and then evaluates its share of the items. This
+    is safe with dolfin, PETSc and MPI. The workers run outside of any MPI
+    job, hence spawn_map should be called from serial runs.
+
+    factory, f, the items and the results are pickled, so factory and f must
+    be defined at the top level of a module that the workers can import (that
+    is, not in the main script).
+
+    :param factory: A function without arguments that returns the state of a
+        worker.
+    :param f: The function to evaluate.
+    :param items: The list of arguments.
+    :param workers: The number of worker processes.
+    :returns: list -- the results in the order of the items.
+    """
+    return spawn_map_async(factory, f, items, workers).get()
+
+
+def spawn_map_async(factory, f, items, workers=1):
+    """ A variant of :func:`spawn_map` that returns once the worker processes
+    are started, so that the calling process can continue working while the
+    items are evaluated.
+
+    :returns: :class:`SpawnMapResult` -- the pending results.
+    """
+    items = list(items)
+    workers = max(min(workers, len(items)), 1)
+
+    env = dict((key, value) for key, value in os.environ.iteritems()
+               if not key.startswith(_mpi_environment_prefixes))
+    env["PYTHONPATH"] = os.pathsep.join(os.path.abspath(path or os.curdir)
+                                        for path in sys.path)
+
+    tmpdir = tempfile.mkdtemp(prefix="opentidalfarm-")
+    processes = []
+    try:
+        for i in range(workers):
+            task_file = os.path.join(tmpdir, "task%i.pickle" % i)
+            result_file = os.path.join(tmpdir, "result%i.pickle" % i)
+            with open(task_file, "wb") as task:
+                cPickle.dump((factory, f, items[i::workers]), task,
+                             cPickle.HIGHEST_PROTOCOL)
+            process = subprocess.Popen([sys.executable, "-m",
+                                        "opentidalfarm.spawn_worker",
+                                        task_file, result_file], env=env)
+            processes.append((process, result_file))
+    except:
+        SpawnMapResult(len(items), tmpdir, processes).terminate()
+        raise
+
+    return SpawnMapResult(len(items), tmpdir, processes)
+
+
+class SpawnMapResult(object):
+    """ The pending results of :func:`spawn_map_async`. """
+
+    def __init__(self, size, tmpdir, processes):
+        self._size = size
+        self._tmpdir = tmpdir
+        self._processes = processes
+        self._values = None
+
+    def get(self):
+        """ Waits for and returns the list of results. """
+        if self._values is not None:
+            return self._values
+
+        workers = len(self._processes)
+        try:
+            results = [None]*self._size
+            for i, (process, result_file) in enumerate(self._processes):
+                if process.wait() != 0:
+                    raise RuntimeError("Worker process %i failed with exit "
+                                       "code %i." % (i, process.returncode))
+                with open(result_file, "rb") as result:
+                    results[i::workers] = cPickle.load(result)
+        finally:
+            self.terminate()
+
+        self._values = results
+        return self._values
+
+    def terminate(self):
+        """ Stops the worker processes and removes their files. """
+        for process, result_file in self._processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        shutil.rmtree(self._tmpdir, ignore_errors=True)
+
+
 def function_eval(func, point):
     ''' A parallel safe evaluation of dolfin functions '''
     try:
@@ -226,6 +449,131 @@ def function_eval(func, point):
         return maxval
 
 
+def mpi_allreduce(arr, op="sum"):
+    """ Reduces a numpy array entry-wise over all processes.
+
+    :param arr: The local contribution.
+    :type arr: numpy.ndarray
+    :param op: The reduction operation, one of "sum", "max" or "min".
+    :type op: str
+    :returns: numpy.ndarray -- the reduced array.
+    """
+    arr = numpy.ascontiguousarray(arr, dtype=float)
+    comm = mpi_comm_world()
+
+    if MPI.size(comm) == 1:
+        return arr
+
+    # Reduce the whole array with a single collective if mpi4py is available.
+    if hasattr(comm, "tompi4py"):
+        comm = comm.tompi4py()
+    if hasattr(comm, "Allreduce"):
+        from mpi4py import MPI as mpi4py_MPI
+        mpi4py_ops = {"sum": mpi4py_MPI.SUM, "max": mpi4py_MPI.MAX,
+                      "min": mpi4py_MPI.MIN}
+        out = numpy.empty_like(arr)
+        comm.Allreduce(arr, out, op=mpi4py_ops[op])
+        return out
+
+    dolfin_ops = {"sum": MPI.sum, "max": MPI.max, "min": MPI.min}
+    return numpy.reshape([dolfin_ops[op](mpi_comm_world(), float(a))
+                          for a in arr.ravel()], arr.shape)
+
+
+class PointProbes(object):
+    """ Evaluates functions at a fixed set of points.
+
+    The points are located in the mesh once, and the basis functions of each
+    function space are evaluated at the points only once. Evaluating a
+    function then only requires a vectorised product with its coefficients
+    and one parallel reduction, which makes it cheap to evaluate functions at
+    many points and many times (e.g. at the turbine positions in every
+    timestep).
+
+    Points that are outside the domain evaluate to numpy.nan.
+
+    :param mesh: The mesh.
+    :type mesh: dolfin.Mesh
+    :param points: The coordinates of the points.
+    :type points: numpy.ndarray of shape (number of points x 2)
+    """
+
+    def __init__(self, mesh, points):
+        self.mesh = mesh
+        self.points = numpy.reshape(numpy.asarray(points, dtype=float),
+                                    (-1, mesh.geometry().dim()))
+        self._basis_cache = {}
+
+        # Locate the cells of the points that are inside the local mesh.
+        tree = mesh.bounding_box_tree()
+        cells = numpy.array([tree.compute_first_entity_collision(Point(*point))
+                             for point in self.points], dtype=numpy.int64)
+        found = cells < mesh.num_cells()
+
+        # Points on the boundary between two processes are found by both,
+        # hence the process with the lowest rank evaluates them.
+        comm = mpi_comm_world()
+        rank = MPI.rank(comm)
+        owner = numpy.where(found, rank, MPI.size(comm))
+        owner = mpi_allreduce(owner, op="min")
+
+        self.inside = owner < MPI.size(comm)
+        self._local = numpy.nonzero(found & (owner == rank))[0]
+        self._cells = cells[self._local]
+
+    def _basis(self, V):
+        """ Returns the global indices of the cell dofs and the basis functions
+        of V evaluated at the local points. """
+        key = V.id()
+        if key not in self._basis_cache:
+            element = V.element()
+            dofmap = V.dofmap()
+            space_dim = element.space_dimension()
+            value_size = max(1, numpy.prod(V.ufl_element().value_shape()))
+
+            dofs = numpy.zeros((len(self._cells), space_dim), dtype=numpy.intc)
+            basis = numpy.zeros((len(self._cells), space_dim, value_size))
+            for i, (point, cell_index) in enumerate(zip(self.points[self._local],
+                                                        self._cells)):
+                cell = Cell(self.mesh, int(cell_index))
+                values = element.evaluate_basis_all(point,
+                                                    cell.get_vertex_coordinates(),
+                                                    cell.orientation())
+                basis[i] = numpy.reshape(values, (space_dim, value_size))
+                dofs[i] = [dofmap.local_to_global_index(dof)
+                           for dof in dofmap.cell_dofs(int(cell_index))]
+
+            self._basis_cache[key] = (dofs, basis, value_size)
+
+        return self._basis_cache[key]
+
+    def __call__(self, func):
+        """ Evaluates func at the points.
+
+        :param func: The function to be evaluated.
+        :type func: dolfin.Function
+        :returns: numpy.ndarray -- the function values, with one row per point
+            for vector valued functions.
+        """
+        dofs, basis, value_size = self._basis(func.function_space())
+
+        if MPI.size(mpi_comm_world()) == 1:
+            coefficients = func.vector().array()[dofs]
+        else:
+            coefficients = numpy.reshape(
+                func.vector().gather(dofs.ravel().astype(numpy.intc)),
+                dofs.shape)
+
+        values = numpy.zeros((len(self.points), value_size))
+        values[self._local] = numpy.einsum("pk,pkv->pv", coefficients, basis)
+        values = mpi_allreduce(values)
+        values[~self.inside] = numpy.nan
+
+        if value_size == 1:
+            return values[:, 0]
+        return values
+
+
 class FrozenClass(object):
     """ A class which can be (un-)frozen. If the class is frozen, no attributes
         can be added to the class. """
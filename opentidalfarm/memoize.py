@@ -1,8 +1,19 @@
 import os
+import sys
+import zlib
+import atexit
+import weakref
+import types
+import struct
 import signal
+import hashlib
+import tempfile
 import cPickle
-from dolfin import log, INFO, WARNING
-from helpers import cpu0only
+from collections import OrderedDict
+import numpy
+from dolfin import log, INFO, WARNING, Expression
+import helpers
+from helpers import cpu0only, get_rank
 
 def to_tuple(obj):
     if hasattr(obj, '__iter__'):
@@ -11,10 +22,351 @@ def to_tuple(obj):
         return obj
 
 
+def to_digest(obj, digest=None):
+    ''' Returns a digest of obj. Numeric arrays (and lists or tuples of numbers)
+    are hashed through their raw bytes, which is much faster than converting
+    them to nested tuples. '''
+    if digest is None:
+        digest = hashlib.sha1()
+
+    if hasattr(obj, '__iter__') and not isinstance(obj, dict):
+        try:
+            arr = numpy.asarray(obj)
+        except ValueError:
+            arr = numpy.empty(0, dtype=object)
+        if arr.dtype.kind in 'biuf':
+            arr = numpy.ascontiguousarray(arr, dtype=numpy.float64)
+            digest.update("array%s" % (arr.shape,))
+            digest.update(arr.tostring())
+        else:
+            digest.update("sequence%i" % len(obj))
+            for o in obj:
+                to_digest(o, digest)
+    else:
+        digest.update(repr(obj))
+
+    return digest
+
+
+def fingerprint(obj, digest=None, exclude=(), _visited=None):
+    ''' Returns a digest of the content of obj, which identifies e.g. a
+    problem across runs. Parameter classes are identified by their public
+    attributes, other objects by their attributes, meshes by their
+    coordinates and cells, functions by their values and expressions by their
+    code and parameters. Attributes whose name is in exclude are ignored. '''
+    if digest is None:
+        digest = hashlib.sha1()
+    if _visited is None:
+        _visited = {}
+
+    if obj is None or isinstance(obj, (bool, int, long, float, complex,
+                                       basestring)):
+        digest.update("%s:%r" % (type(obj).__name__, obj))
+        return digest
+
+    if isinstance(obj, (numpy.ndarray, numpy.number)):
+        return to_digest(obj, digest)
+
+    # Objects that are referenced more than once are only fingerprinted once.
+    # The objects are kept alive, so that their ids are not reused.
+    if id(obj) in _visited:
+        digest.update("visited%i" % _visited[id(obj)][0])
+        return digest
+    _visited[id(obj)] = (len(_visited), obj)
+
+    def recurse(o):
+        fingerprint(o, digest, exclude, _visited)
+
+    cls = type(obj)
+    digest.update("%s.%s" % (cls.__module__, cls.__name__))
+
+    if isinstance(obj, (types.FunctionType, types.MethodType)):
+        code = getattr(obj, "__func__", obj).__code__
+        digest.update(code.co_code)
+        recurse([c for c in code.co_consts if not isinstance(c, types.CodeType)])
+
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            if key not in exclude:
+                recurse(key)
+                recurse(obj[key])
+
+    elif isinstance(obj, (list, tuple)):
+        for o in obj:
+            recurse(o)
+
+    else:
+        # Meshes, functions and other dolfin objects are identified by their
+        # data.
+        if hasattr(obj, "coordinates") and hasattr(obj, "cells"):
+            recurse(obj.coordinates())
+            recurse(obj.cells())
+        elif hasattr(obj, "vector") and hasattr(obj, "function_space"):
+            recurse(repr(obj.ufl_element()))
+            recurse(obj.vector().array())
+        elif hasattr(obj, "values") and hasattr(obj, "ufl_shape"):
+            recurse(obj.values())
+        elif hasattr(obj, "array") and callable(obj.array):
+            recurse(obj.array())
+        if hasattr(obj, "cppcode"):
+            recurse(obj.cppcode)
+
+        if isinstance(obj, helpers.FrozenClass):
+            attrs = [k for k in dir(obj) if not k.startswith("_")]
+        elif isinstance(obj, Expression):
+            # The parameters of compiled expressions are properties of the
+            # generated class, not instance attributes.
+            params = [k for k in set(dir(obj)) - set(dir(Expression))
+                      if not k.startswith("_") and
+                      not callable(getattr(obj, k))]
+            attrs = sorted(set(params) | set(vars(obj)))
+        elif hasattr(obj, "__dict__"):
+            attrs = sorted(vars(obj))
+        else:
+            # E.g. ufl elements, which are identified by their representation
+            # unless it contains their memory address.
+            attrs = []
+            if " at 0x" not in repr(obj):
+                digest.update(repr(obj))
+        for k in attrs:
+            if k not in exclude and k != "this":
+                digest.update(k)
+                recurse(getattr(obj, k))
+
+    return digest
+
+
+def _sizeof(value):
+    ''' Estimates the memory usage of a cached value in bytes. '''
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    return sys.getsizeof(value)
+
+
+# The checkpoint logs that are open for writing. They are closed when the
+# interpreter exits.
+_open_checkpoint_logs = weakref.WeakSet()
+
+
+@atexit.register
+def _close_checkpoint_logs():
+    for checkpoint_log in list(_open_checkpoint_logs):
+        checkpoint_log.close()
+
+
+class CheckpointLog(object):
+    ''' An append-only log of (key, value) records for checkpointing memoized
+    evaluations. Each record is stored with its length and CRC32 checksum, so
+    that a partially written record at the end of the file (e.g. after a
+    crash) is detected and discarded when the log is replayed. The file is
+    synchronised to disk after every sync_period records, and when the log is
+    closed. Logs that are still open are closed when the interpreter exits. '''
+
+    _header = struct.Struct("<II")
+
+    def __init__(self, filename, sync_period=10):
+        self.filename = filename
+        self.sync_period = sync_period
+        self._file = None
+        self._unsynced = 0
+
+    def replay(self):
+        ''' Returns the list of valid (key, value) records in the log. An
+        invalid tail is removed from the file. '''
+        records = []
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            log(WARNING, "Warning: Checkpoint file '%s' not found." % self.filename)
+            return records
+
+        valid_size = 0
+        with f:
+            while True:
+                header = f.read(self._header.size)
+                if len(header) < self._header.size:
+                    break
+                length, checksum = self._header.unpack(header)
+                payload = f.read(length)
+                if (len(payload) < length or
+                    zlib.crc32(payload) & 0xffffffff != checksum):
+                    break
+                try:
+                    records.append(cPickle.loads(payload))
+                except Exception:
+                    break
+                valid_size = f.tell()
+
+        if valid_size < os.path.getsize(self.filename) and get_rank() == 0:
+            log(WARNING, "Warning: Removing an invalid record at the end of "
+                         "checkpoint file '%s'." % self.filename)
+            with open(self.filename, "r+b") as f:
+                f.truncate(valid_size)
+
+        return records
+
+    def open(self, append=True):
+        ''' Opens the log for writing. If append is False, an existing log
+        is overwritten. '''
+        self._file = open(self.filename, "ab" if append else "wb")
+        _open_checkpoint_logs.add(self)
+
+    def is_empty(self):
+        self._file.seek(0, os.SEEK_END)
+        return self._file.tell() == 0
+
+    def append(self, key, value):
+        payload = cPickle.dumps((key, value), cPickle.HIGHEST_PROTOCOL)
+        header = self._header.pack(len(payload), zlib.crc32(payload) & 0xffffffff)
+        self._file.write(header + payload)
+        self._unsynced += 1
+        if self._unsynced >= self.sync_period:
+            self.sync()
+
+    def flush(self):
+        ''' Passes the written records to the operating system. '''
+        self._file.flush()
+
+    def sync(self):
+        ''' Synchronises the written records to disk. '''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        ''' Synchronises the written records to disk and closes the log. '''
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+        _open_checkpoint_logs.discard(self)
+
+
+class ResultStore(object):
+    ''' A persistent store of evaluation results on disk, which can be shared
+    between runs. Each entry is a set of named numpy arrays, stored in a single
+    file whose name is the key of the entry (e.g. a fingerprint of the
+    problem and the controls). Files are written atomically, so that
+    concurrent runs can use the same store.
+
+    If max_size (in bytes) is given, the least recently used entries are
+    removed once the store exceeds it. '''
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process may have created it in the meantime.
+                if not os.path.isdir(directory):
+                    raise
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def _read(self, key):
+        try:
+            with open(self._filename(key), "rb") as f:
+                data = numpy.load(f)
+                return dict((k, data[k]) for k in data.files)
+        except (IOError, ValueError, zlib.error):
+            return None
+
+    def get(self, key, name):
+        ''' Returns the entry key as a dictionary of arrays, or None if the
+        entry does not exist or does not contain the array name. '''
+        entry = self._read(key)
+        if entry is None or name not in entry:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Mark the entry as recently used.
+        try:
+            os.utime(self._filename(key), None)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, **arrays):
+        ''' Adds the arrays to the entry key. '''
+        entry = self._read(key) or {}
+        entry.update(arrays)
+
+        fd, tmp_filename = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.savez(f, **entry)
+            os.rename(tmp_filename, self._filename(key))
+        except:
+            os.remove(tmp_filename)
+            raise
+
+        self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".npz"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        # Remove the least recently used entries first, but keep the most
+        # recent one.
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        for mtime, entry_size, path in entries[:-1]:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+    def statistics(self):
+        ''' Returns a string with the store hits and misses. '''
+        return "%i hits, %i misses" % (self.hits, self.misses)
+
+
 class MemoizeMutable:
-    ''' Implements a memoization function to avoid duplicated functional (derivative) evaluations '''
+    ''' Implements a memoization function to avoid duplicated functional (derivative) evaluations
+
+    If digest_keys is True, the arguments are identified by a digest of their
+    raw bytes instead of nested tuples. The cache can be bounded by the number
+    of entries (max_entries) and the memory of the cached values in bytes
+    (max_memory), in which case the least recently used entries are evicted
+    first.
+
+    If key_args is given, only the first key_args positional arguments
+    identify an evaluation, i.e. the remaining arguments must not change the
+    result. '''
 
     def get_key(self, args, kwds):
+        if self.key_args is not None:
+            args = args[:self.key_args]
+            kwds = {}
+
+        if self.digest_keys:
+            digest = hashlib.sha1()
+            for arg in args:
+                to_digest(arg, digest)
+            to_digest(sorted(kwds.items()), digest)
+            return digest.hexdigest()
+
         h1 = to_tuple(args)
         h2 = to_tuple(kwds.items())
         h = tuple([h1, h2])
@@ -25,48 +377,138 @@ class MemoizeMutable:
             h = hash(h)
         return h
 
-    def __init__(self, fn, hash_keys=False):
+    def __init__(self, fn, hash_keys=False, digest_keys=False,
+                 max_entries=None, max_memory=None, key_args=None):
         ''' sigint_save: Create a checkpoint file in case a sigint signal is received. '''
         self.fn = fn
-        self.memo = {}
+        self.memo = OrderedDict()
         self.hash_keys = hash_keys
+        self.digest_keys = digest_keys
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.key_args = key_args
+
+        self.hits = 0
+        self.misses = 0
+        self._memory = 0
+        self.checkpoint_log = None
 
     def __call__(self, *args, **kwds):
         h = self.get_key(args, kwds)
 
         if h not in self.memo:
-            self.memo[h] = self.fn(*args, **kwds)
+            self.misses += 1
+            self._store(h, self.fn(*args, **kwds))
+            self._log(h)
         else:
+            self.hits += 1
             log(INFO, "Use checkpoint value.")
+            # Mark the entry as the most recently used one.
+            self.memo[h] = self.memo.pop(h)
         return self.memo[h]
 
+    def _store(self, h, value):
+        if h in self.memo:
+            self._memory -= _sizeof(self.memo.pop(h))
+        self.memo[h] = value
+        self._memory += _sizeof(value)
+        self._evict()
+
+    def _evict(self):
+        ''' Removes the least recently used entries until the cache is within
+        its bounds. The most recent entry is always kept. '''
+        while len(self.memo) > 1 and (
+            (self.max_entries is not None and len(self.memo) > self.max_entries) or
+            (self.max_memory is not None and self._memory > self.max_memory)):
+            h, value = self.memo.popitem(last=False)
+            self._memory -= _sizeof(value)
+
     def has_cache(self, *args, **kwds):
         h = self.get_key(args, kwds)
         return h in self.memo
 
-    # Insert a function value into the cache manually.
-    def __add__(self, value, *args, **kwds):
+    def statistics(self):
+        ''' Returns a string with the cache hits, misses and size. '''
+        return ("%i hits, %i misses, %i entries (%.1f MB)" %
+                (self.hits, self.misses, len(self.memo), self._memory/1e6))
+
+    def store(self, value, *args, **kwds):
+        ''' Inserts the value of the function for the given arguments into
+        the cache, e.g. if it was computed elsewhere. '''
         h = self.get_key(args, kwds)
-        self.memo[h] = value
+        self._store(h, value)
+        self._log(h)
+
+    def _log(self, h):
+        if self.checkpoint_log is not None:
+            self.checkpoint_log.append(h, self.memo[h])
+
+    @cpu0only
+    def open_checkpoint_log(self, filename, append=True, sync_period=10):
+        ''' Appends every new evaluation to the checkpoint log in filename.
+        If the log is empty, the evaluations already in the cache (e.g. loaded
+        from an old checkpoint file) are written first. '''
+        self.checkpoint_log = CheckpointLog(filename, sync_period)
+        self.checkpoint_log.open(append)
+        if self.checkpoint_log.is_empty():
+            for h in self.memo:
+                self.checkpoint_log.append(h, self.memo[h])
+        self.checkpoint_log.flush()
+
+    def flush_checkpoint_log(self):
+        if self.checkpoint_log is not None:
+            self.checkpoint_log.flush()
+
+    def close_checkpoint_log(self):
+        ''' Synchronises the checkpoint log to disk and stops writing to it. '''
+        if self.checkpoint_log is not None:
+            self.checkpoint_log.close()
+            self.checkpoint_log = None
+
+    def load_checkpoint_log(self, filename):
+        ''' Loads the evaluations from a checkpoint log. '''
+        for h, value in CheckpointLog(filename).replay():
+            self._load_entry(h, value)
 
     @cpu0only
     def save_checkpoint(self, filename):
         def sig_save(sig, stack):
-            print "Received signal %i. Writing final checkpoint to disk before exiting..." % sig
-            cPickle.dump(self.memo, open(filename, "wb"))
-            print "Checkpoint writing finished. Bye."
+            log(INFO, "Received signal %i. Writing final checkpoint to disk "
+                      "before exiting..." % sig)
+            cPickle.dump(dict(self.memo), open(filename, "wb"))
+            log(INFO, "Checkpoint writing finished. Bye.")
             os._exit(sig)
 
         # Make sure we save successfully, even if the user sends a signal
-        print "Save checkpoint."
+        log(INFO, "Save checkpoint.")
         old_handler = signal.signal(signal.SIGINT, sig_save)
-        cPickle.dump(self.memo, open(filename, "wb"))
+        cPickle.dump(dict(self.memo), open(filename, "wb"))
         signal.signal(signal.SIGINT, old_handler)
 
     def load_checkpoint(self, filename):
         try:
-            self.memo = cPickle.load(open(filename, "rb"))
+            memo = cPickle.load(open(filename, "rb"))
         except IOError:
             log(WARNING, "Warning: Checkpoint file '%s' not found." % filename)
+            return
         except ValueError:
             log(WARNING, "Error: Checkpoint file '%s' is invalid." % filename)
+            return
+
+        self.memo = OrderedDict()
+        self._memory = 0
+        for h, value in memo.iteritems():
+            self._load_entry(h, value)
+
+    def _load_entry(self, h, value):
+        # Checkpoints written with tuple keys are converted to the current
+        # key format.
+        if isinstance(h, tuple) and (self.digest_keys or
+                                     self.key_args is not None):
+            args, kwds = h
+            h = self.get_key(args, dict(kwds))
+        elif self.digest_keys and not isinstance(h, str):
+            log(WARNING, "Warning: Skipping checkpoint entry with a "
+                         "hashed key.")
+            return
+        self._store(h, value)
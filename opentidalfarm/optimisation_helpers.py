@@ -1,13 +1,16 @@
 import os.path
 import numpy
+import scipy.sparse
+from scipy.spatial import cKDTree
 import dolfin
 from dolfin import Constant, log, INFO
-from helpers import function_eval
+from helpers import mpi_allreduce, PointProbes
 from dolfin_adjoint import InequalityConstraint, EqualityConstraint
 
 __all__ = ["MinimumDistanceConstraints", "MinimumDistanceConstraintsLargeArrays",
     "friction_constraints", "get_domain_constraints", "position_constraints",
-    "get_distance_function", "ConvexPolygonSiteConstraint", "DomainRestrictionConstraints"]
+    "get_distance_function", "ConvexPolygonSiteConstraint", "DomainRestrictionConstraints",
+    "minimize", "maximize"]
 
 def position_constraints(config):
     ''' This function returns the constraints to ensure that the turbine
@@ -46,10 +49,21 @@ def friction_constraints(config, lb=0.0, ub=None):
 
 
 class DomainRestrictionConstraints(InequalityConstraint):
-    def __init__(self, config, feasible_area, attraction_center):
+    def __init__(self, config, feasible_area, attraction_center,
+                 raster_size=None):
         '''
            Generates the inequality constraints to enforce the turbines in the feasible area.
            If the turbine is outside the domain, the constraints is equal to the distance between the turbine and the attraction center.
+
+           The feasible area and its gradient are evaluated at the turbine
+           positions with PointProbes. If raster_size (an integer or a tuple
+           (nx, ny)) is given, the feasible area is instead sampled once on a
+           regular raster of that size covering the mesh, and the constraints
+           and their derivatives are evaluated by bilinear interpolation
+           without any point search or parallel reduction. Raster points
+           outside the domain are linearly extrapolated from the closest
+           sample inside, so that the interpolation is continuous up to the
+           boundary.
         '''
         self.config = config
         self.feasible_area = feasible_area
@@ -72,28 +86,123 @@ class DomainRestrictionConstraints(InequalityConstraint):
         self.feasible_area_grad = feasible_area_grad
 
         self.attraction_center = attraction_center
+        self._mesh = feasible_area.function_space().mesh()
+
+        self.raster = None
+        if raster_size is not None:
+            self._sample_raster(raster_size)
+
+    def _sample_raster(self, raster_size):
+        ''' Samples the feasible area on a regular raster covering the mesh.
+        The samples outside the domain are extrapolated with the value and
+        gradient of the closest sample inside the domain. '''
+        if not hasattr(raster_size, "__getitem__"):
+            raster_size = (raster_size, raster_size)
+        nx, ny = raster_size
+        if nx < 2 or ny < 2:
+            raise ValueError("The raster needs at least two points in each direction.")
+
+        coords = self._mesh.coordinates()
+        lower = mpi_allreduce(coords.min(axis=0)[:2], op="min")
+        upper = mpi_allreduce(coords.max(axis=0)[:2], op="max")
+
+        log(INFO, "Sampling the feasible area on a %ix%i raster" % (nx, ny))
+        xs = numpy.linspace(lower[0], upper[0], nx)
+        ys = numpy.linspace(lower[1], upper[1], ny)
+
+        # The raster points are located in the mesh once, and all samples are
+        # combined with one reduction per function.
+        points = numpy.column_stack([c.ravel() for c in
+                                     numpy.meshgrid(xs, ys, indexing="ij")])
+        samples = self._probe(PointProbes(self._mesh, points))
+        valid = numpy.isfinite(samples).all(axis=0)
+        if not valid.any():
+            raise ValueError("No raster point is inside the domain.")
+
+        values = samples[0]
+        outside = numpy.nonzero(~valid)[0]
+        if len(outside) > 0:
+            inside = numpy.nonzero(valid)[0]
+            closest = inside[cKDTree(points[inside]).query(points[outside])[1]]
+            offset = points[outside] - points[closest]
+            values[outside] = (values[closest] +
+                               (samples[1:, closest].T * offset).sum(axis=1))
+
+        self.raster = {"x": xs, "y": ys,
+                       "samples": numpy.reshape(values, (nx, ny)),
+                       "valid": numpy.reshape(valid, (nx, ny))}
+
+    def _probe(self, probes):
+        ''' Returns the feasible area and its gradient at the probe points,
+        with numpy.nan for points outside the domain. '''
+        return numpy.array([probes(f) for f in
+                            (self.feasible_area,) + self.feasible_area_grad])
+
+    def _evaluate(self, m_pos):
+        ''' Returns the feasible area and its gradient at the turbine
+        positions, and a mask of the turbines inside the domain. '''
+        if self.raster is not None:
+            return self._interpolate_raster(m_pos)
+
+        probes = PointProbes(self._mesh, numpy.reshape(m_pos, (-1, 2)))
+        return self._probe(probes), probes.inside
+
+    def _interpolate_raster(self, m_pos):
+        ''' Returns the bilinear interpolation of the feasible area and its
+        derivatives at the turbine positions, and a mask of the turbines whose
+        interpolation stencil touches the domain. '''
+        xs = self.raster["x"]
+        ys = self.raster["y"]
+        samples = self.raster["samples"]
+        valid = self.raster["valid"]
+        pos = numpy.reshape(m_pos, (-1, 2))
+        hx = xs[1] - xs[0]
+        hy = ys[1] - ys[0]
+
+        fx = (pos[:, 0] - xs[0]) / hx
+        fy = (pos[:, 1] - ys[0]) / hy
+        inside = ((fx >= 0) & (fx <= len(xs) - 1) &
+                  (fy >= 0) & (fy <= len(ys) - 1))
+
+        i = numpy.clip(numpy.floor(fx).astype(int), 0, len(xs) - 2)
+        j = numpy.clip(numpy.floor(fy).astype(int), 0, len(ys) - 2)
+        tx = fx - i
+        ty = fy - j
+
+        c00, c10 = samples[i, j], samples[i + 1, j]
+        c01, c11 = samples[i, j + 1], samples[i + 1, j + 1]
+        inside &= (valid[i, j] | valid[i + 1, j] |
+                   valid[i, j + 1] | valid[i + 1, j + 1])
+
+        values = ((1 - tx) * (1 - ty) * c00 + tx * (1 - ty) * c10 +
+                  (1 - tx) * ty * c01 + tx * ty * c11)
+        # The derivatives of the interpolant
+        dx = ((1 - ty) * (c10 - c00) + ty * (c11 - c01)) / hx
+        dy = ((1 - tx) * (c01 - c00) + tx * (c11 - c10)) / hy
+        return numpy.array([values, dx, dy]), inside
+
+    def _position_controls(self, m):
+        if len(self.config.params['controls']) == 2:
+        # If the controls consists of the the friction and the positions, then we need to first extract the position part
+            assert(len(m) % 3 == 0)
+            return m[len(m) / 3:]
+        else:
+            return m
 
     def length(self):
         m_pos = self.config.params['turbine_pos']
         return len(m_pos)
 
     def function(self, m):
-        ieqcons = []
-        if len(self.config.params['controls']) == 2:
-        # If the controls consists of the the friction and the positions, then we need to first extract the position part
-            assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
-        else:
-            m_pos = m
+        m_pos = self._position_controls(m)
+        pos = numpy.reshape(m_pos, (-1, 2))
+        values, inside = self._evaluate(m_pos)
 
-        for i in range(len(m_pos) / 2):
-            x = m_pos[2 * i]
-            y = m_pos[2 * i + 1]
-            try:
-                ieqcons.append(function_eval(self.feasible_area, (x, y)))
-            except RuntimeError:
-                print "Warning: a turbine is outside the domain"
-                ieqcons.append((x - self.attraction_center[0]) ** 2 + (y - self.attraction_center[1]) ** 2)  # Point is outside domain
+        if not inside.all():
+            print "Warning: a turbine is outside the domain"
+        # Points outside the domain use the distance to the attraction center
+        ieqcons = numpy.where(inside, values[0],
+                              ((pos - self.attraction_center) ** 2).sum(axis=1))
 
         arr = -numpy.array(ieqcons)
         if any(arr <= 0):
@@ -101,31 +210,22 @@ class DomainRestrictionConstraints(InequalityConstraint):
         return arr
 
     def jacobian(self, m):
-        ieqcons = []
-        if len(self.config.params['controls']) == 2:
-        # If the controls consists of the the friction and the positions, then we need to first extract the position part
-            assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
-        else:
-            m_pos = m
+        m_pos = self._position_controls(m)
+        pos = numpy.reshape(m_pos, (-1, 2))
+        values, inside = self._evaluate(m_pos)
 
-        for i in range(len(m_pos) / 2):
-            x = m_pos[2 * i]
-            y = m_pos[2 * i + 1]
-            primes = numpy.zeros(len(m))
-            try:
-                primes[2 * i] = function_eval(self.feasible_area_grad[0], (x, y))
-                primes[2 * i + 1] = function_eval(self.feasible_area_grad[1], (x, y))
-
-            except RuntimeError:
-                primes[2 * i] = 2 * (x - self.attraction_center[0])
-                primes[2 * i + 1] = 2 * (y - self.attraction_center[1])
-            ieqcons.append(primes)
+        grad = numpy.where(inside[:, numpy.newaxis], values[1:].T,
+                           2 * (pos - self.attraction_center))
 
-        return -numpy.array(ieqcons)
+        ieqcons = numpy.zeros((len(pos), len(m)))
+        for i in range(len(pos)):
+            ieqcons[i, 2 * i:2 * i + 2] = grad[i]
+        return -ieqcons
 
-def get_domain_constraints(config, feasible_area, attraction_center):
-    return DomainRestrictionConstraints(config, feasible_area, attraction_center)
+def get_domain_constraints(config, feasible_area, attraction_center,
+                           raster_size=None):
+    return DomainRestrictionConstraints(config, feasible_area, attraction_center,
+                                        raster_size=raster_size)
 
 def get_distance_function(config, domains):
     V = dolfin.FunctionSpace(config.domain.mesh, "CG", 1)
@@ -159,9 +259,39 @@ def get_distance_function(config, domains):
 
     return sol
 
+def _position_offset(m, controls, n_turbines):
+    """Returns the index of the first turbine position in the control array m.
+    The control array contains the friction coefficients first, followed by
+    the turbine positions."""
+    if controls.position and controls.friction:
+        return len(m)/3
+    elif controls.position and controls.dynamic_friction:
+        return len(m) - 2*n_turbines
+    else:
+        return 0
+
+
 class MinimumDistanceConstraints(InequalityConstraint):
     """This class implements minimum distance constraints between turbines.
 
+    By default, one constraint is created for each pair of turbines. For large
+    farms, the number of constraints can be reduced by only constraining pairs
+    of turbines that are closer than a cutoff distance (active-set mode). The
+    close pairs are found with a KD-tree. Since the optimisation algorithms
+    expect a fixed number of constraints, at most max_pairs of the closest pairs
+    are constrained, and the remaining constraints are filled with the
+    (feasible) value of a pair at the cutoff distance.
+
+    In active-set mode, the constrained pairs are selected for the initial
+    turbine positions and kept fixed, so that each constraint refers to the
+    same pair throughout an optimisation (algorithms such as SLSQP keep
+    multipliers and quasi-Newton information per constraint). The pairs can be
+    selected again between optimisations with :meth:`update_active_set`. Pairs
+    that come closer than the cutoff distance during the optimisation are not
+    constrained, unless they violate the minimum distance: the active set is
+    then selected again for the current positions, with a warning, so that no
+    layout violating the minimum distance is reported as feasible.
+
     .. note:: This class subclasses `dolfin_adjoint.InequalityConstraint`_. The
         following method names must not change:
 
@@ -174,14 +304,21 @@ class MinimumDistanceConstraints(InequalityConstraint):
             http://www.dolfin-adjoint.org/en/latest/documentation/api.html#dolfin_adjoint.InequalityConstraint
 
     """
-    def __init__(self, turbine_positions, minimum_distance, controls):
+    def __init__(self, turbine_positions, minimum_distance, controls,
+                 cutoff=None, max_pairs=None):
         """Create MinimumDistanceConstraints
 
         :param serialized_turbines: The serialized turbine paramaterisation.
         :type serialized_turbines: numpy.ndarray.
         :param minimum_distance: The minimum distance allowed between turbines.
         :type minimum_distance: float.
-        :raises: NotImplementedError
+        :param cutoff: If not None, only pairs of turbines that are closer than
+            cutoff are constrained. Must be larger than minimum_distance.
+        :type cutoff: float.
+        :param max_pairs: The maximum number of constrained pairs in
+            active-set mode. Default: six per turbine.
+        :type max_pairs: int.
+        :raises: NotImplementedError, ValueError
 
 
         """
@@ -189,26 +326,92 @@ class MinimumDistanceConstraints(InequalityConstraint):
             raise NotImplementedError("Turbines must be deployed for distance "
                                       "constraints to be used.")
 
+        if cutoff is not None and cutoff <= minimum_distance:
+            raise ValueError("The cutoff distance must be larger than the "
+                             "minimum distance.")
 
         self._turbines = numpy.asarray(turbine_positions).flatten().tolist()
         self._minimum_distance = minimum_distance
         self._controls = controls
+        self._cutoff = cutoff
+
+        n_turbines = len(self._turbines)/2
+        n_pairs = n_turbines*(n_turbines-1)/2
+        if cutoff is not None:
+            if max_pairs is None:
+                max_pairs = 6*n_turbines
+            n_pairs = min(n_pairs, max_pairs)
+        self._n_pairs = n_pairs
 
+        self._active_pairs = None
+        if cutoff is not None:
+            self._active_pairs = self._select_pairs(
+                numpy.reshape(self._turbines, (-1, 2)))
 
-    def _sl2norm(self, x):
-        """Calculates the squared l2norm of a vector x."""
-        return sum([v**2 for v in x])
+
+    def update_active_set(self, m):
+        """Selects the constrained pairs of the active-set mode again, for the
+        turbine positions in m. This changes the meaning of the constraints
+        and hence should only be called between optimisations.
+
+        :param m: The serialized paramaterisation of the turbines.
+        :tpye m: numpy.ndarray.
+        """
+        if self._cutoff is not None:
+            offset, positions = self._positions(m)
+            self._active_pairs = self._select_pairs(positions)
 
 
     def length(self):
         """Returns the number of constraints ``len(function(m))``."""
-        n_constraints = 0
-        for i in range(len(self._turbines)):
-          for j in range(len(self._turbines)):
-            if i <= j:
-              continue
-            n_constraints += 1
-        return n_constraints
+        return self._n_pairs
+
+
+    def _positions(self, m):
+        """Returns the offset of the positions in m and the positions as a
+        (number of turbines x 2) array."""
+        m = numpy.asarray(m, dtype=float)
+        offset = _position_offset(m, self._controls, len(self._turbines)/2)
+        return offset, numpy.reshape(m[offset:], (-1, 2))
+
+
+    def _pairs(self, positions):
+        """Returns the indices (i, j), i > j, of the constrained turbine pairs.
+        """
+        if self._cutoff is None:
+            # All pairs, ordered as (1, 0), (2, 0), (2, 1), (3, 0), ...
+            return numpy.tril_indices(len(positions), -1)
+
+        # Pairs that moved within the minimum distance since the active set
+        # was selected must be constrained.
+        i, j = self._active_pairs
+        active = set(zip(j.tolist(), i.tolist()))
+        violating = cKDTree(positions).query_pairs(self._minimum_distance)
+        if not violating.issubset(active):
+            dolfin.log(dolfin.WARNING,
+                       "Turbine pairs outside of the active set violate the "
+                       "minimum distance. Selecting the active set again.")
+            self._active_pairs = self._select_pairs(positions)
+
+        return self._active_pairs
+
+
+    def _select_pairs(self, positions):
+        """Returns the indices (i, j), i > j, of the pairs within the cutoff
+        distance, of which the closest max_pairs are selected. The pairs are
+        ordered by their indices."""
+        pairs = cKDTree(positions).query_pairs(self._cutoff)
+        if len(pairs) == 0:
+            return (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int))
+
+        pairs = numpy.array(sorted(pairs))
+        i, j = pairs[:, 1], pairs[:, 0]
+        if len(pairs) > self._n_pairs:
+            dist_sq = ((positions[i]-positions[j])**2).sum(axis=1)
+            closest = numpy.sort(numpy.argsort(dist_sq, kind="mergesort")
+                                 [:self._n_pairs])
+            i, j = i[closest], j[closest]
+        return i, j
 
 
     def function(self, m):
@@ -221,16 +424,20 @@ class MinimumDistanceConstraints(InequalityConstraint):
 
         """
         dolfin.log(dolfin.PROGRESS, "Calculating minimum distance constraints.")
-        inequality_constraints = []
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-                inequality_constraints.append(self._sl2norm([m[2*i]-m[2*j],
-                                                             m[2*i+1]-m[2*j+1]])
-                                              - self._minimum_distance**2)
-
-        inequality_constraints = numpy.array(inequality_constraints)
+        offset, positions = self._positions(m)
+        i, j = self._pairs(positions)
+
+        inequality_constraints = (((positions[i]-positions[j])**2).sum(axis=1)
+                                  - self._minimum_distance**2)
+
+        if self._cutoff is not None:
+            # Fill up the constraints with the value of a pair at the cutoff
+            # distance.
+            padding = numpy.ones(self._n_pairs - len(i))
+            padding *= self._cutoff**2 - self._minimum_distance**2
+            inequality_constraints = numpy.concatenate((inequality_constraints,
+                                                        padding))
+
         if any(inequality_constraints <= 0):
             dolfin.log(dolfin.WARNING,
                        "Minimum distance inequality constraints (should all "
@@ -238,6 +445,41 @@ class MinimumDistanceConstraints(InequalityConstraint):
         return inequality_constraints
 
 
+    def jacobian_sparse(self, m):
+        """Returns the gradient of the constraint function as a sparse matrix.
+
+        Each row contains the gradient of one constraint, which only has four
+        non-zero entries: the derivatives with respect to the positions of the
+        two turbines of the pair.
+
+        :param m: The serialized paramaterisation of the turbines.
+        :tpye m: numpy.ndarray.
+        :returns: scipy.sparse.csr_matrix -- the gradient of the constraint
+            function with respect to each input parameter m.
+
+        """
+        offset, positions = self._positions(m)
+        i, j = self._pairs(positions)
+        diff = 2*(positions[i]-positions[j])
+
+        # The control vector contains the friction coefficients first, so we
+        # need to shift here
+        rows = numpy.repeat(numpy.arange(len(i)), 4)
+        cols = numpy.column_stack((offset+2*i, offset+2*j,
+                                   offset+2*i+1, offset+2*j+1)).ravel()
+        vals = numpy.column_stack((diff[:, 0], -diff[:, 0],
+                                   diff[:, 1], -diff[:, 1])).ravel()
+
+        # In active-set mode, the rows of the filled up constraints are zero.
+        if self._cutoff is None:
+            n_rows = len(i)
+        else:
+            n_rows = self._n_pairs
+
+        return scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                       shape=(n_rows, len(m)))
+
+
     def jacobian(self, m):
         """Returns the gradient of the constraint function.
 
@@ -252,33 +494,7 @@ class MinimumDistanceConstraints(InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating the jacobian of minimum "
                    "distance constraints function.")
-        inequality_constraints = []
-
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-
-                # Need to add space for zeros for the friction
-                if self._controls.position and self._controls.friction:
-                    prime_inequality_constraints = numpy.zeros(len(m)*3/2)
-                    friction_length = len(m)/2
-                else:
-                    prime_inequality_constraints = numpy.zeros(len(m))
-                    friction_length = 0
-
-                # Provide a shorter handle
-                p_ineq_c = prime_inequality_constraints
-
-                # The control vector contains the friction coefficients first,
-                # so we need to shift here
-                p_ineq_c[friction_length+2*i] = 2*(m[2*i] - m[2*j])
-                p_ineq_c[friction_length+2*j] = -2*(m[2*i] - m[2*j])
-                p_ineq_c[friction_length+2*i+1] = 2*(m[2*i+1] - m[2*j+1])
-                p_ineq_c[friction_length+2*j+1] = -2*(m[2*i+1] - m[2*j+1])
-                inequality_constraints.append(p_ineq_c)
-
-        return numpy.array(inequality_constraints)
+        return self.jacobian_sparse(m).toarray()
 
 
 class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
@@ -295,6 +511,18 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
     where N is the number of turbines, :math:`p_i` is the position of the i'th
     turbine and D is the minimum distance between two turbines.
 
+    Since the penalty has a kink at :math:`||p_i - p_j|| = D`, gradient-based
+    optimisers can stall. With smooth=True, the squared penalty
+
+    .. math::
+
+        -\sum_{i,j=0, i>j}^{N-1} \min(||p_i - p_j||^2 - D^2, 0)^2 \ge 0
+
+    is used instead, which is continuously differentiable.
+
+    Only the pairs of turbines that are closer than D contribute to the
+    penalty. They are found with a KD-tree.
+
     .. note:: This class subclasses `dolfin_adjoint.InequalityConstraint`_. The
         following method names must not change:
 
@@ -307,13 +535,16 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
             http://www.dolfin-adjoint.org/en/latest/documentation/api.html#dolfin_adjoint.InequalityConstraint
 
     """
-    def __init__(self, turbine_positions, minimum_distance, controls):
+    def __init__(self, turbine_positions, minimum_distance, controls,
+                 smooth=False):
         """Create MinimumDistanceConstraints
 
         :param serialized_turbines: The serialized turbine paramaterisation.
         :type serialized_turbines: numpy.ndarray.
         :param minimum_distance: The minimum distance allowed between turbines.
         :type minimum_distance: float.
+        :param smooth: Use the continuously differentiable squared penalty.
+        :type smooth: bool.
         :raises: NotImplementedError
 
 
@@ -326,11 +557,7 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         self._turbines = numpy.asarray(turbine_positions).flatten().tolist()
         self._minimum_distance = minimum_distance
         self._controls = controls
-
-
-    def _sl2norm(self, x):
-        """Calculates the squared l2norm of a vector x."""
-        return sum([v**2 for v in x])
+        self._smooth = smooth
 
 
     def length(self):
@@ -338,16 +565,25 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         return 1
 
 
-    def _penalty(self, x_sq):
-        return min(0, x_sq - self._minimum_distance**2)
-
+    def _violations(self, m):
+        """Returns the offset of the positions in m, the positions, the indices
+        (i, j) of the turbine pairs that are closer than the minimum distance
+        and their violations D^2 - ||p_i - p_j||^2 >= 0."""
+        m = numpy.asarray(m, dtype=float)
+        offset = _position_offset(m, self._controls, len(self._turbines)/2)
+        positions = numpy.reshape(m[offset:], (-1, 2))
 
-    def _dpenalty(self, x_sq):
-        """ Returns the derivative of the penalty function """
-        if x_sq - self._minimum_distance**2 > 0:
-            return 0.0
+        pairs = cKDTree(positions).query_pairs(self._minimum_distance)
+        if len(pairs) == 0:
+            i = j = numpy.zeros(0, dtype=int)
         else:
-            return 1.0
+            pairs = numpy.array(list(pairs))
+            i, j = pairs[:, 0], pairs[:, 1]
+
+        violations = (self._minimum_distance**2 -
+                      ((positions[i]-positions[j])**2).sum(axis=1))
+        violations = numpy.maximum(violations, 0)
+        return offset, positions, i, j, violations
 
 
     def function(self, m):
@@ -360,19 +596,12 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
 
         """
         dolfin.log(dolfin.PROGRESS, "Calculating minimum distance constraints.")
+        offset, positions, i, j, violations = self._violations(m)
 
-        if self._controls.position and self._controls.friction:
-            friction_length = len(m)/3
-            m = m[friction_length:]
-
-        value = 0
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-                dist_sq = self._sl2norm([m[2*i]-m[2*j],
-                                         m[2*i+1]-m[2*j+1]])
-                value += self._penalty(dist_sq)
+        if self._smooth:
+            value = -(violations**2).sum()
+        else:
+            value = -violations.sum()
 
         if value <= 0:
             dolfin.log(dolfin.WARNING,
@@ -395,31 +624,24 @@ class MinimumDistanceConstraintsLargeArrays(InequalityConstraint):
         """
         dolfin.log(dolfin.PROGRESS, "Calculating the jacobian of minimum "
                    "distance constraints function.")
-        inequality_constraints = []
+        offset, positions, i, j, violations = self._violations(m)
 
-        if self._controls.position and self._controls.friction:
-            friction_length = len(m)/3
-            m = m[friction_length:]
+        # The derivative of the penalty with respect to the squared distance.
+        if self._smooth:
+            dvalue = 2*violations
         else:
-            friction_length = 0
+            dvalue = numpy.ones(len(violations))
+        dpair = (dvalue*2)[:, numpy.newaxis]*(positions[i]-positions[j])
 
-        p_ineq_c = numpy.zeros(friction_length + len(m))
+        # Scatter the derivatives of the pairs to both turbines.
+        dpositions = numpy.zeros_like(positions)
+        numpy.add.at(dpositions, i, dpair)
+        numpy.add.at(dpositions, j, -dpair)
 
-        for i in range(len(m)/2):
-            for j in range(len(m)/2):
-                if i <= j:
-                    continue
-
-                dist_sq = self._sl2norm([m[2*i]-m[2*j],
-                                         m[2*i+1]-m[2*j+1]])
-                dvalue = self._dpenalty(dist_sq)
-
-                # The control vector contains the friction coefficients first,
-                # so we need to shift here
-                p_ineq_c[friction_length+2*i] += dvalue * 2*(m[2*i] - m[2*j])
-                p_ineq_c[friction_length+2*j] += dvalue * (-2*(m[2*i] - m[2*j]))
-                p_ineq_c[friction_length+2*i+1] += dvalue * 2*(m[2*i+1] - m[2*j+1])
-                p_ineq_c[friction_length+2*j+1] += dvalue * (-2*(m[2*i+1] - m[2*j+1]))
+        # The control vector contains the friction coefficients first, so we
+        # need to shift here
+        p_ineq_c = numpy.zeros(len(m))
+        p_ineq_c[offset:] = dpositions.ravel()
 
         return numpy.array([p_ineq_c])
 
@@ -458,53 +680,80 @@ class ConvexPolygonSiteConstraint(InequalityConstraint):
         # our function is b - A*x.
 
     def length(self):
-        return len(self.config.params['turbine_pos']) * self.nvertices
+        return self.farm.number_of_turbines * self.nvertices
 
     def output_workspace(self):
         return numpy.array([0]*self.length())
 
-    def function(self, m):
-        ieqcons = []
-        controlled_by = self.farm.turbine_specification.controls
-        if (controlled_by.position and
-            (controlled_by.friction or controlled_by.dynamic_friction)):
-        # If the controls consists of the the friction and the positions, then we need to first extract the position part
-            assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
-        else:
-            m_pos = m
+    def _positions(self, m):
+        """ Returns the offset of the positions in m and the positions as a
+        (number of turbines x 2) array. """
+        m = numpy.asarray(m, dtype=float)
+        # If the controls consists of the the friction and the positions, then
+        # we need to first extract the position part
+        offset = _position_offset(m, self.farm.turbine_specification.controls,
+                                  self.farm.number_of_turbines)
+        return offset, numpy.reshape(m[offset:], (-1, 2))
 
-        for i in range(len(m_pos) / 2):
-            pos = numpy.array([m_pos[2 * i], m_pos[2 * i + 1]])
-            c = self.b - numpy.dot(self.A, pos)
-            ieqcons = ieqcons + list(c)
+    def function(self, m):
+        offset, positions = self._positions(m)
 
-        arr = numpy.array(ieqcons)
+        # The constraints of all turbines and vertices, ordered by turbine.
+        arr = (self.b - numpy.dot(positions, self.A.T)).ravel()
         if any(arr < 0):
           log(INFO, "Convex site position constraints (should be >= 0): %s" % arr)
         return arr
 
+    def jacobian_sparse(self, m):
+        """ Returns the jacobian as a sparse matrix. The constraint of the i'th
+        turbine and the k'th vertex only depends on the position of the i'th
+        turbine, so that each row has two non-zero entries. """
+        offset, positions = self._positions(m)
+        n_turbines = len(positions)
+
+        rows = numpy.repeat(numpy.arange(n_turbines*self.nvertices), 2)
+        cols = (offset + 2*numpy.repeat(numpy.arange(n_turbines),
+                                        2*self.nvertices) +
+                numpy.tile([0, 1], n_turbines*self.nvertices))
+        vals = numpy.tile(-self.A.ravel(), n_turbines)
+
+        return scipy.sparse.csr_matrix((vals, (rows, cols)),
+                                       shape=(n_turbines*self.nvertices, len(m)))
+
     def jacobian(self, m):
-        ieqcons = []
-        controlled_by = self.farm.turbine_specification.controls
-        if (controlled_by.position and
-            (controlled_by.friction or controlled_by.dynamic_friction)):
-            # If the controls consists of the the friction and the positions, then we need to first extract the position part
-            assert(len(m) % 3 == 0)
-            m_pos = m[len(m) / 3:]
-            mf_len = len(m_pos) / 2
-        else:
-            m_pos = m
-            mf_len = 0
-
-        for i in range(len(m_pos) / 2):
-            pos = numpy.array([m_pos[2 * i], m_pos[2 * i + 1]])
-            for constraint in range(self.nvertices):
-                d = -self.A[constraint, :]
-                prime = numpy.zeros(len(m))
-                prime[mf_len + 2 * i] = d[0]
-                prime[mf_len + 2 * i + 1] = d[1]
-                ieqcons.append(prime)
-
-        arr = numpy.array(ieqcons)
-        return arr
+        return self.jacobian_sparse(m).toarray()
+
+
+# Gradient based optimisation algorithms that request the derivative at every
+# point at which they evaluate the functional.
+_fused_methods = ["L-BFGS-B", "SLSQP", "BFGS", "CG", "TNC", "Newton-CG"]
+
+
+def _optimise(optimiser, rf, method, **kwargs):
+    fused = getattr(rf, "fused_evaluation", None)
+    if fused is None or method not in _fused_methods:
+        return optimiser(rf, method=method, **kwargs)
+
+    # Compute the derivative along with each functional evaluation, so that
+    # the forward solution is not recomputed for the derivative.
+    rf.fused_evaluation = True
+    try:
+        return optimiser(rf, method=method, **kwargs)
+    finally:
+        rf.fused_evaluation = fused
+
+
+def minimize(rf, method="L-BFGS-B", **kwargs):
+    ''' Minimises the reduced functional rf with dolfin_adjoint.minimize. For
+    gradient based algorithms (such as L-BFGS-B), the functional and its
+    derivative are computed together. '''
+    import dolfin_adjoint
+    return _optimise(dolfin_adjoint.minimize, rf, method, **kwargs)
+
+
+def maximize(rf, method="L-BFGS-B", **kwargs):
+    ''' Maximises the reduced functional rf with dolfin_adjoint.maximize. For
+    gradient based algorithms (such as L-BFGS-B), the functional and its
+    derivative are computed together. '''
+    import dolfin_adjoint
+    return _optimise(dolfin_adjoint.maximize, rf, method, **kwargs)
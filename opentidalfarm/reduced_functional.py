@@ -7,12 +7,42 @@ from dolfin import *
 from dolfin_adjoint import *
 from solvers import Solver
 from functionals import TimeIntegrator, PrototypeFunctional
-from memoize import MemoizeMutable
+from functionals.prototype_functional import CombinedFunctional, \
+                                             ScaledFunctional
+from memoize import MemoizeMutable, ResultStore, fingerprint, to_digest
 from reduced_functional_prototype import ReducedFunctionalPrototype
 
 __all__ = ["ReducedFunctional", "ReducedFunctionalParameters",
            "TurbineFarmControl"]
 
+# The problem parameters that identify the results in the result store.
+_problem_parameters = ["domain", "finite_element", "g", "depth", "viscosity",
+                       "friction", "rho", "tidal_farm", "include_advection",
+                       "include_viscosity", "linear_divergence",
+                       "initial_condition", "initial_condition_u",
+                       "initial_condition_eta", "f_u", "bcs", "theta", "dt",
+                       "start_time", "finish_time",
+                       "functional_final_time_only"]
+
+# The solver parameters that identify the results in the result store. The
+# other parameters only affect the output or the performance.
+_solver_parameters = ["dolfin_solver", "quadrature_degree", "cpp_flags",
+                      "les_model", "les_parameters", "modified_newton",
+                      "jacobian_refresh_period", "jacobian_refresh_rate",
+                      "fieldsplit", "adaptive_timestepping",
+                      "timestep_tolerance", "min_timestep", "max_timestep",
+                      "continuation", "continuation_viscosity_factor",
+                      "continuation_target_iterations", "timestep_predictor",
+                      "secant_predictor"]
+
+# Attributes that are not fingerprinted once per reduced functional: the
+# turbine parameters (which are digested with the control array), attributes
+# derived from them, the time of time dependent expressions (which is set
+# during the solves) and the problem of the functional (which is fingerprinted
+# through its parameters).
+_excluded_attributes = ["_parameters", "turbine_cache", "t", "problem"]
+
+
 class ReducedFunctionalParameters(helpers.FrozenClass):
     """ A set of parameters for a :class:`ReducedFunctional`.
 
@@ -27,8 +57,29 @@ class ReducedFunctionalParameters(helpers.FrozenClass):
         used. Default: False
     :ivar save_checkpoints: Automatically store checkpoints after each
         search iteration. Default: False
+    :ivar checkpoints_sync_period: The number of checkpoints after which the
+        checkpoint files are synchronised to disk. Default: 10
     :ivar checkpoint_basefilename: The base filename (without extensions) for
         storing or loading the checkpoints. Default: 'checkpoints'.
+    :ivar memoization_digest_keys: Identify the memoized evaluations by a
+        digest of the raw bytes of the control array, which is much faster for
+        large control arrays. Default: True
+    :ivar memoization_max_entries: The maximum number of memoized functional
+        and gradient evaluations each. If exceeded, the least recently used
+        evaluations are discarded. Set to None for no limit. Default: None
+    :ivar memoization_max_memory: The maximum memory (in bytes) of the memoized
+        functional and gradient values each. Set to None for no limit.
+        Default: None
+    :ivar result_store_dir: A directory in which the functional values,
+        gradients and final states are stored, so that they can be reused by
+        other runs. The results are identified by a fingerprint of the
+        problem parameters, the solver parameters, the functional and the
+        control array. The problem is fingerprinted once per reduced
+        functional, so it must not be changed after the first evaluation.
+        Set to None to deactivate the result store. Default: None
+    :ivar result_store_max_size: The maximum size (in bytes) of the result
+        store. If exceeded, the least recently used results are removed. Set to
+        None for no limit. Default: None
     """
 
     scale = 1.
@@ -36,6 +87,12 @@ class ReducedFunctionalParameters(helpers.FrozenClass):
     save_checkpoints = False
     load_checkpoints = False
     checkpoints_basefilename = "checkpoints"
+    checkpoints_sync_period = 10
+    memoization_digest_keys = True
+    memoization_max_entries = None
+    memoization_max_memory = None
+    result_store_dir = None
+    result_store_max_size = None
 
 
 class ReducedFunctional(ReducedFunctionalPrototype):
@@ -50,7 +107,8 @@ class ReducedFunctional(ReducedFunctionalPrototype):
     This class has a parameter attribute for further adjustments.
     """
 
-    def __init__(self, functional, controls, solver, parameters):
+    def __init__(self, functional, controls, solver, parameters,
+                 _shared_output=None):
         # For consistency with the dolfin-adjoint API.
         self.scale = parameters.scale
         self.rf = self
@@ -71,12 +129,18 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         self._time_integrator = None
         self._automatic_scaling_factor = None
 
+        # If True, the derivative is computed whenever the functional is
+        # evaluated.
+        self.fused_evaluation = False
+
         # For storing the friction function for each time step as one changing
         # function and not as multiple functions
-        if (isinstance(self.solver.problem.parameters.tidal_farm.\
-                       friction_function, list)):
-            self._friction_plot_function = self.solver.problem.parameters\
-                                           .tidal_farm.friction_function[0]
+        farm = self.solver.problem.parameters.tidal_farm
+        if (farm is not None and
+            farm.turbine_specification.controls.dynamic_friction):
+            self._friction_plot_function = Function(
+                farm._turbine_function_space, name="turbine_friction",
+                annotate=False)
         else:
             self._friction_plot_function = self.solver.problem.parameters\
                                            .tidal_farm.friction_function
@@ -84,7 +148,13 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         # Caching variables that store which controls the last forward run was
         # performed
         self.last_m = None
-        if self.solver.parameters.dump_period > 0:
+        if _shared_output is not None:
+            # Write to the output files of another reduced functional of the
+            # same solver, instead of recreating them.
+            for name in ["turbine_file", "power_file"]:
+                if hasattr(_shared_output, name):
+                    setattr(self, name, getattr(_shared_output, name))
+        elif self.solver.parameters.dump_period > 0:
             turbine_filename = os.path.join(solver.parameters.output_dir, "turbines.pvd")
             self.turbine_file = File(turbine_filename, "compressed")
 
@@ -111,14 +181,36 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             controls = [controls]
         self.controls = controls
 
-        self._compute_functional_mem = MemoizeMutable(self._compute_functional)
-        self._compute_gradient_mem = MemoizeMutable(self._compute_gradient)
+        # The persistent store of results across runs, and the digest of the
+        # problem, solver and functional, which identifies the results.
+        self._result_store = None
+        self._result_digest = None
+        if self.parameters.result_store_dir is not None:
+            self._result_store = ResultStore(
+                self.parameters.result_store_dir,
+                max_size=self.parameters.result_store_max_size)
+
+        # The evaluations are identified by the control array only.
+        memoize_params = {
+            "key_args": 1,
+            "digest_keys": self.parameters.memoization_digest_keys,
+            "max_entries": self.parameters.memoization_max_entries,
+            "max_memory": self.parameters.memoization_max_memory}
+        self._compute_functional_mem = MemoizeMutable(self._load_or_compute_functional,
+                                                      **memoize_params)
+        self._compute_gradient_mem = MemoizeMutable(self._load_or_compute_gradient,
+                                                    **memoize_params)
 
         # Load checkpoints from file
         if self.parameters.load_checkpoints:
             self._load_checkpoint()
 
-        if (self._solver_params.print_individual_turbine_power
+        # Append all new evaluations to the checkpoint files
+        if self.parameters.save_checkpoints:
+            self._open_checkpoint()
+
+        if _shared_output is None and (
+            self._solver_params.print_individual_turbine_power
             or ((self.solver.parameters.dump_period > 0)
             and self._solver_params.output_turbine_power)):
             # if this is enabled, we need to instantiate the relevant helper
@@ -164,6 +256,9 @@ class ReducedFunctional(ReducedFunctionalPrototype):
 
         djdtf = dolfin_adjoint.compute_gradient(J, parameters, forget=forget)
         dolfin.parameters["adjoint"]["stop_annotating"] = False
+        if forget:
+            # The annotation of the forward run has been deleted.
+            self.last_m = None
 
         # Decide if we need to apply the chain rule to get the gradient of
         # interest.
@@ -178,51 +273,31 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             # dJ/dm = (\partial J)/(\partial u) * (d u) / d m + \partial J / \partial m
             #               = adj_state * \partial F / \partial u + \partial J / \partial m
             # In this particular case m = turbine_friction, J = \sum_t(ft)
-            dj = []
-
-            if farm.turbine_specification.controls.friction:
-                # Compute the derivatives with respect to the turbine friction
-                for tfd in farm.turbine_cache["turbine_derivative_friction"]:
-                    farm.update()
-                    dj.append(djdtf.vector().inner(tfd.vector()))
-
-            elif farm.turbine_specification.controls.dynamic_friction:
-                # Compute the derivatives with respect to the turbine friction
-                for djdtf_arr, t in zip(djdtf,
-                                    farm.turbine_cache["turbine_derivative_friction"]):
-                    for tfd in t:
-                        farm.update()
-                        dj.append(djdtf_arr.vector().inner(tfd.vector()))
-
-            if (farm.turbine_specification.controls.position):
-                if (farm.turbine_specification.controls.dynamic_friction):
-                    # Compute the derivatives with respect to the turbine position
-                    farm.update()
-                    turb_deriv_pos = farm.turbine_cache["turbine_derivative_pos"]
-                    n_time_steps =len(turb_deriv_pos)
-                    for n in xrange(farm.number_of_turbines):
-                        for var in ('turbine_pos_x', 'turbine_pos_y'):
-                            dj_t = 0
-                            for t in xrange(n_time_steps):
-                                tfd_t = turb_deriv_pos[t][n][var]
-                                dj_t += djdtf_arr.vector().inner(tfd_t.vector())
-                            dj.append(dj_t)
-
-                else:
-                    # Compute the derivatives with respect to the turbine position
-                    for d in farm.turbine_cache["turbine_derivative_pos"]:
-                        for var in ('turbine_pos_x', 'turbine_pos_y'):
-                            farm.update()
-                            tfd = d[var]
-                            dj.append(djdtf.vector().inner(tfd.vector()))
+            #
+            # The turbine cache stores the derivatives of the turbine field
+            # with respect to the controls as a sparse matrix, so that the
+            # chain rule reduces to a single sparse matrix product with the
+            # local part of djdtf.
+            farm.update()
+            if farm.turbine_specification.controls.dynamic_friction:
+                djdtf_arr = numpy.array([djdtf_t.vector().array()
+                                         for djdtf_t in djdtf])
+            else:
+                djdtf_arr = djdtf.vector().array()
+            dj = farm.turbine_cache.gradient(djdtf_arr)
 
-            dj = numpy.array(dj)
+            # Sum up the contributions of all processes.
+            dj = helpers.mpi_allreduce(dj)
 
         return dj
 
     def _compute_functional(self, m, annotate=True):
         """ Compute the functional of interest for the turbine positions/frictions array """
-        self.last_m = m
+        # The gradient can only reuse the forward run if it was annotated.
+        if annotate:
+            self.last_m = numpy.copy(m)
+        else:
+            self.last_m = None
         self._update_turbine_farm(m)
         farm = self.solver.problem.parameters.tidal_farm
 
@@ -255,6 +330,11 @@ class ReducedFunctional(ReducedFunctionalPrototype):
             numpy.savetxt(filename, self.time_integrator.vals)
 
         j = float(self.time_integrator.integrate())
+
+        if isinstance(self.functional, CombinedFunctional):
+            components = self.time_integrator.integrate_components()
+            for i, val in enumerate(components):
+                log(INFO, "Functional component %i: %e." % (i, float(val)))
         if ((self.solver.parameters.dump_period > 0)
             and self._solver_params.output_j):
             dir = os.path.join(self.solver.parameters.output_dir,
@@ -269,6 +349,84 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         return j
 
 
+    def _result_key(self, m):
+        """ Returns the key of the evaluation for the parameter array m in the
+        result store. The turbine farm must be up to date with m. The problem,
+        solver and functional are fingerprinted once, at the first
+        evaluation. """
+        if self._result_digest is None:
+            params = [[(name, getattr(parameters, name))
+                       for name in names if hasattr(parameters, name)]
+                      for parameters, names in
+                      [(self._problem_params, _problem_parameters),
+                       (self._solver_params, _solver_parameters)]]
+            self._result_digest = fingerprint(
+                [type(self.solver.problem).__name__, type(self.solver).__name__,
+                 params, self.functional],
+                exclude=_excluded_attributes)
+
+        digest = self._result_digest.copy()
+        farm = self._problem_params.tidal_farm
+        if farm is not None:
+            for name in sorted(farm._parameters):
+                digest.update(name)
+                to_digest(farm._parameters[name], digest)
+        to_digest(m, digest)
+
+        # Each process stores its part of the state.
+        key = digest.hexdigest()
+        if MPI.size(mpi_comm_world()) > 1:
+            key += "_p%i" % helpers.get_rank()
+        return key
+
+    def _load_result(self, m, name):
+        """ Returns the result store entry for m if it contains the result
+        name on all processes, or None otherwise. """
+        self._update_turbine_farm(m)
+        key = self._result_key(m)
+        entry = self._result_store.get(key, name)
+
+        found = helpers.mpi_allreduce(numpy.array([entry is not None]), "min")
+        if not found[0]:
+            return key, None
+        return key, entry
+
+    def _load_or_compute_functional(self, m, annotate=True):
+        """ Loads the functional value for m from the result store, or computes
+        and stores it. """
+        if self._result_store is None:
+            return self._compute_functional(m, annotate=annotate)
+
+        key, entry = self._load_result(m, "j")
+        if entry is not None:
+            log(INFO, "Loaded the functional value from the result store.")
+            # The farm has changed since the last annotated forward run.
+            self.last_m = None
+            if getattr(self.solver, "state", None) is not None:
+                self.solver.state.vector().set_local(entry["state"])
+                self.solver.state.vector().apply("insert")
+            return float(entry["j"])
+
+        j = self._compute_functional(m, annotate=annotate)
+        self._result_store.put(key, j=numpy.array(j),
+                               state=self.solver.state.vector().array())
+        return j
+
+    def _load_or_compute_gradient(self, m, forget=True):
+        """ Loads the functional gradient for m from the result store, or
+        computes and stores it. """
+        if self._result_store is None:
+            return self._compute_gradient(m, forget=forget)
+
+        key, entry = self._load_result(m, "dj")
+        if entry is not None:
+            log(INFO, "Loaded the functional gradient from the result store.")
+            return entry["dj"]
+
+        dj = self._compute_gradient(m, forget=forget)
+        self._result_store.put(key, dj=dj)
+        return dj
+
     def _set_revolve_parameters(self):
         if (hasattr(self._solver_params, "revolve_parameters")
             and self._solver_params.revolve_parameters is not None):
@@ -312,23 +470,159 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         farm.update()
 
 
+    def _checkpoint_base_path(self):
+        base_filename = self.parameters.checkpoints_basefilename
+        return os.path.join(self._solver_params.output_dir, base_filename)
+
+    def _open_checkpoint(self):
+        """ Opens the checkpoint files, to which each new evaluation of the
+        functional and its gradient is appended. Existing checkpoint files are
+        only extended if the checkpoints were loaded. """
+        base_path = self._checkpoint_base_path()
+        append = self.parameters.load_checkpoints
+        sync_period = self.parameters.checkpoints_sync_period
+        self._compute_functional_mem.open_checkpoint_log(
+            base_path + "_fwd.log", append=append, sync_period=sync_period)
+        self._compute_gradient_mem.open_checkpoint_log(
+            base_path + "_adj.log", append=append, sync_period=sync_period)
+
     def _save_checkpoint(self):
         """ Checkpoint the reduced functional from which can be used to restart
-        the turbine optimisation. """
-        base_filename = self.parameters.checkpoints_basefilename
-        base_path = os.path.join(self._solver_params.output_dir, base_filename)
-        self._compute_functional_mem.save_checkpoint(base_path + "_fwd.dat")
-        self._compute_gradient_mem.save_checkpoint(base_path + "_adj.dat")
+        the turbine optimisation. The evaluations are appended to the
+        checkpoint files as they are computed, so this only passes them on to
+        the operating system. """
+        self._compute_functional_mem.flush_checkpoint_log()
+        self._compute_gradient_mem.flush_checkpoint_log()
+
+    def close(self):
+        """ Synchronises the checkpoint files to disk and closes them. The
+        checkpoint files are also closed when the interpreter exits. """
+        self._compute_functional_mem.close_checkpoint_log()
+        self._compute_gradient_mem.close_checkpoint_log()
 
     def _load_checkpoint(self):
         """ Checkpoint the reduceduced functional from which can be used to
-        restart the turbine optimisation. """
-        base_filename = self.parameters.checkpoints_basefilename
-        base_path = os.path.join(self._solver_params.output_dir, base_filename)
-        self._compute_functional_mem.load_checkpoint(base_path + "_fwd.dat")
-        self._compute_gradient_mem.load_checkpoint(base_path + "_adj.dat")
+        restart the turbine optimisation. Checkpoint files in the old format
+        (a pickled dictionary) are loaded if no checkpoint log exists. """
+        base_path = self._checkpoint_base_path()
+        for mem, suffix in [(self._compute_functional_mem, "_fwd"),
+                            (self._compute_gradient_mem, "_adj")]:
+            if os.path.exists(base_path + suffix + ".log"):
+                mem.load_checkpoint_log(base_path + suffix + ".log")
+            else:
+                mem.load_checkpoint(base_path + suffix + ".dat")
 
     def evaluate(self, m, annotate=True):
+        """ Return the functional value for the given parameter array.
+
+        If fused_evaluation is True, the derivative is computed along with the
+        functional value (see :meth:`evaluate_and_derivative`). This is
+        used by optimisation algorithms which need the derivative at every
+        point at which they evaluate the functional. """
+        if self.fused_evaluation and annotate:
+            return self.evaluate_and_derivative(m)[0]
+        return self._evaluate(m, annotate=annotate)
+
+    def evaluate_and_derivative(self, m, forget=True):
+        """ Return the functional value and its derivative for the given
+        parameter array.
+
+        Both are computed with a single forward and a single adjoint solve
+        and stored in the caches, so that subsequent calls to
+        :meth:`evaluate` and :meth:`derivative` with the same parameter array
+        do not solve again. """
+        j = self._evaluate(m, annotate=True)
+        # The search iteration is advanced when the optimisation algorithm
+        # requests the derivative.
+        dj = self._dj(m, forget, new_search_iteration=False)
+        return j, dj
+
+    def evaluate_many(self, ms, workers=1, derivative=False, factory=None):
+        """ Return the functional values for a list of parameter arrays.
+
+        The evaluations are stored in the caches, as if they were computed
+        with :meth:`evaluate` (and :meth:`derivative`). This is useful for
+        sampling the functional, for example at random turbine layouts.
+
+        If workers > 1, the parameter arrays are evaluated in parallel in
+        worker processes (see :func:`helpers.spawn_map`). Each worker builds
+        its own reduced functional with factory, which must set up the same
+        problem as this reduced functional. The worker processes do not write
+        output files. In parallel runs with MPI, the parameter arrays are
+        evaluated one after another.
+
+        :param ms: The list of parameter arrays.
+        :param workers: The number of worker processes. Default: 1, i.e. the
+            parameter arrays are evaluated one after another.
+        :param derivative: If True, the derivatives are computed as well.
+        :param factory: A function without arguments, defined at the top
+            level of an importable module, that returns a
+            :class:`ReducedFunctional` of the same problem. Required if
+            workers > 1.
+        :returns: list -- the functional values, or a list of (value,
+            derivative) tuples if derivative is True.
+        """
+        return self.evaluate_many_async(ms, workers, derivative,
+                                        factory).get()
+
+    def evaluate_many_async(self, ms, workers=1, derivative=False,
+                            factory=None):
+        """ A variant of :meth:`evaluate_many` that returns once the worker
+        processes are started, so that the functional can be used (e.g. to
+        compute a derivative) while the parameter arrays are evaluated.
+
+        :returns: an object whose get() method waits for and returns the
+            results of :meth:`evaluate_many`. If the parameter arrays are
+            evaluated one after another, they are evaluated when the results
+            are requested.
+        """
+        ms = [numpy.asarray(m, dtype=float) for m in ms]
+
+        # Only evaluate the parameter arrays that are not in the caches, each
+        # of them once.
+        new_ms = {}
+        for m in ms:
+            key = self._compute_functional_mem.get_key((m,), {})
+            if (not self._compute_functional_mem.has_cache(m) or
+                (derivative and not self._compute_gradient_mem.has_cache(m))):
+                new_ms[key] = m
+        new_ms = new_ms.values()
+
+        items = [(m, derivative) for m in new_ms]
+        if workers > 1 and len(items) > 1 and MPI.size(mpi_comm_world()) == 1:
+            if factory is None:
+                raise ValueError("Parallel evaluations need a factory that "
+                                 "builds the reduced functional in the "
+                                 "worker processes.")
+            log(INFO, "Evaluating the functional for %i parameter arrays in "
+                "%i worker processes" % (len(items), workers))
+            pending = helpers.spawn_map_async(factory, _evaluate_in_worker,
+                                              items, workers)
+        else:
+            log(INFO, "Evaluating the functional for %i parameter arrays" %
+                len(items))
+            pending = helpers.ParallelMapResult(self._solve_item, items)
+
+        return _PendingEvaluations(self, ms, new_ms, derivative, pending)
+
+    def _solve_item(self, item):
+        """ Computes the functional (and its derivative) of an item of
+        :meth:`evaluate_many`. """
+        m, derivative = item
+        j = self._load_or_compute_functional(m, annotate=derivative)
+        if derivative:
+            return j, self._load_or_compute_gradient(m, forget=True)
+        return j, None
+
+    def _init_worker(self):
+        """ Prepares the reduced functional for evaluations in a worker
+        process. The output and checkpoint files are written by the calling
+        process only. """
+        self.solver.parameters.dump_period = 0
+        self._compute_functional_mem.checkpoint_log = None
+        self._compute_gradient_mem.checkpoint_log = None
+
+    def _evaluate(self, m, annotate=True):
         """ Return the functional value for the given parameter array. """
         log(INFO, 'Start evaluation of j')
         timer = dolfin.Timer("j evaluation")
@@ -383,7 +677,7 @@ class ReducedFunctional(ReducedFunctionalPrototype):
                     friction_file = File(filename)
                     for timestep in range(0,len(farm.friction_function)):
                         self._friction_plot_function.assign(
-                            farm.friction_function[timestep])
+                            farm.friction_function[timestep], annotate=False)
                         friction_file << self._friction_plot_function
                 else:
                     self.turbine_file << farm.turbine_cache["turbine_field"]
@@ -398,6 +692,12 @@ class ReducedFunctional(ReducedFunctionalPrototype):
 
         log(INFO, "Runtime: " + str(timer.stop()) + " s")
         log(INFO, "|dj| = " + str(numpy.linalg.norm(dj)))
+        log(INFO, "Memoized functional evaluations: " +
+                  self._compute_functional_mem.statistics())
+        log(INFO, "Memoized gradient evaluations: " +
+                  self._compute_gradient_mem.statistics())
+        if self._result_store is not None:
+            log(INFO, "Result store: " + self._result_store.statistics())
 
         if self.parameters.automatic_scaling:
             self._set_automatic_scaling_factor(dj)
@@ -442,17 +742,30 @@ class ReducedFunctional(ReducedFunctionalPrototype):
 
         return self._dj(m_array, forget)
 
-    def derivative_with_check(self, m, seed=0.1, tol=1.8, forget=True):
+    def derivative_with_check(self, m, seed=0.1, tol=1.8, forget=True,
+                              workers=1, factory=None):
         ''' This function checks the correctness and returns the gradient of
-        the functional for the parameter choice m. '''
+        the functional for the parameter choice m. If workers > 1, the
+        perturbed functionals are evaluated in worker processes while the
+        gradient is computed (see :meth:`evaluate_many` for the factory
+        that builds the reduced functional of the workers). '''
 
         log(INFO, "Checking derivative at m = " + str(m))
         p = numpy.random.rand(len(m))
+        evaluate_async = None
+        if workers > 1:
+            if factory is None:
+                raise ValueError("Parallel evaluations need a factory that "
+                                 "builds the reduced functional in the "
+                                 "worker processes.")
+            evaluate_async = lambda ms: self.evaluate_many_async(
+                ms, workers=workers, factory=factory)
         minconv = helpers.test_gradient_array(self.evaluate,
                                               self._dj,
                                               m,
                                               seed=seed,
-                                              perturbation_direction=p)
+                                              perturbation_direction=p,
+                                              evaluate_async=evaluate_async)
         if minconv < tol:
             log(INFO, "The gradient taylor remainder test failed.")
             sys.exit(1)
@@ -465,6 +778,96 @@ class ReducedFunctional(ReducedFunctionalPrototype):
         return mpi_comm_world()
 
 
+def _evaluate_in_worker(rf, item):
+    """ Evaluates an item of :meth:`ReducedFunctional.evaluate_many` with the
+    reduced functional of a worker process. """
+    rf._init_worker()
+    return rf._solve_item(item)
+
+
+class _PendingEvaluations(object):
+    """ The pending results of :meth:`ReducedFunctional.evaluate_many_async`,
+    which are stored in the caches of the reduced functional once they are
+    available. """
+
+    def __init__(self, rf, ms, new_ms, derivative, pending):
+        self._rf = rf
+        self._ms = ms
+        self._new_ms = new_ms
+        self._derivative = derivative
+        self._pending = pending
+        self._timer = dolfin.Timer("j batch evaluation")
+        self._values = None
+
+    def get(self):
+        """ Waits for and returns the results. """
+        if self._values is not None:
+            return self._values
+
+        rf = self._rf
+        results = self._pending.get()
+        log(INFO, 'Runtime: %f s.' % self._timer.stop())
+
+        for m, (j, dj) in zip(self._new_ms, results):
+            rf._compute_functional_mem.store(j, m)
+            if self._derivative:
+                rf._compute_gradient_mem.store(dj, m)
+
+        if rf.parameters.save_checkpoints:
+            rf._save_checkpoint()
+
+        if self._derivative:
+            self._values = [(rf._evaluate(m, annotate=False),
+                             rf._dj(m, True, new_search_iteration=False))
+                            for m in self._ms]
+        else:
+            self._values = [rf._evaluate(m, annotate=False) for m in self._ms]
+        return self._values
+
+
+def combine_reduced_functionals(terms):
+    """ Combines reduced functionals that share their solver and controls into
+    a single :class:`ReducedFunctional`, which integrates all functionals in
+    one forward solve and computes the derivative with one adjoint solve.
+
+    :param terms: A list of (weight, reduced functional) tuples.
+    :returns: A tuple of the reduced functional of the weighted sum of the
+        functionals, or None if they cannot be combined, and a flag that is
+        False if they might be combined later. Reduced functionals with
+        automatic scaling can only be combined once their scaling factor has
+        been determined.
+    """
+    first = terms[0][1]
+    for weight, rf in terms:
+        if (not isinstance(rf, ReducedFunctional) or
+            rf.solver is not first.solver or rf.controls != first.controls):
+            return None, True
+
+    functionals = []
+    for weight, rf in terms:
+        scale = weight*rf.scale
+        if rf.parameters.automatic_scaling:
+            if rf._automatic_scaling_factor is None:
+                return None, False
+            scale *= rf._automatic_scaling_factor
+        functionals.append(ScaledFunctional(rf.functional, float(scale)))
+
+    log(INFO, "Combining %i functionals with a shared forward solve" %
+        len(functionals))
+    params = ReducedFunctionalParameters()
+    params.automatic_scaling = False
+    params.memoization_digest_keys = first.parameters.memoization_digest_keys
+    params.memoization_max_entries = first.parameters.memoization_max_entries
+    params.memoization_max_memory = first.parameters.memoization_max_memory
+
+    # The combined reduced functional shares the output files of the first
+    # one, and the individual turbine power is still written for the
+    # functional of the first one.
+    rf = ReducedFunctional(CombinedFunctional(functionals), first.controls,
+                           first.solver, params, _shared_output=first)
+    return rf, True
+
+
 class TurbineFarmControl(object):
     """This class is required to that the parameter set works with
     dolfin-adjoint."""
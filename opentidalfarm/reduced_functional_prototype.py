@@ -75,6 +75,11 @@ class ReducedFunctionalPrototype(ReducedFunctionalNumPy):
 class CombinedReducedFunctional(ReducedFunctionalPrototype):
     """ Constructs a single combined functional by adding one functional to
     another.
+
+    If the combined reduced functionals share the same solver and controls,
+    the combined functional is evaluated with a single forward solve, in which
+    all functionals are integrated, and its derivative with a single adjoint
+    solve.
     """
 
     def __init__(self, reduced_functional_list):
@@ -82,11 +87,57 @@ class CombinedReducedFunctional(ReducedFunctionalPrototype):
             assert isinstance(reducedfunctional, ReducedFunctionalNumPy)
         self.reduced_functional_list = reduced_functional_list
 
-		# We know that all controls are the same, so just pick the first one
+        # We know that all controls are the same, so just pick the first one
         self.controls = reduced_functional_list[0].controls
 
+        # The reduced functional that evaluates all functionals with a shared
+        # forward solve, if it exists.
+        self._shared_reduced_functional = None
+        self._shared_reduced_functional_checked = False
+        self._fused_evaluation = False
+
+    @property
+    def fused_evaluation(self):
+        """ If True, the derivative is computed along with each functional
+        evaluation. Setting it sets the flag of the shared reduced functional
+        and of all combined reduced functionals that support it. """
+        return self._fused_evaluation
+
+    @fused_evaluation.setter
+    def fused_evaluation(self, fused):
+        self._fused_evaluation = fused
+        rfs = [rf for weight, rf in self.linear_terms()]
+        if self._shared_reduced_functional is not None:
+            rfs.append(self._shared_reduced_functional)
+        for rf in rfs:
+            if hasattr(rf, "fused_evaluation"):
+                rf.fused_evaluation = fused
+
+    def linear_terms(self):
+        """ Returns the combined functional as a list of (weight, reduced
+        functional) tuples, such that it is the weighted sum of the reduced
+        functionals. """
+        return _linear_terms(self)
+
+    def shared_reduced_functional(self):
+        """ Returns a single reduced functional that evaluates all combined
+        functionals with a shared forward solve, or None if they do not share
+        their solver and controls. """
+        if not self._shared_reduced_functional_checked:
+            from reduced_functional import combine_reduced_functionals
+            rf, final = combine_reduced_functionals(self.linear_terms())
+            if rf is not None:
+                rf.fused_evaluation = self._fused_evaluation
+            self._shared_reduced_functional = rf
+            self._shared_reduced_functional_checked = final
+        return self._shared_reduced_functional
+
     def __call__(self, m):
         """Return the functional value for the controls choice"""
+        shared_rf = self.shared_reduced_functional()
+        if shared_rf is not None:
+            return shared_rf(m)
+
         combined_reduced_functional = sum([reducedfunctional.__call__(m) for \
                 reducedfunctional in self.reduced_functional_list])
         return combined_reduced_functional
@@ -94,12 +145,28 @@ class CombinedReducedFunctional(ReducedFunctionalPrototype):
     def derivative(self, m, **kwargs):
         """ Return the derivative of the functional value with respect to
         the control choice"""
+        shared_rf = self.shared_reduced_functional()
+        if shared_rf is not None:
+            return shared_rf.derivative(m, **kwargs)
+
         combined_reduced_functional_derivative = \
                 sum([reducedfunctional.derivative(m, **kwargs) for \
                 reducedfunctional in self.reduced_functional_list])
         return combined_reduced_functional_derivative
 
 
+def _linear_terms(reducedfunctional, weight=1):
+    """ Returns the (weight, reduced functional) terms of a combined or scaled
+    reduced functional. """
+    if isinstance(reducedfunctional, CombinedReducedFunctional):
+        return [term for rf in reducedfunctional.reduced_functional_list
+                for term in _linear_terms(rf, weight)]
+    if isinstance(reducedfunctional, ScaledReducedFunctional):
+        return _linear_terms(reducedfunctional.reducedfunctional,
+                             weight*reducedfunctional.scaling_factor)
+    return [(weight, reducedfunctional)]
+
+
 class ScaledReducedFunctional(ReducedFunctionalPrototype):
     """Scales the functional
     """
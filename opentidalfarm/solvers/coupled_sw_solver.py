@@ -1,6 +1,7 @@
 import os.path
 from os import mkdir
 
+import numpy
 from dolfin import *
 from dolfin_adjoint import *
 
@@ -8,7 +9,9 @@ from solver import Solver
 from ..problems import SWProblem
 from ..problems import SteadySWProblem
 from ..problems import MultiSteadySWProblem
-from ..helpers import StateWriter, FrozenClass
+from ..helpers import StateWriter, FrozenClass, mpi_allreduce, spawn_map
+from state_cache import StateCache
+from modified_newton import ModifiedNewtonSolver
 
 
 class CoupledSWSolverParameters(FrozenClass):
@@ -25,6 +28,7 @@ class CoupledSWSolverParameters(FrozenClass):
 
         By default, the MUMPS direct solver is used for the linear system. If
         not available, the default solver and preconditioner of FEniCS is used.
+        Other configurations can be selected with :meth:`set_solver_preset`.
 
     :ivar dump_period: Specifies how often the solution should be dumped to disk.
         Use a negative value to disable it. Default 1.
@@ -32,6 +36,88 @@ class CoupledSWSolverParameters(FrozenClass):
         for every timestep and are used as initial guesses for the next solve.
         If False, the solution of the previous timestep is used as an initial guess.
         Default: True
+    :ivar state_cache_max_memory: The memory budget (in bytes) for the cached
+        forward states. If exceeded, states are moved to a memory-mapped file
+        (see `state_cache_spill`). Default: None (no limit)
+    :ivar state_cache_policy: Selects the cached states that are kept in memory
+        if the memory budget is exceeded: "lru" keeps the most recently used
+        states, "strided" keeps the states of every k'th timestep.
+        Default: "lru"
+    :ivar state_cache_spill: If True, the cached states that exceed the memory
+        budget are stored in a memory-mapped file, otherwise they are
+        discarded. Default: True
+    :ivar state_cache_single_precision: Store the cached states in single
+        precision. Default: False
+    :ivar timestep_predictor: If the initial guess for a timestep is not
+        cached, extrapolate it from the solutions of the previous timesteps.
+        Valid values are None (use the previous solution, or the initial
+        condition for multi steady-state problems), "linear" or "quadratic".
+        Default: None
+    :ivar secant_predictor: Extrapolate the initial guesses from the cached
+        states of the previous two forward solves, based on the change of the
+        controls (requires `cache_forward_state`). Default: False
+    :ivar adaptive_timestepping: Adapt the timestep of transient problems to
+        the local time discretisation error. The error of each timestep is
+        estimated from the difference between the solution and its linear
+        extrapolation from the previous two timesteps. Timesteps with an error
+        above `timestep_tolerance` (or a failed Newton solve) are repeated
+        with a smaller timestep. Only accepted timesteps are annotated for the
+        adjoint model. The initial timestep is the `dt` problem parameter.
+        A remainder below `min_timestep` before the finish time is merged into
+        the last timestep. The states of the adaptive timesteps are not
+        cached for the next forward solve. Not supported with dynamic friction
+        controls. Default: False
+    :ivar freeze_timesteps: Record the timesteps that the adaptive time
+        stepping accepts in the first forward solve, and reuse them in all
+        later solves (see :meth:`CoupledSWSolver.reset_timesteps`). The
+        adjoint model treats the timesteps as constants, hence the derivative
+        is only consistent with the functional if the timesteps do not depend
+        on the controls. If False, every solve adapts its timesteps, and the
+        derivative ignores their dependency on the controls. Default: True
+    :ivar timestep_tolerance: The tolerance for the estimated relative error
+        of each timestep. Default: 1e-3
+    :ivar min_timestep: The minimum timestep of the adaptive time stepping.
+        Default: None (one hundredth of `dt`)
+    :ivar max_timestep: The maximum timestep of the adaptive time stepping.
+        Default: None (ten times `dt`)
+    :ivar continuation: Solve steady-state equations by continuation, if no
+        cached or extrapolated initial guess is available: "viscosity" starts
+        with the viscosity scaled by `continuation_viscosity_factor`,
+        "advection" starts without the advection term. The parameter is then
+        stepped towards the target equations, using each converged solution
+        as initial guess for the next step. The continuation steps of each
+        time level are remembered for the next forward solve. None disables
+        the continuation. Default: None
+    :ivar continuation_viscosity_factor: The factor of the viscosity at the
+        start of a viscosity continuation. Default: 10.
+    :ivar continuation_target_iterations: The continuation step is increased
+        if the Newton solver needs fewer iterations, and decreased if it needs
+        more. Default: 4
+    :ivar ensemble_workers: The number of worker processes that solve the time
+        levels of a :class:`MultiSteadySWProblem` concurrently. The computed
+        states are then used as initial guesses for the annotated solves of
+        the time loop, which start converged and hence do not factorise the
+        Jacobian. The workers are new processes, which build their own solver
+        with `ensemble_factory` (see :func:`opentidalfarm.helpers.spawn_map`),
+        hence this setting is ignored in MPI runs. Default: 1 (solve the
+        levels one after another)
+    :ivar ensemble_factory: A function without arguments, defined at the top
+        level of an importable module, that returns a :class:`CoupledSWSolver`
+        for the same problem (on the same mesh). Required if
+        `ensemble_workers` > 1. Default: None
+    :ivar modified_newton: Solve the nonlinear problems with a modified Newton
+        method, which reuses the Jacobian and its LU factorisation across
+        iterations, timesteps and forward solves (see
+        :class:`ModifiedNewtonSolver`). Default: False
+    :ivar jacobian_refresh_period: The maximum number of modified Newton
+        iterations with the same Jacobian. Default: 5
+    :ivar jacobian_refresh_rate: The Jacobian is refreshed if a modified
+        Newton iteration reduces the residual by less than this factor.
+        Default: 0.5
+    :ivar fieldsplit: Solve the linear systems with GMRES and a field-split
+        Schur complement preconditioner (see :func:`fieldsplit_petsc_options`).
+        This uses the Newton iteration of :class:`ModifiedNewtonSolver`.
+        Default: False
     :ivar print_individual_turbine_power: Print out the turbine power for each
         turbine. Default: False
     :ivar quadrature_degree: The quadrature degree for the matrix assembly.
@@ -79,6 +165,26 @@ class CoupledSWSolverParameters(FrozenClass):
 
     # Performance settings
     cache_forward_state = True
+    state_cache_max_memory = None
+    state_cache_policy = "lru"
+    state_cache_spill = True
+    state_cache_single_precision = False
+    timestep_predictor = None
+    secant_predictor = False
+    ensemble_workers = 1
+    ensemble_factory = None
+    continuation = None
+    continuation_viscosity_factor = 10.
+    continuation_target_iterations = 4
+    adaptive_timestepping = False
+    freeze_timesteps = True
+    timestep_tolerance = 1e-3
+    min_timestep = None
+    max_timestep = None
+    modified_newton = False
+    jacobian_refresh_period = 5
+    jacobian_refresh_rate = 0.5
+    fieldsplit = False
     quadrature_degree = -1
     cpp_flags = ["-O3", "-ffast-math", "-march=native"]
     revolve_parameters = None  # (strategy,
@@ -90,14 +196,46 @@ class CoupledSWSolverParameters(FrozenClass):
     callback = lambda self, sol: None
 
     def __init__(self):
+        self.set_solver_preset("direct")
 
-        linear_solver = 'mumps' if 'mumps' in linear_solver_methods() else 'default'
-        preconditioner = 'default'
+    def set_solver_preset(self, preset):
+        """ Configures the nonlinear and linear solvers. Available presets are:
 
-        self.dolfin_solver["newton_solver"]["linear_solver"] = linear_solver
-        self.dolfin_solver["newton_solver"]["preconditioner"] = preconditioner
-        self.dolfin_solver["newton_solver"]["maximum_iterations"] = 20
-        self.dolfin_solver["newton_solver"]["convergence_criterion"] = "incremental"
+        - "direct": Newton's method with the MUMPS direct solver, or the
+          default solver of FEniCS if MUMPS is not available.
+        - "fieldsplit": Newton's method with GMRES, preconditioned with a
+          Schur complement field-split of the velocity and free-surface blocks
+          and algebraic multigrid for the free-surface block. Scales to larger
+          meshes and more processes than direct solvers.
+
+        Note that the preset replaces the `dolfin_solver` settings.
+        """
+        if preset == "direct":
+            linear_solver = 'mumps' if 'mumps' in linear_solver_methods() else 'default'
+            preconditioner = 'default'
+
+            self.dolfin_solver = {"newton_solver": {}}
+            self.dolfin_solver["newton_solver"]["linear_solver"] = linear_solver
+            self.dolfin_solver["newton_solver"]["preconditioner"] = preconditioner
+            self.dolfin_solver["newton_solver"]["maximum_iterations"] = 20
+            self.dolfin_solver["newton_solver"]["convergence_criterion"] = "incremental"
+            self.modified_newton = False
+            self.fieldsplit = False
+
+        elif preset == "fieldsplit":
+            # The Krylov solver and preconditioner are configured with the
+            # PETSc options of fieldsplit_petsc_options.
+            self.dolfin_solver = {"newton_solver": {}}
+            self.dolfin_solver["newton_solver"]["maximum_iterations"] = 20
+            self.dolfin_solver["newton_solver"]["krylov_solver"] = {
+                "relative_tolerance": 1e-10,
+                "absolute_tolerance": 1e-14,
+                "maximum_iterations": 1000}
+            self.modified_newton = False
+            self.fieldsplit = True
+
+        else:
+            raise ValueError("Unknown solver preset '%s'." % preset)
 
 class CoupledSWSolver(Solver):
     r""" The coupled solver solves the shallow water equations as a fully coupled
@@ -172,10 +310,38 @@ class CoupledSWSolver(Solver):
         # If cache_for_nonlinear_initial_guess is true, then we store all
         # intermediate state variables in this dictionary to be used for the
         # next solve
-        self.state_cache = {}
+        self.state_cache = self._new_state_cache()
+
+        # For the secant predictor, the states of the forward solve before the
+        # last one are stored as well, with the control arrays of both (latest
+        # first).
+        self.previous_state_cache = self._new_state_cache()
+        self._control_points = []
+
+        # The number of Newton iterations of each timestep of the last forward
+        # solve, and whether its initial guess was predicted.
+        self.newton_iterations = []
+        # The number of Jacobian factorisations of each timestep of the last
+        # forward solve with the modified Newton solver.
+        self.jacobian_factorisations = []
+        # The number of Newton iterations of the last solve at each time
+        # without a predicted initial guess.
+        self._unpredicted_iterations = {}
 
         self.state = None
 
+        # The setup of the equations, which is reused by subsequent solves.
+        self._setup_cache = None
+        self._setup_cache_key = None
+        self._setup_time = 0.
+
+        # The continuation steps of each time level of the last forward solve.
+        self._continuation_paths = {}
+
+        # The timesteps that the adaptive time stepping accepted in the first
+        # forward solve, if they are frozen.
+        self.adaptive_timesteps = None
+
         self.mesh = problem.parameters.domain.mesh
         elements = self.problem.parameters.finite_element()
         self.function_space = FunctionSpace(self.mesh, MixedElement(elements))
@@ -186,6 +352,20 @@ class CoupledSWSolver(Solver):
         """
         return CoupledSWSolverParameters()
 
+    def reset_timesteps(self):
+        """ Discards the frozen timesteps of the adaptive time stepping (see
+        the `freeze_timesteps` parameter), so that the next forward solve
+        adapts and records them again. """
+        self.adaptive_timesteps = None
+
+    def _new_state_cache(self):
+        solver_params = self.parameters
+        return StateCache(
+            max_memory=solver_params.state_cache_max_memory,
+            policy=solver_params.state_cache_policy,
+            spill=solver_params.state_cache_spill,
+            single_precision=solver_params.state_cache_single_precision)
+
     def _generate_strong_bcs(self):
 
         bcs = self.problem.parameters.bcs
@@ -224,8 +404,408 @@ class CoupledSWSolver(Solver):
         else:
             return float(current_time - finish_time) >= - 1e3*DOLFIN_EPS
 
-    def solve(self, annotate=True):
-        ''' Returns an iterator for solving the shallow water equations. '''
+    def _secant_weight(self, m):
+        """ Returns the weight alpha of the secant prediction
+        s_k + alpha*(s_k - s_{k-1}) of the state for the control array m, where
+        s_k and s_{k-1} are the states of the last two forward solves. alpha
+        is the projection of m - m_k onto m_k - m_{k-1}. Returns None if the
+        prediction is not available. """
+        if m is None or len(self._control_points) < 2:
+            return None
+
+        m_k, m_k1 = self._control_points
+        if not (numpy.shape(m) == numpy.shape(m_k) == numpy.shape(m_k1)):
+            return None
+
+        d = m_k - m_k1
+        dd, md = mpi_allreduce(numpy.array([numpy.dot(d, d),
+                                            numpy.dot(m - m_k, d)]))
+        if dd == 0:
+            return None
+
+        # Do not extrapolate far beyond the last two control arrays.
+        return numpy.clip(md/dd, -1., 2.)
+
+    def _predict(self, t, state_new, alpha, previous_solutions,
+                 include_time_term):
+        """ Sets the initial guess for the solve at time t. Returns True if the
+        initial guess was predicted by extrapolation. """
+        solver_params = self.parameters
+
+        if solver_params.cache_forward_state and t in self.state_cache:
+            s_k = self.state_cache.get(t)
+            if alpha is not None and t in self.previous_state_cache:
+                log(INFO, "Extrapolate initial guess from the last two forward "
+                          "solves for t=%f." % t)
+                s_k1 = self.previous_state_cache.get(t)
+                state_new.vector().set_local(s_k + alpha*(s_k - s_k1))
+                state_new.vector().apply("insert")
+                return True
+
+            log(INFO, "Read initial guess from cache for t=%f." % t)
+            # Load initial guess for solver from cache
+            state_new.vector().set_local(s_k)
+            state_new.vector().apply("insert")
+            return False
+
+        order = {None: 0, "linear": 1, "quadratic": 2}[
+            solver_params.timestep_predictor]
+        order = min(order, len(previous_solutions) - 1)
+        if order > 0:
+            log(INFO, "Extrapolate initial guess from the previous timesteps.")
+            s = previous_solutions
+            if order == 1:
+                guess = 2*s[-1] - s[-2]
+            else:
+                guess = 3*s[-1] - 3*s[-2] + s[-3]
+            state_new.vector().set_local(guess)
+            state_new.vector().apply("insert")
+            return True
+
+        if not include_time_term:
+            log(INFO, "Set the initial guess for the nonlinear solver to the initial condition.")
+            # Reset the initial guess after each timestep
+            ic = self.problem.parameters.initial_condition
+            state_new.assign(ic, annotate=False)
+        return False
+
+    def _update_time_level(self, setup, timestep, t, annotate, dt=None):
+        """ Updates the boundary conditions, the source term and the turbine
+        friction for the solve of the given timestep at time t. The timestep
+        dt defaults to the one of the setup. """
+        problem_params = self.problem.parameters
+        farm = problem_params.tidal_farm
+        theta, tf = setup["theta"], setup["tf"]
+        if dt is None:
+            dt = setup["dt"]
+
+        # Update bc's
+        t_theta = Constant(t - (1.0 - theta) * dt)
+        problem_params.bcs.update_time(t, only_type=["strong_dirichlet"])
+        problem_params.bcs.update_time(t_theta,
+                                       exclude_type=["strong_dirichlet"])
+
+        # Update source term
+        problem_params.f_u.t = Constant(t_theta)
+
+        # Set the control function for the upcoming timestep.
+        if farm:
+            if farm.turbine_specification.controls.dynamic_friction:
+                friction_functions = farm.friction_function
+                # The adjoint model refers to the fields of the annotated
+                # solves, hence they are kept by the sequence.
+                tf_new = friction_functions.get(timestep, annotate)
+                tf_old = friction_functions.get(timestep-1, annotate)
+                tf.assign(theta*tf_new+(1.-float(theta))*tf_old,
+                          annotate=annotate)
+            else:
+                tf.assign(farm.friction_function)
+
+    def _solve_adaptive_timestep(self, setup, timestep, t, controller,
+                                 annotate):
+        """ Solves the next timestep after time t with the timestep proposed
+        by the controller, and repeats the solve with smaller timesteps until
+        the estimated error is below `timestep_tolerance`. If the controller
+        replays frozen timesteps, the timestep is taken from them instead.
+        The solves are not annotated; the accepted timestep is solved again
+        with annotation, starting from its converged solution. Returns the new
+        time, the number of Newton iterations and whether the initial guess
+        was extrapolated. """
+        state, state_new = setup["state"], setup["state_new"]
+        dt = setup["dt"]
+        finish_time = float(setup["finish_time"])
+        tol = self.parameters.timestep_tolerance
+        replay = controller["replay"]
+        t_old = float(t)
+        iterations = 0
+        attempt = 0
+
+        while True:
+            if replay is not None:
+                if timestep > len(replay):
+                    raise RuntimeError("The frozen timesteps do not reach "
+                                       "the finish time. Call "
+                                       "reset_timesteps() after changing "
+                                       "the time parameters.")
+                dt_value = replay[timestep - 1]
+            else:
+                dt_value = self._adaptive_timestep(controller, t_old,
+                                                   finish_time, attempt)
+            attempt += 1
+            t = Constant(t_old + dt_value)
+            dt.assign(Constant(dt_value), annotate=False)
+            self._update_time_level(setup, timestep, t, annotate, dt=dt_value)
+
+            # Extrapolate the initial guess from the previous two timesteps
+            prediction = None
+            if controller["previous"] is not None:
+                dt_old, previous = controller["previous"]
+                prediction = state.vector().copy()
+                prediction *= 1. + dt_value/dt_old
+                prediction.axpy(-dt_value/dt_old, previous)
+                state_new.vector().set_local(prediction.array())
+                state_new.vector().apply("insert")
+            else:
+                state_new.assign(state, annotate=False)
+
+            log(INFO, "Solve shallow water equations at time %s with timestep "
+                "%s." % (float(t), dt_value))
+            try:
+                its, converged, residual0 = self._solve_unannotated(setup)
+            except RuntimeError:
+                if replay is not None or dt_value <= controller["min_dt"]:
+                    raise
+                log(INFO, "Newton solver failed, reducing the timestep.")
+                controller["dt"] = max(dt_value/2, controller["min_dt"])
+                continue
+            iterations += its
+
+            if prediction is None or replay is not None:
+                factor = 1.
+                break
+
+            # The extrapolation is first order accurate, hence the error
+            # scales with the square of the timestep.
+            diff = state_new.vector().copy()
+            diff.axpy(-1., prediction)
+            error = diff.norm("l2")/max(state_new.vector().norm("l2"),
+                                        DOLFIN_EPS)
+            factor = min(2., max(0.2, 0.9*(tol/max(error, DOLFIN_EPS))**0.5))
+            if error <= tol or dt_value <= controller["min_dt"]:
+                break
+
+            log(INFO, "Reject timestep %s with estimated error %e." %
+                (dt_value, error))
+            controller["dt"] = max(factor*dt_value, controller["min_dt"])
+
+        controller["accepted"].append(dt_value)
+        controller["previous"] = (dt_value, state.vector().copy())
+        controller["dt"] = min(max(factor*dt_value, controller["min_dt"]),
+                               controller["max_dt"])
+
+        if annotate:
+            # Like the turbine friction of dynamic friction controls, the
+            # timestep of each time level is assigned from its own function,
+            # so that the adjoint model uses the right timestep.
+            dt_level = Function(dt.function_space())
+            dt_level.assign(Constant(dt_value), annotate=False)
+            dt.assign(dt_level, annotate=annotate)
+            iterations += self._solve_converged(setup, annotate, residual0)
+
+        return t, iterations, prediction is not None
+
+    def _adaptive_timestep(self, controller, t, finish_time, attempt):
+        """ Returns the timestep after time t that the controller proposes,
+        which does not step beyond the finish time. A remainder below the
+        minimum timestep is merged into the first attempt of the timestep,
+        and split evenly between the last two timesteps in the repeated
+        attempts. """
+        remainder = finish_time - t
+        dt_value = min(controller["dt"], remainder)
+        if 0 < remainder - dt_value < controller["min_dt"]:
+            if attempt == 0:
+                dt_value = remainder
+            else:
+                dt_value = remainder/2
+        return dt_value
+
+    def _solve_with_continuation(self, setup, t, annotate):
+        """ Solves the steady-state equations at time t by continuation (see
+        the `continuation` parameter). The continuation parameter s steps from
+        0 (the starting equations) to 1 (the target equations), where the step
+        is adapted to the Newton iterations and halved if a solve fails. The
+        steps follow the path of the last continuation at time t as long as
+        the solves converge. The continuation solves are not annotated; the
+        target equations are solved again with annotation, starting from
+        their converged solution. Returns the number of Newton iterations and
+        the residual norm of the initial guess of the last solve of the
+        target equations. """
+        solver_params = self.parameters
+        state_new = setup["state_new"]
+        nonlinear_solver = setup["nonlinear_solver"]
+        factor = solver_params.continuation_viscosity_factor
+        target_iterations = solver_params.continuation_target_iterations
+
+        def set_parameter(s):
+            if solver_params.continuation == "viscosity":
+                setup["viscosity_factor"].assign(factor**(1. - s))
+            else:
+                setup["advection_factor"].assign(s)
+
+        def try_solve():
+            """ Returns the Newton iterations and the residual norm of the
+            initial guess, or None if the solve failed. """
+            try:
+                its, converged, residual0 = self._solve_unannotated(setup)
+            except RuntimeError:
+                return None
+            return (its, residual0) if converged else None
+
+        log(INFO, "Solve shallow water equations with %s continuation." %
+            solver_params.continuation)
+        set_parameter(0.)
+        result = try_solve()
+        if result is None:
+            set_parameter(1.)
+            raise RuntimeError("The Newton solver did not converge for the "
+                               "starting equations of the continuation.")
+        iterations, residual0 = result
+
+        path = list(self._continuation_paths.get(t, []))
+        steps = []
+        s, ds = 0., 0.25
+        converged_state = state_new.vector().array()
+        while s < 1.:
+            s_new = path.pop(0) if path else min(1., s + ds)
+            set_parameter(s_new)
+            result = try_solve()
+
+            if result is None:
+                # Restart from the last converged solution with a smaller step
+                state_new.vector().set_local(converged_state)
+                state_new.vector().apply("insert")
+                path = []
+                ds = (s_new - s)/2
+                if ds < 1e-3:
+                    set_parameter(1.)
+                    raise RuntimeError("The continuation did not converge.")
+                log(INFO, "Newton solver failed, reducing the continuation "
+                    "step to %f." % ds)
+                continue
+
+            its, residual0 = result
+            iterations += its
+            ratio = float(target_iterations)/max(its, 1)
+            ds = (s_new - s)*min(2., max(0.5, ratio))
+            s = s_new
+            steps.append(s)
+            converged_state = state_new.vector().array()
+            log(INFO, "Continuation step s=%f converged in %i Newton "
+                "iterations." % (s, its))
+
+        self._continuation_paths[t] = steps
+        log(INFO, "Continuation finished after %i steps." % len(steps))
+
+        if annotate:
+            iterations += self._solve_converged(setup, annotate, residual0)
+
+        return iterations, residual0
+
+    def _solve_unannotated(self, setup):
+        """ Solves the equations without annotation, e.g. before they are
+        solved again with annotation by :meth:`_solve_converged`. Returns the
+        number of Newton iterations, whether the solve converged and the
+        residual norm of the initial guess. """
+        nonlinear_solver = setup["nonlinear_solver"]
+        if isinstance(nonlinear_solver, ModifiedNewtonSolver):
+            its, converged = nonlinear_solver.solve(annotate=False)
+            return its, converged, nonlinear_solver.residual0
+
+        residual0 = setup["converged_solver"].residual()
+        its, converged = nonlinear_solver.solve(annotate=False)
+        return its, converged, residual0
+
+    def _solve_converged(self, setup, annotate, residual0):
+        """ Solves the equations again, starting from their converged
+        solution, e.g. to annotate them for the adjoint model. The relative
+        tolerance refers to residual0, the residual norm of the initial guess
+        of the solve that computed the solution (see
+        :meth:`_solve_unannotated`), so that the solve checks the residual
+        and does not assemble or factorise the Jacobian unless the solution
+        needs to be improved. Returns the number of Newton iterations. """
+        its, converged = setup["converged_solver"].solve(annotate=annotate,
+                                                         residual0=residual0)
+        return its
+
+    def _solve_levels_concurrently(self, setup, times, alpha):
+        """ Solves the independent time levels of a multi steady-state problem
+        in `ensemble_workers` worker processes, each with its own solver
+        from `ensemble_factory`. The initial guesses are set in this process,
+        from the cached states or the initial condition. Returns the
+        dictionary of the solution arrays and the residual norms of the
+        initial guesses (see :meth:`_solve_unannotated`) for each
+        timestep. """
+        solver_params = self.parameters
+        if solver_params.ensemble_factory is None:
+            raise ValueError("Solving the time levels concurrently requires "
+                             "an ensemble_factory.")
+
+        state_new = setup["state_new"]
+        farm = self.problem.parameters.tidal_farm
+        farm_parameters = {}
+        if farm is not None:
+            farm_parameters = dict(farm._parameters)
+
+        levels = []
+        for timestep, t in enumerate(times, 1):
+            cached = (solver_params.cache_forward_state and
+                      float(t) in self.state_cache)
+            predicted = self._predict(float(t), state_new, alpha, [], False)
+            continuation = (solver_params.continuation is not None and
+                            not (cached or predicted))
+            levels.append((farm_parameters, timestep, float(t),
+                           state_new.vector().array(), continuation))
+
+        log(INFO, "Solve %i time levels with %i processes." %
+            (len(times), solver_params.ensemble_workers))
+        states = spawn_map(solver_params.ensemble_factory,
+                           _solve_ensemble_level, levels,
+                           workers=solver_params.ensemble_workers)
+        return dict(zip(range(1, len(times) + 1), states))
+
+    def _report_newton_iterations(self, saved):
+        """ Logs the number of Newton iterations of the forward solve, for the
+        timesteps with and without predicted initial guesses, and the number
+        of iterations that the predictions saved. """
+        if len(self.newton_iterations) == 0:
+            return
+
+        iterations = numpy.array(self.newton_iterations)
+        log(INFO, "Newton iterations of the forward solve: %i." %
+            iterations[:, 0].sum())
+        for predicted, name in [(True, "with"), (False, "without")]:
+            its = iterations[iterations[:, 1] == predicted, 0]
+            if len(its) > 0:
+                log(INFO, "Average Newton iterations %s predicted initial "
+                    "guess: %.2f (%i timesteps)." % (name, its.mean(), len(its)))
+
+        if saved is not None:
+            log(INFO, "Newton iterations saved by the predicted initial "
+                "guesses: %i." % saved)
+
+    def _setup_key(self):
+        """ Returns the parameters that the setup of the equations depends on.
+        Floating point parameters are compiled into the forms and hence
+        compared by value. The time parameters are copied by the setup, so
+        they are compared by value as well. All other parameters are compared
+        by identity. """
+        problem_params = self.problem.parameters
+        solver_params = self.parameters
+
+        key = [id(self.problem), solver_params.quadrature_degree,
+               tuple(solver_params.cpp_flags), solver_params.modified_newton,
+               solver_params.fieldsplit, solver_params.adaptive_timestepping,
+               solver_params.continuation]
+        for name in ["g", "depth", "viscosity", "friction", "theta", "dt",
+                     "start_time", "finish_time", "include_advection",
+                     "include_viscosity", "linear_divergence",
+                     "initial_condition", "f_u", "bcs", "tidal_farm",
+                     "domain"]:
+            value = getattr(problem_params, name, None)
+            if isinstance(value, (bool, int, long, float)):
+                key.append(value)
+            elif (name in ["theta", "dt", "start_time", "finish_time"] and
+                  value is not None):
+                key.append(float(value))
+            else:
+                key.append(id(value))
+        return tuple(key)
+
+    def _setup(self):
+        """ Sets up the equations, i.e. the functions, forms, boundary
+        conditions and the nonlinear solver. The returned dictionary is reused
+        by all calls of :meth:`solve` until the parameters it depends on (see
+        :meth:`_setup_key`) change. """
 
         ############################### Setting up the equations ###########################
 
@@ -234,50 +814,46 @@ class CoupledSWSolver(Solver):
         solver_params = self.parameters
         farm = problem_params.tidal_farm
 
-        # Performance settings
-        parameters['form_compiler']['quadrature_degree'] = \
-            solver_params.quadrature_degree
-        parameters['form_compiler']['cpp_optimize_flags'] = \
-            " ".join(solver_params.cpp_flags)
-        parameters['form_compiler']['cpp_optimize'] = True
-        parameters['form_compiler']['optimize'] = True
-
         # Get domain measures
         ds = problem_params.domain.ds
 
         # Initialise solver settings
         if type(self.problem) == SWProblem:
-            log(INFO, "Solve a transient shallow water problem")
-
             theta = Constant(problem_params.theta)
-            dt = Constant(problem_params.dt)
+            if solver_params.adaptive_timestepping:
+                if farm and farm.turbine_specification.controls.dynamic_friction:
+                    raise ValueError("Adaptive time stepping is not supported "
+                                     "with dynamic friction controls.")
+                # The timestep is stored in a function, so that its value at
+                # each timestep is annotated for the adjoint model.
+                R = FunctionSpace(problem_params.domain.mesh, "R", 0)
+                dt = Function(R, name="timestep")
+                dt.assign(Constant(problem_params.dt), annotate=False)
+            else:
+                dt = Constant(problem_params.dt)
             finish_time = Constant(problem_params.finish_time)
 
-            t = Constant(problem_params.start_time)
+            start_time = problem_params.start_time
 
             include_time_term = True
 
         elif type(self.problem) == MultiSteadySWProblem:
-            log(INFO, "Solve a multi steady-state shallow water problem")
-
             theta = Constant(1)
             dt = Constant(problem_params.dt)
             finish_time = Constant(problem_params.finish_time)
 
             # The multi steady-state case solves the steady-state equation also
             # for the start time
-            t = Constant(problem_params.start_time - dt)
+            start_time = problem_params.start_time - dt
 
             include_time_term = False
 
         elif type(self.problem) == SteadySWProblem:
-            log(INFO, "Solve a steady-state shallow water problem")
-
             theta = Constant(1.)
             dt = Constant(1.)
             finish_time = Constant(0.5)
 
-            t = Constant(0.)
+            start_time = 0.
 
             include_time_term = False
 
@@ -292,23 +868,34 @@ class CoupledSWSolver(Solver):
         viscosity = problem_params.viscosity
         bcs = problem_params.bcs
         linear_divergence = problem_params.linear_divergence
-        cache_forward_state = solver_params.cache_forward_state
         f_u = problem_params.f_u
 
         u_dg = "Discontinuous" in str(self.function_space.split()[0])
 
+        # The continuation parameters (see :meth:`_solve_with_continuation`)
+        viscosity_factor = Constant(1.)
+        advection_factor = Constant(1.)
+        if solver_params.continuation not in (None, "viscosity", "advection"):
+            raise ValueError("Unknown continuation '%s'." %
+                             solver_params.continuation)
+        if solver_params.continuation == "viscosity" and not include_viscosity:
+            raise ValueError("Viscosity continuation requires the viscosity "
+                             "term.")
+        if solver_params.continuation == "advection" and not include_advection:
+            raise ValueError("Advection continuation requires the advection "
+                             "term.")
+
         # Define test functions
         v, q = TestFunctions(self.function_space)
 
         # Define functions
         state = Function(self.function_space, name="Current_state")
-        self.state = state
         state_new = Function(self.function_space, name="New_state")
 
         # Load initial condition (or initial guess for stady problems)
         # Projection is necessary to obtain 2nd order convergence
-        ic = project(problem_params.initial_condition, self.function_space)
-        state.assign(ic, annotate=False)
+        ic = project(problem_params.initial_condition, self.function_space,
+                     annotate=False)
 
         # Split mixed functions
         u, h = split(state_new)
@@ -321,9 +908,6 @@ class CoupledSWSolver(Solver):
         else:
             H = h + depth
 
-        # Create initial conditions and interpolate
-        state_new.assign(state, annotate=annotate)
-
         # u_(n+theta) and h_(n+theta)
         u_mid = (1.0 - theta) * u0 + theta * u
         h_mid = (1.0 - theta) * h0 + theta * h
@@ -384,14 +968,13 @@ class CoupledSWSolver(Solver):
         friction = problem_params.friction
         if not farm:
             tf = Constant(0)
-        elif type(farm.friction_function) == list:
-            tf = farm.friction_function[0].copy(deepcopy=True,
-                    name="turbine_friction", annotate=annotate)
-            tf.assign(theta*farm.friction_function[1]+(1.-float(theta))*\
-                      farm.friction_function[0], annotate=annotate)
+        elif farm.turbine_specification.controls.dynamic_friction:
+            # The values are set in solve().
+            tf = Function(farm.friction_function[0].function_space(),
+                          name="turbine_friction")
         else:
-            tf = farm.friction_function.copy(deepcopy=True,
-                                             name="turbine_friction", annotate=annotate)
+            tf = Function(farm.friction_function.function_space(),
+                          name="turbine_friction")
         # FIXME: FEniCS fails on assembling the below form for u_mid = 0, even
         # though it is differentiable. Even this potential fix does not help:
         #norm_u_mid = conditional(inner(u_mid, u_mid)**0.5 < DOLFIN_EPS, Constant(0),
@@ -442,10 +1025,14 @@ class CoupledSWSolver(Solver):
 
         # Add the advection term
         if include_advection:
+            if solver_params.continuation == "advection":
+                Ad_mid = advection_factor * Ad_mid
             G_mid += Ad_mid
 
         # Add the viscosity term
         if include_viscosity:
+            if solver_params.continuation == "viscosity":
+                D_mid = viscosity_factor * D_mid
             G_mid += D_mid
 
         # Add the source term
@@ -459,6 +1046,102 @@ class CoupledSWSolver(Solver):
         # Generate the scheme specific strong boundary conditions
         strong_bcs = self._generate_strong_bcs()
 
+        # The nonlinear solver for each timestep
+        if solver_params.modified_newton or solver_params.fieldsplit:
+            nonlinear_solver = ModifiedNewtonSolver(
+                F, state_new, strong_bcs, derivative(F, state_new),
+                solver_params)
+            converged_solver = nonlinear_solver
+        else:
+            nonlinear_problem = NonlinearVariationalProblem(
+                F, state_new, bcs=strong_bcs, J=derivative(F, state_new))
+            nonlinear_solver = NonlinearVariationalSolver(nonlinear_problem)
+            # The solves that start from a converged solution (see
+            # _solve_converged) check the residual before assembling and
+            # factorising the Jacobian.
+            converged_solver = ModifiedNewtonSolver(
+                F, state_new, strong_bcs, derivative(F, state_new),
+                solver_params)
+
+        return {"theta": theta, "dt": dt, "finish_time": finish_time,
+                "start_time": start_time, "include_time_term": include_time_term,
+                "state": state, "state_new": state_new, "ic": ic, "tf": tf,
+                "u0": u0, "h0": h0, "nonlinear_solver": nonlinear_solver,
+                "converged_solver": converged_solver,
+                "viscosity_factor": viscosity_factor,
+                "advection_factor": advection_factor}
+
+    def _get_setup(self):
+        """ Returns the setup of the equations, which is created unless the
+        setup of the last solve can be reused. """
+        setup_key = self._setup_key()
+        if self._setup_cache is None or self._setup_cache_key != setup_key:
+            timer = Timer("Forward model setup")
+            self._setup_cache = self._setup()
+            self._setup_cache_key = setup_key
+            # The frozen timesteps belong to the old time parameters.
+            self.adaptive_timesteps = None
+            self._setup_time = timer.stop()
+            log(INFO, "Setup of the forward model: %f s." % self._setup_time)
+        else:
+            log(INFO, "Reuse the setup of the forward model (saves %f s)." %
+                self._setup_time)
+        return self._setup_cache
+
+    def solve(self, annotate=True):
+        ''' Returns an iterator for solving the shallow water equations. '''
+
+        # Get parameters
+        problem_params = self.problem.parameters
+        solver_params = self.parameters
+        farm = problem_params.tidal_farm
+        cache_forward_state = solver_params.cache_forward_state
+
+        # Performance settings
+        parameters['form_compiler']['quadrature_degree'] = \
+            solver_params.quadrature_degree
+        parameters['form_compiler']['cpp_optimize_flags'] = \
+            " ".join(solver_params.cpp_flags)
+        parameters['form_compiler']['cpp_optimize'] = True
+        parameters['form_compiler']['optimize'] = True
+
+        setup = self._get_setup()
+
+        theta, dt = setup["theta"], setup["dt"]
+        finish_time = setup["finish_time"]
+        include_time_term = setup["include_time_term"]
+        state, state_new = setup["state"], setup["state_new"]
+        u0, h0, tf = setup["u0"], setup["h0"], setup["tf"]
+        nonlinear_solver = setup["nonlinear_solver"]
+        self.state = state
+
+        if type(self.problem) == SWProblem:
+            log(INFO, "Solve a transient shallow water problem")
+        elif type(self.problem) == MultiSteadySWProblem:
+            log(INFO, "Solve a multi steady-state shallow water problem")
+        else:
+            log(INFO, "Solve a steady-state shallow water problem")
+
+        t = Constant(setup["start_time"])
+
+        # Load initial condition (or initial guess for stady problems)
+        state.assign(setup["ic"], annotate=False)
+
+        # Create initial conditions and interpolate
+        state_new.assign(state, annotate=annotate)
+
+        # Set the turbine friction
+        if farm and farm.turbine_specification.controls.dynamic_friction:
+            # The turbine field of each timestep is assembled from the turbine
+            # shapes and frictions when it is first accessed.
+            friction_functions = farm.friction_function
+            tf.assign(friction_functions.get(0, annotate), annotate=annotate)
+            tf.assign(theta*friction_functions.get(1, annotate)+
+                      (1.-float(theta))*friction_functions.get(0, annotate),
+                      annotate=annotate)
+        elif farm:
+            tf.assign(farm.friction_function, annotate=annotate)
+
         ############################### Perform the simulation ###########################
 
         if solver_params.dump_period > 0:
@@ -476,88 +1159,203 @@ class CoupledSWSolver(Solver):
         solver_params.callback(result)
         yield(result)
 
-        log(INFO, "Start of time loop")
-        adjointer.time.start(t)
-        timestep = 0
-        while not self._finished(t, finish_time):
-            # Update timestep
-            timestep += 1
-            t = Constant(t + dt)
-
-            # Update bc's
-            t_theta = Constant(t - (1.0 - theta) * dt)
-            bcs.update_time(t, only_type=["strong_dirichlet"])
-            bcs.update_time(t_theta, exclude_type=["strong_dirichlet"])
-
-            # Update source term
-            f_u.t = Constant(t_theta)
-
-            # Set the control function for the upcoming timestep.
-            if farm:
-                if type(farm.friction_function) == list:
-                    tf.assign(theta*farm.friction_function[timestep]+(1.\
-                              -float(theta))*farm.friction_function[timestep-1],
-                              annotate=annotate)
+        # The initial guesses may be extrapolated from the last two forward
+        # solves (with the control arrays m_k and m_k1) or from the solutions
+        # of the previous timesteps.
+        m = None
+        if farm and solver_params.secant_predictor:
+            m = numpy.array(farm.control_array, dtype=float)
+        alpha = self._secant_weight(m)
+
+        previous_solutions = []
+        if include_time_term:
+            previous_solutions.append(state.vector().array())
+
+        self.newton_iterations = []
+        self.jacobian_factorisations = []
+        # The iterations saved by the predictions, compared to the last
+        # unpredicted solves at the same times.
+        saved = None
+
+        # With the secant predictor, the states of this solve are stored in a
+        # fresh cache, which becomes the latest one once the solve finishes.
+        new_state_cache = self.state_cache
+        if cache_forward_state and solver_params.secant_predictor:
+            new_state_cache = self._new_state_cache()
+        finished = False
+
+        # The levels of multi steady-state problems are independent, and
+        # may be solved concurrently beforehand.
+        ensemble_states = {}
+        if (type(self.problem) == MultiSteadySWProblem and
+            solver_params.ensemble_workers > 1 and
+            MPI.size(mpi_comm_world()) == 1):
+            times = []
+            t_level = t
+            while not self._finished(t_level, finish_time):
+                t_level = Constant(t_level + dt)
+                times.append(t_level)
+            ensemble_states = self._solve_levels_concurrently(setup, times,
+                                                              alpha)
+
+        # The state of the timestep controller
+        controller = None
+        if solver_params.adaptive_timestepping and include_time_term:
+            dt_value = float(problem_params.dt)
+            replay = None
+            if solver_params.freeze_timesteps:
+                replay = self.adaptive_timesteps
+            controller = {"dt": dt_value, "previous": None,
+                          "min_dt": solver_params.min_timestep or dt_value/100,
+                          "max_dt": solver_params.max_timestep or 10*dt_value,
+                          "replay": replay, "accepted": []}
+
+        try:
+            log(INFO, "Start of time loop")
+            adjointer.time.start(t)
+            timestep = 0
+            while not self._finished(t, finish_time):
+                # Update timestep
+                timestep += 1
+                if isinstance(nonlinear_solver, ModifiedNewtonSolver):
+                    factorisations = nonlinear_solver.factorisations
                 else:
-                    tf.assign(farm.friction_function)
-
-            # Set the initial guess for the solve
-            if cache_forward_state and self.state_cache.has_key(float(t)):
-                log(INFO, "Read initial guess from cache for t=%f." % t)
-                # Load initial guess for solver from cache
-                state_new.assign(self.state_cache[float(t)], annotate=False)
-
-            elif not include_time_term:
-                log(INFO, "Set the initial guess for the nonlinear solver to the initial condition.")
-                # Reset the initial guess after each timestep
-                ic = problem_params.initial_condition
-                state_new.assign(ic, annotate=False)
-
-            # Solve non-linear system with a Newton solver
-            if self.problem._is_transient:
-                log(INFO, "Solve shallow water equations at time %s" % float(t))
-            else:
-                log(INFO, "Solve shallow water equations.")
-
-            solve(F == 0, state_new, bcs=strong_bcs,
-                  solver_parameters=solver_params.dolfin_solver,
-                  annotate=annotate,
-                  J=derivative(F, state_new))
-
-            # After the timestep solve, update state
-            state.assign(state_new)
-
-            if cache_forward_state:
-                # Save state for initial guess cache
-                log(INFO, "Cache solution t=%f as next initial guess." % t)
-                if not self.state_cache.has_key(float(t)):
-                    self.state_cache[float(t)] = Function(self.function_space)
-                self.state_cache[float(t)].assign(state_new, annotate=False)
-
-            if (solver_params.dump_period > 0 and
-                timestep % solver_params.dump_period == 0):
-                log(INFO, "Write state to disk...")
-                writer.write(state)
+                    nonlinear_solver.parameters.update(solver_params.dolfin_solver)
 
-            # Return the results
-            result = {"time": t,
-                      "u": u0,
-                      "eta": h0,
-                      "tf": tf,
-                      "state": state,
-                      "is_final": self._finished(t, finish_time)}
-            solver_params.callback(result)
-            yield(result)
+                if controller is not None:
+                    t, iterations, predicted = self._solve_adaptive_timestep(
+                        setup, timestep, t, controller, annotate)
+                else:
+                    t = Constant(t + dt)
+
+                    self._update_time_level(setup, timestep, t, annotate)
+
+                    # Set the initial guess for the solve
+                    cached = cache_forward_state and float(t) in self.state_cache
+                    if timestep in ensemble_states:
+                        log(INFO, "Use the concurrently computed state as initial "
+                                  "guess for t=%f." % t)
+                        state_new.vector().set_local(
+                            ensemble_states[timestep][0])
+                        state_new.vector().apply("insert")
+                        predicted = True
+                    else:
+                        predicted = self._predict(float(t), state_new, alpha,
+                                                  previous_solutions,
+                                                  include_time_term)
+
+                    # Solve non-linear system with a Newton solver
+                    if self.problem._is_transient:
+                        log(INFO, "Solve shallow water equations at time %s" %
+                            float(t))
+                    else:
+                        log(INFO, "Solve shallow water equations.")
+
+                    if timestep in ensemble_states:
+                        iterations = self._solve_converged(
+                            setup, annotate, ensemble_states[timestep][1])
+                    elif (solver_params.continuation is not None and
+                          not include_time_term and not (cached or predicted)):
+                        iterations, residual0 = self._solve_with_continuation(
+                            setup, float(t), annotate)
+                    else:
+                        iterations, converged = nonlinear_solver.solve(
+                            annotate=annotate)
+                self.newton_iterations.append((iterations, predicted))
+                if isinstance(nonlinear_solver, ModifiedNewtonSolver):
+                    self.jacobian_factorisations.append(
+                        nonlinear_solver.factorisations - factorisations)
+                if not predicted:
+                    self._unpredicted_iterations[float(t)] = iterations
+                elif float(t) in self._unpredicted_iterations:
+                    saved = ((saved or 0) +
+                             self._unpredicted_iterations[float(t)] - iterations)
+
+                # After the timestep solve, update state
+                state.assign(state_new)
+
+                if solver_params.timestep_predictor is not None:
+                    previous_solutions.append(state_new.vector().array())
+                    del previous_solutions[:-3]
+
+                if cache_forward_state and controller is None:
+                    # Save state for initial guess cache. The adaptive
+                    # timesteps differ between forward solves, so their
+                    # states are not cached.
+                    log(INFO, "Cache solution t=%f as next initial guess." % t)
+                    new_state_cache.store(float(t), state_new)
+
+                if (solver_params.dump_period > 0 and
+                    timestep % solver_params.dump_period == 0):
+                    log(INFO, "Write state to disk...")
+                    writer.write(state)
+
+                # Return the results
+                result = {"time": t,
+                          "u": u0,
+                          "eta": h0,
+                          "tf": tf,
+                          "state": state,
+                          "is_final": self._finished(t, finish_time)}
+                solver_params.callback(result)
+                yield(result)
+
+                # Increase the adjoint timestep
+                adj_inc_timestep(time=float(t), finished=self._finished(t,
+                    finish_time))
+
+
+            # If we're outputting the individual turbine power
+            if (self.parameters.print_individual_turbine_power
+                or ((solver_params.dump_period > 0)
+                and self.parameters.output_turbine_power)):
+                self.parameters.output_writer.individual_turbine_power(self)
+
+            finished = True
+        finally:
+            if new_state_cache is not self.state_cache:
+                if finished:
+                    # The states of this forward solve become the latest
+                    # states.
+                    self.previous_state_cache.clear()
+                    self.previous_state_cache = self.state_cache
+                    self.state_cache = new_state_cache
+                    self._control_points = [m] + self._control_points[:1]
+                else:
+                    # Keep the caches of the last complete solves.
+                    new_state_cache.clear()
 
-            # Increase the adjoint timestep
-            adj_inc_timestep(time=float(t), finished=self._finished(t,
-                finish_time))
+        if (controller is not None and solver_params.freeze_timesteps and
+            controller["replay"] is None):
+            log(INFO, "Freeze the %i adaptive timesteps for the following "
+                "solves." % len(controller["accepted"]))
+            self.adaptive_timesteps = controller["accepted"]
 
+        self._report_newton_iterations(saved)
+        log(INFO, "End of time loop.")
 
-        # If we're outputting the individual turbine power
-        if (self.parameters.print_individual_turbine_power
-            or ((solver_params.dump_period > 0)
-            and self.parameters.output_turbine_power)):
-            self.parameters.output_writer.individual_turbine_power(self)
 
-        log(INFO, "End of time loop.")
+def _solve_ensemble_level(solver, level):
+    """ Solves a time level of a multi steady-state problem with the solver of
+    a worker process (see :meth:`CoupledSWSolver._solve_levels_concurrently`).
+    Returns the solution array and the residual norm of the initial guess. """
+    farm_parameters, timestep, t, guess, continuation = level
+    farm = solver.problem.parameters.tidal_farm
+    for name, value in farm_parameters.iteritems():
+        farm._parameters[name] = value
+
+    setup = solver._get_setup()
+    solver._update_time_level(setup, timestep, Constant(t), annotate=False)
+    state_new = setup["state_new"]
+    state_new.vector().set_local(guess)
+    state_new.vector().apply("insert")
+
+    nonlinear_solver = setup["nonlinear_solver"]
+    if not isinstance(nonlinear_solver, ModifiedNewtonSolver):
+        nonlinear_solver.parameters.update(solver.parameters.dolfin_solver)
+    if continuation:
+        its, residual0 = solver._solve_with_continuation(setup, t,
+                                                         annotate=False)
+    else:
+        its, converged, residual0 = solver._solve_unannotated(setup)
+    return state_new.vector().array(), residual0
@@ -0,0 +1,271 @@
+import dolfin
+from dolfin import *
+from dolfin_adjoint import adjglobals, adjlinalg, solving, utils
+import libadjoint
+
+
+def fieldsplit_petsc_options():
+    """ Returns the PETSc options of the field-split preconditioned Krylov
+    solver for the coupled velocity/free-surface systems: GMRES, preconditioned
+    with a Schur complement factorisation. The velocity block is approximated
+    with block Jacobi/ILU and the Schur complement (constructed from the
+    diagonal of the velocity block) with algebraic multigrid. """
+    if has_krylov_solver_preconditioner("hypre_amg"):
+        amg = {"fieldsplit_eta_pc_type": "hypre",
+               "fieldsplit_eta_pc_hypre_type": "boomeramg"}
+    else:
+        amg = {"fieldsplit_eta_pc_type": "gamg"}
+
+    options = {"ksp_type": "gmres",
+               "ksp_gmres_restart": 100,
+               "pc_type": "fieldsplit",
+               "pc_fieldsplit_type": "schur",
+               "pc_fieldsplit_schur_fact_type": "full",
+               "pc_fieldsplit_schur_precondition": "selfp",
+               "fieldsplit_u_ksp_type": "preonly",
+               "fieldsplit_u_pc_type": "bjacobi",
+               "fieldsplit_eta_ksp_type": "preonly"}
+    options.update(amg)
+    return options
+
+
+class ModifiedNewtonSolver(object):
+    r""" Solves the nonlinear problem :math:`F(u) = 0` with a modified Newton
+    method, which reuses the Jacobian and its LU factorisation for several
+    iterations.
+
+    The Jacobian is reassembled and refactorised if
+
+    - it has been used for `jacobian_refresh_period` iterations, or
+    - the residual norm was reduced by less than the factor
+      `jacobian_refresh_rate` in the last iteration.
+
+    If an iteration with an old Jacobian increases the residual, the iteration
+    is undone and repeated with a fresh Jacobian. The factorisation is kept
+    between solves, so that consecutive timesteps and forward solves with
+    similar Jacobians share it.
+
+    The solve converges once the residual norm is below the absolute
+    tolerance, or below the relative tolerance times the reference residual
+    norm (see :meth:`solve`). With the "incremental" convergence criterion, it
+    also converges once the norm of a Newton increment is below the absolute
+    tolerance, or below the relative tolerance times the norm of the first
+    increment. A solve that starts with a converged initial guess and the
+    reference residual of the solve that computed it does not factorise the
+    Jacobian at all.
+
+    If `solver_params.modified_newton` is False, the Jacobian is refreshed in
+    every iteration. If `solver_params.fieldsplit` is True, the linear systems
+    are solved with a Krylov solver and the field-split preconditioner of
+    :func:`fieldsplit_petsc_options` instead, and the preconditioner takes the
+    place of the factorisation.
+
+    For the adjoint model, the solve is annotated as a nonlinear solve with the
+    exact Jacobian.
+
+    :param F: The residual form.
+    :param u: The solution function, which contains the initial guess.
+    :param bcs: The list of strong Dirichlet boundary conditions.
+    :param J: The Jacobian form.
+    :param solver_params: The :class:`CoupledSWSolverParameters`. The linear
+        solver, the tolerances and the maximum number of iterations are read
+        from the `newton_solver` entry of `dolfin_solver`. With the field-split
+        preconditioner, the linear solver entry is not used, and the Krylov
+        solver tolerances are read from its `krylov_solver` entry. The
+        `convergence_criterion` entry is either "residual" (the default) or
+        "incremental".
+    """
+
+    def __init__(self, F, u, bcs, J, solver_params):
+        self.F = F
+        self.u = u
+        self.bcs = bcs
+        self.J = J
+        self.solver_params = solver_params
+
+        # The Newton increments satisfy homogeneous boundary conditions.
+        self._bcs_hom = []
+        for bc in bcs:
+            bc_hom = DirichletBC(bc)
+            bc_hom.homogenize()
+            self._bcs_hom.append(bc_hom)
+
+        self._A = None
+        self._linear_solver = None
+        self._b = Vector()
+        self._du = Function(u.function_space())
+
+        #: The number of Jacobian factorisations (or preconditioner setups) of
+        #: all solves.
+        self.factorisations = 0
+        #: The residual norm of the initial guess of the last solve.
+        self.residual0 = None
+
+    def _newton_parameters(self):
+        params = {"linear_solver": "default",
+                  "maximum_iterations": 50,
+                  "absolute_tolerance": 1e-10,
+                  "relative_tolerance": 1e-9,
+                  "convergence_criterion": "residual"}
+        params.update(self.solver_params.dolfin_solver.get("newton_solver", {}))
+        return params
+
+    def residual(self):
+        """ Returns the residual norm of the current solution, after applying
+        the boundary conditions to it. """
+        for bc in self.bcs:
+            bc.apply(self.u.vector())
+        return self._residual()
+
+    def _residual(self):
+        assemble(self.F, tensor=self._b)
+        for bc in self._bcs_hom:
+            bc.apply(self._b)
+        return self._b.norm("l2")
+
+    def _refresh_jacobian(self, linear_solver, krylov_params):
+        if self._A is None:
+            self._A = Matrix()
+        assemble(self.J, tensor=self._A)
+        for bc in self._bcs_hom:
+            bc.apply(self._A)
+
+        if self.solver_params.fieldsplit:
+            self._linear_solver = self._fieldsplit_solver(krylov_params)
+        else:
+            self._linear_solver = LUSolver(self._A, linear_solver)
+            self._linear_solver.parameters["reuse_factorization"] = True
+        self.factorisations += 1
+
+    def _fieldsplit_solver(self, krylov_params):
+        prefix = "otf_fieldsplit_"
+        for key, value in fieldsplit_petsc_options().iteritems():
+            PETScOptions.set(prefix + key, value)
+
+        solver = PETScKrylovSolver()
+        solver.set_options_prefix(prefix)
+        solver.set_operator(self._A)
+        solver.parameters.update(krylov_params)
+        solver.set_from_options()
+
+        W = self.u.function_space()
+        fields = [W.sub(0).dofmap().dofs(), W.sub(1).dofmap().dofs()]
+        PETScPreconditioner.set_fieldsplit(solver, fields, ["u", "eta"])
+        return solver
+
+    def solve(self, annotate=None, residual0=None):
+        """ Solves the nonlinear problem.
+
+        :param residual0: The reference residual norm of the relative
+            tolerance. Default: the residual norm of the initial guess. A
+            solve that starts from the solution of another solve (e.g. to
+            annotate it) should pass the residual norm of the initial guess
+            of that solve.
+        :returns: A tuple of the number of iterations and whether the solve
+            converged, as :meth:`NonlinearVariationalSolver.solve`.
+        """
+        to_annotate = utils.to_annotate(annotate)
+        if to_annotate:
+            solving.annotate(self.F == 0, self.u, self.bcs, J=self.J,
+                             solver_parameters=self.solver_params.dolfin_solver)
+
+        iterations, converged = self._solve(residual0)
+
+        if to_annotate and dolfin.parameters["adjoint"]["record_all"]:
+            adjglobals.adjointer.record_variable(
+                adjglobals.adj_variables[self.u],
+                libadjoint.MemoryStorage(adjlinalg.Vector(self.u)))
+
+        return iterations, converged
+
+    def _solve(self, residual0):
+        params = self._newton_parameters()
+        if params["convergence_criterion"] not in ["residual", "incremental"]:
+            raise ValueError("Unknown convergence criterion '%s'." %
+                             params["convergence_criterion"])
+        incremental = params["convergence_criterion"] == "incremental"
+        if self.solver_params.modified_newton:
+            period = self.solver_params.jacobian_refresh_period
+        else:
+            # Newton's method with a fresh Jacobian in every iteration
+            period = 1
+        rate = self.solver_params.jacobian_refresh_rate
+        x = self.u.vector()
+        dx_ = self._du.vector()
+
+        for bc in self.bcs:
+            bc.apply(x)
+
+        residual = self._residual()
+        self.residual0 = residual
+        if residual0 is None:
+            residual0 = residual
+        increment0 = None
+        # The number of iterations with the current Jacobian. A Jacobian from
+        # a previous solve is reused until the checks below request a fresh
+        # one.
+        age = 0
+        refresh = self._linear_solver is None or period == 1
+        iterations = 0
+        factorisations = self.factorisations
+
+        while True:
+            log(INFO, "Modified Newton iteration %i: residual %e." %
+                (iterations, residual))
+            if (residual < params["absolute_tolerance"] or
+                residual < params["relative_tolerance"]*residual0):
+                converged = True
+                break
+            if iterations >= params["maximum_iterations"]:
+                converged = False
+                break
+
+            fresh = refresh or age >= period
+            if fresh:
+                self._refresh_jacobian(params["linear_solver"],
+                                       params.get("krylov_solver", {}))
+                age = 0
+                refresh = False
+
+            self._linear_solver.solve(dx_, self._b)
+            increment = dx_.norm("l2")
+            x.axpy(-1., dx_)
+            iterations += 1
+            age += 1
+
+            new_residual = self._residual()
+            if new_residual >= residual and not fresh:
+                # The old Jacobian stagnates, undo the iteration and retry
+                # with a fresh one.
+                log(INFO, "Residual increased, refreshing the Jacobian.")
+                x.axpy(1., dx_)
+                self._residual()
+                refresh = True
+                continue
+
+            if new_residual > rate*residual:
+                refresh = True
+            residual = new_residual
+
+            if incremental:
+                if increment0 is None:
+                    increment0 = increment
+                if (increment < params["absolute_tolerance"] or
+                    increment < params["relative_tolerance"]*increment0):
+                    log(INFO, "Modified Newton iteration %i: increment %e." %
+                        (iterations, increment))
+                    converged = True
+                    break
+
+        log(INFO, "Modified Newton solver finished after %i iterations with "
+                  "%i Jacobian factorisations." %
+            (iterations, self.factorisations - factorisations))
+
+        if not converged:
+            error_on_nonconvergence = self.solver_params.dolfin_solver.get(
+                "newton_solver", {}).get("error_on_nonconvergence", True)
+            if error_on_nonconvergence:
+                raise RuntimeError("Modified Newton solver did not converge "
+                                   "after %i iterations." % iterations)
+
+        return iterations, converged
@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy
+from dolfin import log, INFO
+
+
+class StateCache(object):
+    """ A cache of the solutions of each timestep, which are used as initial
+    guesses for the nonlinear solves of the next forward run.
+
+    The states are stored as arrays of the local degrees of freedom. If the
+    memory of the cached states exceeds max_memory (in bytes), states are
+    moved from memory to a memory-mapped file (or discarded, if spill is
+    False). Which states remain in memory is determined by the policy:
+
+    - "lru": The least recently used states are moved first.
+    - "strided": Only the states of every k'th timestep remain in memory, where
+      the stride k is doubled whenever the memory is exceeded.
+
+    :param max_memory: The memory budget in bytes. Default: None (no limit).
+    :param policy: "lru" or "strided". Default: "lru".
+    :param spill: If True, states that do not fit into memory are stored in a
+        memory-mapped file. Default: True.
+    :param single_precision: If True, the states are stored in single
+        precision. Default: False.
+    """
+
+    def __init__(self, max_memory=None, policy="lru", spill=True,
+                 single_precision=False):
+        if policy not in ("lru", "strided"):
+            raise ValueError("Unknown state cache policy '%s'." % policy)
+
+        self.max_memory = max_memory
+        self.policy = policy
+        self.spill = spill
+        self.dtype = numpy.float32 if single_precision else numpy.float64
+
+        # The states in memory, in the order of their use.
+        self._states = OrderedDict()
+        self._memory = 0
+
+        # The timestep index of each cached time (in the order of their first
+        # insertion) for the strided policy.
+        self._indices = {}
+        self._stride = 1
+
+        # The spilled states, stored in the rows of a memory-mapped array. Each
+        # time keeps its row once it has been assigned.
+        self._spill_dir = None
+        self._spill_file = None
+        self._spill_slots = {}
+        self._spilled = set()
+
+    def __contains__(self, t):
+        return t in self._states or t in self._spilled
+
+    def has_key(self, t):
+        return t in self
+
+    def __len__(self):
+        return len(self._spilled.union(self._states))
+
+    def get(self, t):
+        """ Returns the local values of the cached state at time t. """
+        if t in self._states:
+            values = self._states[t]
+            if self.policy == "lru":
+                # Mark the state as the most recently used one.
+                self._states[t] = self._states.pop(t)
+        else:
+            values = self._spill_file[self._spill_slots[t]]
+
+        return numpy.array(values, dtype=float)
+
+    def load(self, t, function):
+        """ Copies the cached state at time t into function. """
+        function.vector().set_local(self.get(t))
+        function.vector().apply("insert")
+
+    def store(self, t, function):
+        """ Stores the state of function as the cached state at time t. """
+        values = function.vector().array().astype(self.dtype)
+
+        if t not in self._indices:
+            self._indices[t] = len(self._indices)
+
+        if t in self._states:
+            self._memory -= self._states.pop(t).nbytes
+
+        if (self.policy == "strided" and self.max_memory is not None and
+            self._indices[t] % self._stride != 0):
+            self._spill(t, values)
+        else:
+            self._states[t] = values
+            self._memory += values.nbytes
+            self._spilled.discard(t)
+            self._evict()
+
+    def _evict(self):
+        """ Moves states out of memory until the memory budget is met. """
+        if self.max_memory is None or self._memory <= self.max_memory:
+            return
+
+        if self.policy == "lru":
+            # Always keep the most recent state.
+            while len(self._states) > 1 and self._memory > self.max_memory:
+                t, values = self._states.popitem(last=False)
+                self._memory -= values.nbytes
+                self._spill(t, values)
+
+        else:
+            while len(self._states) > 1 and self._memory > self.max_memory:
+                self._stride *= 2
+                log(INFO, "Keeping every %i'th state of the state cache in "
+                    "memory." % self._stride)
+                for t in [t for t in self._states
+                          if self._indices[t] % self._stride != 0]:
+                    values = self._states.pop(t)
+                    self._memory -= values.nbytes
+                    self._spill(t, values)
+
+    def _spill(self, t, values):
+        if not self.spill:
+            self._spilled.discard(t)
+            return
+
+        if t not in self._spill_slots:
+            self._spill_slots[t] = len(self._spill_slots)
+        slot = self._spill_slots[t]
+
+        if self._spill_file is None or slot >= len(self._spill_file):
+            self._grow_spill_file(len(values), max(2*slot, 16))
+
+        self._spill_file[slot] = values
+        self._spilled.add(t)
+
+    def _grow_spill_file(self, size, rows):
+        """ Resizes the memory-mapped file of spilled states to the given
+        number of rows. """
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="opentidalfarm_states_")
+        filename = os.path.join(self._spill_dir, "states.dat")
+
+        if self._spill_file is not None:
+            self._spill_file.flush()
+            del self._spill_file
+
+        with open(filename, "ab") as f:
+            f.truncate(rows*size*numpy.dtype(self.dtype).itemsize)
+
+        self._spill_file = numpy.memmap(filename, dtype=self.dtype, mode="r+",
+                                        shape=(rows, size))
+
+    def clear(self):
+        """ Removes all cached states. """
+        self._states.clear()
+        self._memory = 0
+        self._indices = {}
+        self._stride = 1
+        self._spill_slots = {}
+        self._spilled = set()
+        self._spill_file = None
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def __del__(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
@@ -0,0 +1,19 @@
+""" The worker process of :func:`opentidalfarm.helpers.spawn_map`. It is run
+as ``python -m opentidalfarm.spawn_worker <task file> <result file>``. """
+import sys
+import cPickle
+
+
+def main(task_file, result_file):
+    with open(task_file, "rb") as task:
+        factory, f, items = cPickle.load(task)
+
+    state = factory()
+    results = [f(state, item) for item in items]
+
+    with open(result_file, "wb") as result:
+        cPickle.dump(results, result, cPickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
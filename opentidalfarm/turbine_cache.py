@@ -1,10 +1,17 @@
 import copy
 import numpy
+import scipy.sparse
 from dolfin import *
 from dolfin_adjoint import *
-from turbine_function import TurbineFunction
+from turbine_function import TurbineFunction, sparse_from_blocks
 
 class TurbineCache(dict):
+
+    #: The number of incremental updates of the turbine field after which it
+    #: is rebuilt from the turbine shapes, so that round-off errors of the
+    #: incremental updates do not accumulate.
+    rebuild_period = 100
+
     def __init__(self, *args, **kw):
         super(TurbineCache, self).__init__(*args, **kw)
         self.itemlist = super(TurbineCache, self).keys()
@@ -13,8 +20,25 @@ class TurbineCache(dict):
         self._controlled_by = None
         self._parameters = None
 
+        # The TurbineBlock of each turbine, from which the turbine fields and
+        # their derivatives are assembled.
+        self._blocks = None
+        # The local values of the turbine field (as a single row). With
+        # dynamic friction, the turbine fields are not stored.
+        self._field = None
+        # The number of incremental updates of the turbine field since it was
+        # last rebuilt.
+        self._incremental_updates = 0
+        # The identity and modification counter of the farm parameters that
+        # the cache was last updated with.
+        self._farm_version = None
+
+        #: Counts the changes of the cached turbine fields.
+        self.version = 0
+
     def __setitem__(self, key, value):
-        self.itemlist.append(key)
+        if key not in self:
+            self.itemlist.append(key)
         super(TurbineCache,self).__setitem__(key, value)
 
     def __iter__(self):
@@ -36,11 +60,38 @@ class TurbineCache(dict):
         self._specification = specification
         self._controlled_by = specification.controls
 
+    def _get_farm_version(self, farm):
+        version = getattr(farm._parameters, "version", None)
+        if version is None:
+            return None
+        return (id(farm._parameters), version)
+
+    def outdated(self, farm):
+        """Returns False if the cache is known to be up to date with the farm
+        parameters. In contrast to :meth:`update`, this only compares the
+        modification counter of the farm parameters and hence is cheap.
+        In-place changes of the parameter values are only detected if they are
+        followed by a call to `farm._parameters.modified()`."""
+
+        farm_version = self._get_farm_version(farm)
+        return (farm_version is None or farm_version != self._farm_version or
+                "turbine_field" not in self)
+
+    def _function(self, values, name=""):
+        f = Function(self._function_space, name=name, annotate=False)
+        f.vector().set_local(values)
+        f.vector().apply("insert")
+        return f
 
     def update(self, farm):
         """Creates a list of all turbine function/derivative interpolations.
         This list is used as a cache to avoid the recomputation of the expensive
-        interpolation of the turbine expression."""
+        interpolation of the turbine expression.
+
+        Only the turbines whose position or friction changed since the last
+        update are recomputed: their old contribution is subtracted from the
+        turbine field and their new contribution is added. The turbine field
+        is rebuilt after every rebuild_period incremental updates."""
 
         try:
             assert(self._specification is not None)
@@ -49,24 +100,24 @@ class TurbineCache(dict):
 
         position = farm._parameters["position"]
         friction = farm._parameters["friction"]
+        farm_version = self._get_farm_version(farm)
 
         # If the parameters have not changed, there is nothing to do
-        if self._parameters is not None:
-            if (len(self._parameters["friction"])==len(friction) and
-                len(self._parameters["position"])==len(position) and
-                (self._parameters["friction"]==friction).all() and
-                (self._parameters["position"]==position).all()):
+        old_parameters = self._parameters
+        if old_parameters is not None:
+            if (numpy.array_equal(old_parameters["friction"], friction) and
+                numpy.array_equal(old_parameters["position"], position)):
+                self._farm_version = farm_version
                 return
 
-        else:
-            self._parameters = {"friction": [], "position": []}
-
         # Update the cache.
         log(INFO, "Updating the turbine cache")
 
         # Update the positions and frictions.
-        self._parameters["friction"] = numpy.copy(friction)
-        self._parameters["position"] = numpy.copy(position)
+        self._parameters = {"friction": numpy.copy(friction),
+                            "position": numpy.copy(position)}
+        self._farm_version = farm_version
+        self.version += 1
 
         # For the smeared approached we just update the turbine_field.
         if self._specification.smeared:
@@ -80,86 +131,240 @@ class TurbineCache(dict):
             self["turbine_field"] = tf
             return
 
-
-        # Precompute the interpolation of the friction function of all turbines.
         turbines = TurbineFunction(self, self._function_space,
                                    self._specification)
+        n_dofs = len(turbines.x)
+
+        # The turbine frictions as a (timesteps x turbines) array. Infeasible
+        # optimisation algorithms (such as SLSQP) may try to evaluate the
+        # functional with negative turbine frictions, hence we project them to
+        # positive reals, as TurbineFunction does.
+        new_position = numpy.reshape(self._parameters["position"], (-1, 2))
+        new_friction = numpy.maximum(
+            numpy.atleast_2d(numpy.asarray(self._parameters["friction"],
+                                           dtype=float)), 0)
+        dynamic = self._controlled_by.dynamic_friction
+
+        full_update = (old_parameters is None or self._blocks is None or
+                       len(self._blocks) != len(new_position) or
+                       numpy.shape(old_parameters["friction"]) !=
+                       numpy.shape(self._parameters["friction"]))
 
-        # If the turbine friction is controlled dynamically, we need to cache
-        # the turbine field for every timestep.
-        if self._controlled_by.dynamic_friction:
-            self["turbine_field"] = [
-                turbines(name="turbine_friction_cache_t_"+str(t),
-                timestep=t) for t in xrange(len(self._parameters["friction"]))
-                ]
+        if full_update:
+            # Precompute the interpolation of the friction function of all
+            # turbines.
+            moved = numpy.arange(len(new_position))
+            self._blocks = turbines.blocks()
         else:
-            self["turbine_field"] = turbines(name="turbine_friction_cache")
-
-        # Precompute the interpolation of the friction function for each turbine.
-        log(INFO, "Building individual turbine power friction functions "
-                  "for caching purposes...")
-        if self._controlled_by.dynamic_friction:
-            self["turbine_field_individual"] = [
-                    TurbineFunction(self, self._function_space,
-                        self._specification)(timestep=i)
-                    for i in xrange(len(self._parameters["friction"]))]
+            # Find the turbines that moved and recompute their bumps.
+            old_position = numpy.reshape(old_parameters["position"], (-1, 2))
+            old_friction = numpy.maximum(
+                numpy.atleast_2d(numpy.asarray(old_parameters["friction"],
+                                               dtype=float)), 0)
+
+            moved = numpy.nonzero((old_position != new_position).any(axis=1))[0]
+            old_blocks = dict((n, self._blocks[n]) for n in moved)
+            for n, block in zip(moved, turbines.blocks(moved)):
+                self._blocks[n] = block
+
+        # The shape matrix of size (number of dofs) x (number of turbines),
+        # whose n'th column contains the field of the n'th turbine with unit
+        # friction. It only depends on the turbine positions.
+        if len(moved) > 0 or "turbine_shapes" not in self:
+            self["turbine_shapes"] = sparse_from_blocks(
+                self._blocks, "turbine_friction", n_dofs)
+        shapes = self["turbine_shapes"]
+
+        # The friction of each turbine at each timestep (a single row for
+        # static friction). Together with the shape matrix it fully describes
+        # the turbine field.
+        self["turbine_frictions"] = new_friction
+
+        if dynamic:
+            # If the turbine friction is controlled dynamically, the turbine
+            # field of each timestep is assembled from the shape matrix when it
+            # is accessed, rather than cached for all timesteps.
+            self._field = None
+            self["turbine_field"] = TurbineFieldSequence(
+                self._function_space, len(new_friction),
+                lambda t: shapes.dot(new_friction[t]),
+                name="turbine_friction_cache_t_%i")
+
         else:
-            self["turbine_field_individual"] = [
-                    TurbineFunction(self, self._function_space,
-                        self._specification)()]
-
-        # Precompute the derivatives with respect to the friction magnitude
-        # of each turbine.
-        if self._controlled_by.friction:
-            self["turbine_derivative_friction"] = []
-            for n in xrange(len(self._parameters["friction"])):
-                tfd = turbines(derivative_index=n,
-                               derivative_var="turbine_friction",
-                               name=("turbine_friction_derivative_with_"
-                                     "respect_friction_magnitude_of_turbine_"
-                                     + str(n)))
-                self["turbine_derivative_friction"].append(tfd)
-
-        elif self._controlled_by.dynamic_friction:
-            self["turbine_derivative_friction"] = []
-            for t in xrange(len(self._parameters["friction"])):
-                self["turbine_derivative_friction"].append([])
-
-                for n in xrange(len(self._parameters["friction"][t])):
-                    tfd = turbines(derivative_index=n,
-                                   derivative_var="turbine_friction",
-                                   name=("turbine_friction_derivative_with_"
-                                         "respect_friction_magnitude_of_"
-                                         "turbine_" + str(n) + "t_" +
-                                         str(t)),
-                                   timestep=t)
-                    self["turbine_derivative_friction"][t].append(tfd)
-
-        # Precompute the derivatives with respect to the turbine position.
+            if (full_update or self._field is None or
+                self._incremental_updates >= self.rebuild_period):
+                self._field = numpy.atleast_2d(shapes.dot(new_friction[0]))
+                self._incremental_updates = 0
+
+            else:
+                # Update the turbine field for the turbines that moved or whose
+                # friction changed by replacing their old contribution.
+                changed = (old_friction[0] != new_friction[0])
+                changed[moved] = True
+
+                log(INFO, "Updating %i of %i turbines in the turbine cache" %
+                    (changed.sum(), len(new_position)))
+
+                for n in numpy.nonzero(changed)[0]:
+                    old_block = old_blocks.get(n, self._blocks[n])
+                    new_block = self._blocks[n]
+                    self._field[0, old_block.dofs] -= (
+                        old_friction[0, n]*old_block.turbine_friction)
+                    self._field[0, new_block.dofs] += (
+                        new_friction[0, n]*new_block.turbine_friction)
+                self._incremental_updates += 1
+
+            self["turbine_field"] = self._function(
+                self._field[0], name="turbine_friction_cache")
+
+        # The friction function of each individual turbine. With dynamic
+        # friction, these are the fields at the final timestep.
+        blocks = self._blocks
+
+        def individual_field(n):
+            field = numpy.zeros(n_dofs)
+            field[blocks[n].dofs] = new_friction[-1, n]*blocks[n].turbine_friction
+            return field
+
+        self["turbine_field_individual"] = TurbineFieldSequence(
+            self._function_space, len(new_position), individual_field)
+
+        # Precompute the derivatives of the turbine field with respect to the
+        # controls as a single sparse matrix, with one row per turbine and
+        # control type and one column per dof. The rows are ordered as
+        # [friction, x position, y position], and only the controlled
+        # quantities are included. All derivatives are stored for turbines
+        # with unit friction; the derivatives with respect to the positions are
+        # scaled with the turbine frictions in gradient(). Hence the matrix
+        # only needs to be rebuilt if turbines moved.
+        if len(moved) > 0 or "turbine_derivatives" not in self:
+            derivative_vars = []
+            if (self._controlled_by.friction or
+                self._controlled_by.dynamic_friction):
+                derivative_vars.append("turbine_friction")
+            if self._controlled_by.position:
+                derivative_vars += ["turbine_pos_x", "turbine_pos_y"]
+
+            derivatives = [sparse_from_blocks(self._blocks, var, n_dofs)
+                           for var in derivative_vars]
+            if len(derivatives) > 0:
+                derivatives = scipy.sparse.hstack(derivatives)
+            else:
+                derivatives = scipy.sparse.csc_matrix((n_dofs, 0))
+            self["turbine_derivatives"] = derivatives.T.tocsr()
+
+    def gradient(self, djdtf):
+        """Applies the chain rule to compute the derivative of a functional
+        with respect to the turbine controls from its derivative with respect
+        to the turbine field.
+
+        :param djdtf: The local values of the functional derivative with
+            respect to the turbine field, with one row per timestep for
+            dynamic friction.
+        :type djdtf: numpy.ndarray
+        :returns: The local contribution to the functional derivative with
+            respect to the controls, ordered as in the control array of the
+            farm. It needs to be summed over all processes.
+        :rtype: numpy.ndarray
+        """
+
+        # The derivatives of all timesteps are computed with one sparse
+        # matrix product.
+        djdtf = numpy.atleast_2d(djdtf)
+        dj_all = self["turbine_derivatives"].dot(djdtf.T)
+
+        frictions = self["turbine_frictions"]
+        n_turbines = frictions.shape[1]
+        dj = []
+
+        if (self._controlled_by.friction or
+            self._controlled_by.dynamic_friction):
+            # The control array orders the frictions by timestep.
+            dj.append(dj_all[:n_turbines].T.ravel())
+            dj_all = dj_all[n_turbines:]
+
         if self._controlled_by.position:
-            if not self._controlled_by.dynamic_friction:
-                self["turbine_derivative_pos"] = []
-                for n in xrange(len(self._parameters["position"])):
-                    self["turbine_derivative_pos"].append({})
-                    for var in ("turbine_pos_x", "turbine_pos_y"):
-                        tfd = turbines(derivative_index=n, derivative_var=var,
-                                       name=("turbine_friction_derivative_"
-                                             "with_respect_position_of_"
-                                             "turbine_" + str(n)))
-                        self["turbine_derivative_pos"][-1][var] = tfd
+            # Scale the derivatives with the turbine friction of each timestep
+            # and sum over the timesteps. The control array orders the
+            # positions as [x_1, y_1, x_2, y_2, ...].
+            dj_x = (dj_all[:n_turbines]*frictions.T).sum(axis=1)
+            dj_y = (dj_all[n_turbines:2*n_turbines]*frictions.T).sum(axis=1)
+            dj.append(numpy.column_stack((dj_x, dj_y)).ravel())
+
+        if len(dj) == 0:
+            return numpy.zeros(0)
+        return numpy.concatenate(dj)
+
+
+class TurbineFieldSequence(object):
+    """A read-only sequence of turbine fields which are assembled when they are
+    accessed. Only the most recently accessed fields are kept, so that
+    sequential access (as in the time loop of a solver) assembles each field
+    once, while the memory usage does not grow with the length of the
+    sequence.
+
+    Fields that are accessed with :meth:`get` for an annotated solve are kept
+    as long as the sequence, since the adjoint model refers to them. Later
+    accesses return the same function.
+
+    :param function_space: The function space of the turbine fields.
+    :param length: The number of turbine fields.
+    :param values: A function that returns the local values of the i'th turbine
+        field.
+    :param name: The name of the i'th turbine field is name % i.
+    :param keep: The number of recently accessed fields that are kept.
+    """
+
+    def __init__(self, function_space, length, values, name=None, keep=2):
+        self._function_space = function_space
+        self._length = length
+        self._values = values
+        self._name = name
+        self._keep = keep
+        self._fields = {}
+        self._accessed = []
+        # The fields that are used by the annotation of the adjoint model.
+        self._annotated = {}
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for i in xrange(self._length):
+            yield self[i]
+
+    def __getitem__(self, i):
+        return self.get(i)
+
+    def get(self, i, annotate=False):
+        """Returns the i'th turbine field.
+
+        :param annotate: If True, the field is used in an annotated solve, and
+            it is kept as long as the sequence.
+        """
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError("Turbine field index out of range.")
+
+        if i in self._annotated:
+            return self._annotated[i]
+
+        if i not in self._fields:
+            if self._name is None:
+                name = ""
             else:
-                self["turbine_derivative_pos"] = []
-                for t in xrange(len(self._parameters["friction"])):
-                    self["turbine_derivative_pos"].append([])
-
-                    for n in xrange(len(self._parameters["position"])):
-                        self["turbine_derivative_pos"][t].append({})
-                        for var in ("turbine_pos_x", "turbine_pos_y"):
-                            tfd = turbines(derivative_index=n,
-                                           derivative_var=var,
-                                           name=("turbine_friction_"
-                                                 "derivative_with_respect_"
-                                                 "position_of_turbine_" +
-                                                 str(n)),
-                                           timestep=t)
-                            self["turbine_derivative_pos"][t][-1][var] = tfd
+                name = self._name % i
+            f = Function(self._function_space, name=name, annotate=False)
+            f.vector().set_local(self._values(i))
+            f.vector().apply("insert")
+
+            self._fields[i] = f
+            self._accessed.append(i)
+            if len(self._accessed) > self._keep:
+                del self._fields[self._accessed.pop(0)]
+
+        f = self._fields[i]
+        if annotate:
+            self._annotated[i] = f
+        return f
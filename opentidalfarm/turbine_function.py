@@ -1,12 +1,50 @@
 import copy
+from collections import namedtuple
 import numpy
+import scipy.sparse
+from scipy.spatial import cKDTree
 from dolfin import *
 from dolfin_adjoint import *
 
 __all__ = ["TurbineFunction"]
 
+
+# The contribution of a single turbine with unit friction: the indices of the
+# dofs in its support and, at these dofs, the turbine field (which is also its
+# derivative with respect to the friction) and its derivatives with respect to
+# the turbine position.
+TurbineBlock = namedtuple("TurbineBlock", ["dofs", "turbine_friction",
+                                           "turbine_pos_x", "turbine_pos_y"])
+
+
+def sparse_from_blocks(blocks, derivative_var, size, weights=None):
+    """Assembles a sparse matrix of size (size x len(blocks)) whose n'th column
+    contains the entry derivative_var of the n'th TurbineBlock, optionally
+    scaled by weights[n]."""
+
+    shape = (size, len(blocks))
+    if len(blocks) == 0:
+        return scipy.sparse.csc_matrix(shape)
+
+    rows = numpy.concatenate([block.dofs for block in blocks])
+    cols = numpy.concatenate([n*numpy.ones(len(block.dofs), dtype=int)
+                              for n, block in enumerate(blocks)])
+    if weights is None:
+        vals = numpy.concatenate([getattr(block, derivative_var)
+                                  for block in blocks])
+    else:
+        vals = numpy.concatenate([w*getattr(block, derivative_var)
+                                  for w, block in zip(weights, blocks)])
+
+    return scipy.sparse.csc_matrix((vals, (rows, cols)), shape=shape)
+
+
 class TurbineFunction(object):
 
+    # The dof coordinates and the spatial index over them only depend on the
+    # function space, so they are shared between all TurbineFunction objects.
+    _dof_index_cache = {}
+
     def __init__(self, cache, V, turbine_specification):
 
         self._parameters = copy.deepcopy(cache._parameters)
@@ -14,10 +52,111 @@ class TurbineFunction(object):
         self._cache = cache
 
         # Precompute some turbine parameters for efficiency.
-        self.x = interpolate(Expression("x[0]", degree=1), V).vector().array()
-        self.y = interpolate(Expression("x[1]", degree=1), V).vector().array()
+        self.x, self.y, self._tree = self._dof_index(V)
         self.V = V
 
+    @classmethod
+    def _dof_index(cls, V):
+        """Returns the coordinates of the (local) dofs of V and a KD-tree over
+        them. Both are computed only once per function space."""
+
+        key = V.id()
+        if key not in cls._dof_index_cache:
+            x = interpolate(Expression("x[0]", degree=1), V).vector().array()
+            y = interpolate(Expression("x[1]", degree=1), V).vector().array()
+
+            # A process might not own any dofs in parallel.
+            if len(x) > 0:
+                tree = cKDTree(numpy.column_stack((x, y)))
+            else:
+                tree = None
+
+            cls._dof_index_cache[key] = (x, y, tree)
+
+        return cls._dof_index_cache[key]
+
+    def _support(self, position):
+        """Returns for each turbine position the indices of the local dofs that
+        lie inside the square support of the turbine bump."""
+
+        if self._tree is None or len(position) == 0:
+            return [numpy.array([], dtype=int) for p in position]
+
+        # The bump vanishes outside the square [x-r, x+r] x [y-r, y+r], which
+        # is the ball of radius r in the maximum norm.
+        points = numpy.reshape(numpy.asarray(position, dtype=float), (-1, 2))
+        supports = self._tree.query_ball_point(points,
+                                               self._turbine_specification.radius,
+                                               p=numpy.inf)
+        return [numpy.asarray(dofs, dtype=int) for dofs in supports]
+
+    def _bumps(self, position):
+        """Yields for each turbine position the indices of the dofs in its
+        support, the unit coordinates of these dofs relative to the turbine and
+        the unit bump function evaluated at them."""
+
+        radius = self._turbine_specification.radius
+        eps = 1e-12
+
+        for (x_pos, y_pos), dofs in zip(position, self._support(position)):
+            x_unit = numpy.minimum(
+                numpy.maximum((self.x[dofs]-x_pos)/radius, -1+eps), 1-eps)
+            y_unit = numpy.minimum(
+                numpy.maximum((self.y[dofs]-y_pos)/radius, -1+eps), 1-eps)
+
+            # Apply chain rule to get the derivative with respect to the turbine
+            # friction. Division by zero is ignored.
+            with numpy.errstate(divide="ignore"):
+                exp = numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)
+
+            yield dofs, x_unit, y_unit, exp
+
+    def blocks(self, indices=None):
+        """Returns a list with the TurbineBlock of each turbine with the given
+        indices (default: all turbines). The blocks describe the turbines with
+        unit friction."""
+
+        position = self._parameters["position"]
+        if indices is None:
+            indices = range(len(position))
+        position = [position[i] for i in indices]
+
+        radius = self._turbine_specification.radius
+        blocks = []
+        for dofs, x_unit, y_unit, exp in self._bumps(position):
+            blocks.append(TurbineBlock(
+                dofs=dofs,
+                turbine_friction=exp,
+                turbine_pos_x=exp*(-2*x_unit/((1.0-x_unit**2)**2))*(-1.0/radius),
+                turbine_pos_y=exp*(-2*y_unit/((1.0-y_unit**2)**2))*(-1.0/radius)))
+
+        return blocks
+
+    def sparse(self, derivative_var=None, timestep=None):
+        """Returns the turbine fields of the individual turbines as a sparse
+        matrix of size (number of local dofs) x (number of turbines). Column n
+        contains the field of turbine n, or its derivative with respect to
+        derivative_var, which is one of "turbine_friction", "turbine_pos_x" or
+        "turbine_pos_y". Since each turbine has a compact support, only few
+        entries per column are non-zero."""
+
+        if derivative_var == "turbine_friction":
+            return sparse_from_blocks(self.blocks(), "turbine_friction",
+                                      len(self.x))
+
+        if derivative_var not in (None, "turbine_pos_x", "turbine_pos_y"):
+            raise ValueError("Unknown derivative variable %s." %
+                             derivative_var)
+
+        if timestep is None:
+            friction = self._parameters["friction"]
+        else:
+            friction = self._parameters["friction"][timestep]
+        friction = [max(0, f) for f in friction]
+
+        return sparse_from_blocks(self.blocks(),
+                                  derivative_var or "turbine_friction",
+                                  len(self.x), weights=friction)
 
     def __call__(self, name="", derivative_index=None, derivative_var=None,
                  timestep=None):
@@ -47,36 +186,24 @@ class TurbineFunction(object):
         friction = [max(0, f) for f in friction]
 
         ff = numpy.zeros(len(self.x))
-        # Ignore division by zero.
-        numpy.seterr(divide="ignore")
-        eps = 1e-12
-
-
-        for (x_pos, y_pos), fric in zip(position, friction):
-            radius = self._turbine_specification.radius
-            x_unit = numpy.minimum(
-                numpy.maximum((self.x-x_pos)/radius, -1+eps), 1-eps)
-            y_unit = numpy.minimum(
-                numpy.maximum((self.y-y_pos)/radius, -1+eps), 1-eps)
+        radius = self._turbine_specification.radius
 
-            # Apply chain rule to get the derivative with respect to the turbine
-            # friction.
-            exp = numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)
+        # Only the dofs inside the support of a turbine are evaluated, all other
+        # dofs do not contribute to its bump.
+        for fric, (dofs, x_unit, y_unit, exp) in zip(friction,
+                                                     self._bumps(position)):
 
             if derivative_index is None:
-                ff += exp*fric
+                ff[dofs] += exp*fric
 
             elif derivative_var == "turbine_friction":
-                ff += exp
+                ff[dofs] += exp
 
             if derivative_var == "turbine_pos_x":
-                ff += exp*(-2*x_unit/((1.0-x_unit**2)**2))*fric*(-1.0/radius)
+                ff[dofs] += exp*(-2*x_unit/((1.0-x_unit**2)**2))*fric*(-1.0/radius)
 
             elif derivative_var == "turbine_pos_y":
-                ff += exp*(-2*y_unit/((1.0-y_unit**2)**2))*fric*(-1.0/radius)
-
-        # Reset numpy to warn for zero division errors.
-        numpy.seterr(divide="warn")
+                ff[dofs] += exp*(-2*y_unit/((1.0-y_unit**2)**2))*fric*(-1.0/radius)
 
         f = Function(self.V, name=name, annotate=False)
         f.vector().set_local(ff)
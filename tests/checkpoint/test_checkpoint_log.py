@@ -0,0 +1,70 @@
+import os
+import sys
+import subprocess
+import numpy
+from opentidalfarm.memoize import CheckpointLog, MemoizeMutable
+
+class TestCheckpointLog(object):
+
+    def test_truncated_tail_is_discarded(self, tmpdir):
+        filename = str(tmpdir.join("checkpoints_fwd.log"))
+
+        memo = MemoizeMutable(lambda m: m.sum(), digest_keys=True)
+        memo.open_checkpoint_log(filename, append=False, sync_period=2)
+        for i in range(3):
+            memo(numpy.ones(5)*i)
+        memo.checkpoint_log.close()
+
+        # Simulate a crash while writing the last record.
+        size = os.path.getsize(filename)
+        with open(filename, "r+b") as f:
+            f.truncate(size - 3)
+
+        records = CheckpointLog(filename).replay()
+        assert len(records) == 2
+        assert os.path.getsize(filename) < size - 3
+
+        # The replayed evaluations are used, and the log can be extended.
+        memo = MemoizeMutable(lambda m: m.sum(), digest_keys=True)
+        memo.load_checkpoint_log(filename)
+        memo.open_checkpoint_log(filename, append=True)
+        memo(numpy.ones(5))
+        memo(numpy.ones(5)*2)
+        assert memo.hits == 1
+        assert memo.misses == 1
+        memo.checkpoint_log.close()
+
+        assert len(CheckpointLog(filename).replay()) == 3
+
+    def test_close_syncs_the_log(self, tmpdir):
+        filename = str(tmpdir.join("checkpoints_fwd.log"))
+
+        memo = MemoizeMutable(lambda m: m.sum(), digest_keys=True)
+        memo.open_checkpoint_log(filename, append=False, sync_period=100)
+        for i in range(3):
+            memo(numpy.ones(5)*i)
+        memo.close_checkpoint_log()
+
+        assert memo.checkpoint_log is None
+        assert len(CheckpointLog(filename).replay()) == 3
+
+    def test_log_is_closed_at_exit(self, tmpdir):
+        filename = str(tmpdir.join("checkpoints_fwd.log"))
+
+        # The process exits without flushing or closing the log.
+        script = """
+import sys
+import numpy
+from opentidalfarm.memoize import MemoizeMutable
+memo = MemoizeMutable(lambda m: m.sum(), digest_keys=True)
+memo.open_checkpoint_log(sys.argv[1], append=False, sync_period=100)
+for i in range(3):
+    memo(numpy.ones(5)*i)
+"""
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(os.path.abspath(path or os.curdir)
+                                            for path in sys.path)
+        subprocess.check_call([sys.executable, "-c", script, filename],
+                              env=env)
+
+        assert len(CheckpointLog(filename).replay()) == 3
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+''' This test compares the vectorised convex polygon site constraints with a
+per-turbine evaluation and checks their jacobian with finite differences. '''
+from opentidalfarm import *
+import numpy
+import pytest
+
+
+class TurbineSpecification(object):
+    def __init__(self, controls):
+        self.controls = controls
+
+
+class PolygonFarm(object):
+    def __init__(self, controls, number_of_turbines):
+        self.turbine_specification = TurbineSpecification(controls)
+        self.number_of_turbines = number_of_turbines
+
+
+class TestConvexPolygonSiteConstraint(object):
+
+    # A pentagon in anti-clockwise order
+    vertices = [(0., 0.), (4., 0.), (5., 2.), (2., 4.), (-1., 2.)]
+    positions = numpy.array([[1., 1.], [3., 2.], [4.5, 0.5], [-1., 3.]])
+
+    def control_array(self, controls):
+        m = self.positions.ravel()
+        if controls.friction:
+            # The frictions are stored in front of the positions.
+            m = numpy.concatenate((numpy.arange(1., 5.), m))
+        return m
+
+    def looped_function(self, ieq, positions):
+        ''' The constraints evaluated turbine by turbine. '''
+        values = []
+        for pos in positions:
+            values += list(ieq.b - numpy.dot(ieq.A, pos))
+        return numpy.array(values)
+
+    @pytest.mark.parametrize("friction", [False, True])
+    def test_function(self, friction):
+        controls = Controls(position=True, friction=friction)
+        ieq = ConvexPolygonSiteConstraint(PolygonFarm(controls, 4),
+                                          self.vertices)
+        m = self.control_array(controls)
+
+        values = ieq.function(m)
+        assert len(values) == ieq.length() == 4*5
+        assert numpy.allclose(values, self.looped_function(ieq, self.positions))
+
+        # The constraints are positive inside the polygon only.
+        inside = (values.reshape(4, 5) >= 0).all(axis=1)
+        assert (inside == [True, True, False, False]).all()
+
+    @pytest.mark.parametrize("friction", [False, True])
+    def test_jacobian(self, friction):
+        controls = Controls(position=True, friction=friction)
+        ieq = ConvexPolygonSiteConstraint(PolygonFarm(controls, 4),
+                                          self.vertices)
+        m = self.control_array(controls)
+
+        jacobian = ieq.jacobian_sparse(m).toarray()
+        assert jacobian.shape == (4*5, len(m))
+        assert (ieq.jacobian(m) == jacobian).all()
+
+        # The constraints are linear, hence central differences are exact up
+        # to round-off.
+        eps = 1e-6
+        for i in range(len(m)):
+            dm = numpy.zeros(len(m))
+            dm[i] = eps
+            fd = (ieq.function(m + dm) - ieq.function(m - dm))/(2*eps)
+            assert numpy.allclose(jacobian[:, i], fd, atol=1e-6)
@@ -0,0 +1,277 @@
+import pytest
+from opentidalfarm import *
+
+
+def channel_problem(problem_params, inflow):
+    domain = RectangularDomain(0, 0, 640, 320, 16, 8)
+    problem_params.domain = domain
+
+    bcs = BoundaryConditionSet()
+    bcs.add_bc("u", inflow, 1, "strong_dirichlet")
+    bcs.add_bc("eta", Constant(0.0), 2, "strong_dirichlet")
+    bcs.add_bc("u", facet_id=3, bctype="free_slip")
+    problem_params.bcs = bcs
+    problem_params.viscosity = Constant(16)
+
+    turbine = BumpTurbine(diameter=40., friction=12.0,
+                          controls=Controls(position=True))
+    farm = RectangularFarm(domain, site_x_start=160, site_x_end=480,
+                           site_y_start=80, site_y_end=240, turbine=turbine)
+    farm.add_regular_turbine_layout(num_x=2, num_y=1)
+    problem_params.tidal_farm = farm
+    return problem_params
+
+
+def solve(solver):
+    for s in solver.solve(annotate=False):
+        pass
+    return sum(iterations for iterations, predicted in solver.newton_iterations)
+
+
+class TestPredictors(object):
+
+    def test_timestep_predictor(self, sw_nonlinear_problem_parameters):
+        problem_params = sw_nonlinear_problem_parameters
+        problem_params.start_time = Constant(0)
+        problem_params.dt = Constant(60)
+        problem_params.finish_time = Constant(600)
+        inflow = Expression(("sin(pi*t/1200.)", "0"), t=Constant(0), degree=2)
+        problem = SWProblem(channel_problem(problem_params, inflow))
+
+        iterations = {}
+        for predictor in [None, "linear"]:
+            solver_params = CoupledSWSolver.default_parameters()
+            solver_params.dump_period = -1
+            solver_params.cache_forward_state = False
+            solver_params.timestep_predictor = predictor
+            solver = CoupledSWSolver(problem, solver_params)
+            solve(solver)
+
+            # The prediction needs the solutions of two previous time levels.
+            predicted = [p for its, p in solver.newton_iterations]
+            assert predicted[1:] == [predictor is not None]*(len(predicted) - 1)
+            iterations[predictor] = sum(its for its, p in
+                                        solver.newton_iterations[2:])
+
+        assert iterations["linear"] < iterations[None]
+
+    def test_secant_predictor(self, steady_sw_problem_parameters):
+        problem_params = channel_problem(steady_sw_problem_parameters,
+                                         Constant((2.0, 0)))
+        farm = problem_params.tidal_farm
+        problem = SteadySWProblem(problem_params)
+
+        # Move the turbines along a line.
+        m0 = numpy.array(farm.control_array, dtype=float)
+        d = numpy.zeros(len(m0))
+        d[::2] = 20.
+
+        iterations = {}
+        for secant_predictor in [False, True]:
+            solver_params = CoupledSWSolver.default_parameters()
+            solver_params.dump_period = -1
+            solver_params.secant_predictor = secant_predictor
+            solver = CoupledSWSolver(problem, solver_params)
+
+            for i in range(3):
+                farm._parameters["position"] = numpy.reshape(
+                    m0 + i*d, (-1, 2)).tolist()
+                iterations[secant_predictor] = solve(solver)
+
+            predicted = [p for its, p in solver.newton_iterations]
+            assert predicted == [secant_predictor]
+
+        assert iterations[True] <= iterations[False]
+
+    def test_secant_predictor_is_exception_safe(self,
+                                                steady_sw_problem_parameters):
+        problem_params = channel_problem(steady_sw_problem_parameters,
+                                         Constant((2.0, 0)))
+        farm = problem_params.tidal_farm
+        problem = SteadySWProblem(problem_params)
+
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = -1
+        solver_params.secant_predictor = True
+        solver = CoupledSWSolver(problem, solver_params)
+
+        m0 = numpy.array(farm.control_array, dtype=float)
+        for i in range(2):
+            farm._parameters["position"] = numpy.reshape(m0 + 10.*i,
+                                                         (-1, 2)).tolist()
+            solve(solver)
+        state_cache = solver.state_cache
+        previous_state_cache = solver.previous_state_cache
+        control_points = list(solver._control_points)
+
+        def fail(result):
+            if result["is_final"]:
+                raise ValueError("Aborted solve")
+        solver_params.callback = fail
+        farm._parameters["position"] = numpy.reshape(m0 + 20.,
+                                                     (-1, 2)).tolist()
+        with pytest.raises(ValueError):
+            solve(solver)
+
+        # The aborted solve leaves the caches of the last two solves intact.
+        assert solver.state_cache is state_cache
+        assert solver.previous_state_cache is previous_state_cache
+        assert len(state_cache) == len(previous_state_cache) == 1
+        assert all((a == b).all() for a, b in
+                   zip(solver._control_points, control_points))
+
+
+class TestSetup(object):
+
+    def test_setup_reuse(self, sw_nonlinear_problem_parameters):
+        problem_params = sw_nonlinear_problem_parameters
+        problem_params.start_time = Constant(0)
+        problem_params.dt = Constant(60)
+        problem_params.finish_time = Constant(600)
+        inflow = Expression(("sin(pi*t/1200.)", "0"), t=Constant(0), degree=2)
+        problem = SWProblem(channel_problem(problem_params, inflow))
+
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = -1
+        solver = CoupledSWSolver(problem, solver_params)
+        solve(solver)
+        assert len(solver.newton_iterations) == 10
+
+        # The setup is reused, but the form compiler parameters are set for
+        # every solve.
+        parameters["form_compiler"]["quadrature_degree"] = 7
+        setup = solver._setup_cache
+        solve(solver)
+        assert solver._setup_cache is setup
+        assert (parameters["form_compiler"]["quadrature_degree"] ==
+                solver_params.quadrature_degree)
+
+        # Changing the timestep in place renews the setup.
+        problem_params.dt.assign(120)
+        solve(solver)
+        assert solver._setup_cache is not setup
+        assert len(solver.newton_iterations) == 5
+
+
+class TestAdaptiveTimestepping(object):
+
+    def test_frozen_timesteps(self, sw_nonlinear_problem_parameters):
+        problem_params = sw_nonlinear_problem_parameters
+        problem_params.start_time = Constant(0)
+        problem_params.dt = Constant(60)
+        problem_params.finish_time = Constant(610)
+        inflow = Expression(("sin(pi*t/1200.)", "0"), t=Constant(0), degree=2)
+        problem = SWProblem(channel_problem(problem_params, inflow))
+        farm = problem_params.tidal_farm
+
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = -1
+        solver_params.adaptive_timestepping = True
+        solver_params.min_timestep = 20
+        solver = CoupledSWSolver(problem, solver_params)
+        solve(solver)
+        timesteps = solver.adaptive_timesteps
+
+        # The controller changes the timestep, and does not leave a
+        # remainder below the minimum timestep.
+        assert len(set(timesteps)) > 1
+        assert min(timesteps) >= 20
+        assert abs(sum(timesteps) - 610) < 1e-8
+
+        # Later solves with other controls replay the timesteps.
+        m0 = numpy.array(farm.control_array, dtype=float)
+        farm._parameters["position"] = numpy.reshape(m0 + 20.,
+                                                     (-1, 2)).tolist()
+        solve(solver)
+        assert solver.adaptive_timesteps == timesteps
+
+        solver.reset_timesteps()
+        solve(solver)
+        assert solver.adaptive_timesteps is not timesteps
+
+
+class TestModifiedNewton(object):
+
+    def test_jacobian_reuse(self, sw_nonlinear_problem_parameters):
+        problem_params = sw_nonlinear_problem_parameters
+        problem_params.start_time = Constant(0)
+        problem_params.dt = Constant(60)
+        problem_params.finish_time = Constant(600)
+        inflow = Expression(("sin(pi*t/1200.)", "0"), t=Constant(0), degree=2)
+        problem = SWProblem(channel_problem(problem_params, inflow))
+
+        states = {}
+        for modified_newton in [False, True]:
+            solver_params = CoupledSWSolver.default_parameters()
+            solver_params.dump_period = -1
+            solver_params.modified_newton = modified_newton
+            solver = CoupledSWSolver(problem, solver_params)
+            solve(solver)
+            states[modified_newton] = solver.state.vector().array()
+
+            iterations = [its for its, p in solver.newton_iterations]
+            factorisations = solver.jacobian_factorisations
+            assert len(factorisations) == len(iterations) == 10
+
+        # The factorisations are reused within and across the timesteps.
+        assert sum(factorisations) < sum(iterations)
+        assert 0 in factorisations[1:]
+
+        # Both solvers converge to the same solution.
+        difference = numpy.linalg.norm(states[True] - states[False])
+        assert difference < 1e-8*numpy.linalg.norm(states[False])
+
+    def test_adaptive_annotation_does_not_factorise(self,
+            sw_nonlinear_problem_parameters):
+        problem_params = sw_nonlinear_problem_parameters
+        problem_params.start_time = Constant(0)
+        problem_params.dt = Constant(60)
+        problem_params.finish_time = Constant(600)
+        inflow = Expression(("sin(pi*t/1200.)", "0"), t=Constant(0), degree=2)
+        problem = SWProblem(channel_problem(problem_params, inflow))
+
+        # The default preset converges with the incremental criterion.
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = -1
+        solver_params.adaptive_timestepping = True
+        solver = CoupledSWSolver(problem, solver_params)
+        for s in solver.solve(annotate=True):
+            pass
+
+        # The annotated solves start from the converged solutions.
+        assert solver._setup_cache["converged_solver"].factorisations == 0
+
+    def test_continuation_annotation_does_not_factorise(self,
+            steady_sw_problem_parameters):
+        problem_params = channel_problem(steady_sw_problem_parameters,
+                                         Constant((2.0, 0)))
+        problem = SteadySWProblem(problem_params)
+
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = -1
+        solver_params.continuation = "viscosity"
+        solver = CoupledSWSolver(problem, solver_params)
+        for s in solver.solve(annotate=True):
+            pass
+
+        assert solver._setup_cache["converged_solver"].factorisations == 0
+
+
+class TestSolverPresets(object):
+
+    def test_fieldsplit(self, steady_sw_problem_parameters):
+        problem_params = channel_problem(steady_sw_problem_parameters,
+                                         Constant((2.0, 0)))
+        problem = SteadySWProblem(problem_params)
+
+        states = {}
+        for preset in ["direct", "fieldsplit"]:
+            solver_params = CoupledSWSolver.default_parameters()
+            solver_params.dump_period = -1
+            solver_params.set_solver_preset(preset)
+            solver = CoupledSWSolver(problem, solver_params)
+            solve(solver)
+            states[preset] = solver.state.split(deepcopy=True)
+
+        for direct, fieldsplit in zip(states["direct"], states["fieldsplit"]):
+            assert errornorm(direct, fieldsplit) < 1e-6*norm(direct)
@@ -0,0 +1,64 @@
+#!/usr/bin/python
+''' This test compares the raster interpolation of the domain restriction
+constraints with the point evaluation of the feasible area. '''
+from opentidalfarm import *
+import dolfin
+import numpy
+
+
+class Configuration(object):
+    def __init__(self, positions):
+        self.params = {"controls": ["turbine_pos"],
+                       "turbine_pos": positions}
+
+
+class TestDomainRestrictionConstraint(object):
+
+    def get_feasible_area(self):
+        # A triangular domain, whose hypotenuse cuts the raster diagonally
+        square = dolfin.UnitSquareMesh(20, 20, "left")
+        triangle = dolfin.CompiledSubDomain("x[0] + x[1] <= 1.0 + DOLFIN_EPS")
+        mesh = dolfin.SubMesh(square, triangle)
+
+        V = dolfin.FunctionSpace(mesh, "CG", 2)
+        return dolfin.interpolate(
+            dolfin.Expression("0.25 - pow(x[0] - 1./3, 2) - pow(x[1] - 1./3, 2)",
+                              degree=2), V)
+
+    def test_raster(self):
+        feasible_area = self.get_feasible_area()
+        # The last turbine is closer to the boundary than the raster spacing
+        x = numpy.array([0.2, 0.3, 0.4, 0.1, 0.49, 0.49])
+        config = Configuration([(0.2, 0.3), (0.4, 0.1), (0.49, 0.49)])
+
+        ieq = DomainRestrictionConstraints(config, feasible_area, (1./3, 1./3))
+        ieq_raster = DomainRestrictionConstraints(config, feasible_area,
+                                                  (1./3, 1./3), raster_size=41)
+
+        assert numpy.allclose(ieq_raster.function(x), ieq.function(x),
+                              atol=1e-3)
+        assert numpy.allclose(ieq_raster.jacobian(x), ieq.jacobian(x),
+                              atol=0.1)
+
+    def test_raster_derivative(self):
+        feasible_area = self.get_feasible_area()
+        config = Configuration([(0.49, 0.49)])
+        ieq = DomainRestrictionConstraints(config, feasible_area, (1./3, 1./3),
+                                           raster_size=41)
+
+        # Slightly outside the domain the interpolant continues smoothly
+        # instead of switching to the distance to the attraction center.
+        inside = ieq.function(numpy.array([0.49, 0.49]))
+        outside = ieq.function(numpy.array([0.49, 0.515]))
+        assert abs(outside - inside) < 0.01
+
+        # The jacobian is the derivative of the interpolant, compare it with
+        # central differences within one raster cell.
+        x = numpy.array([0.4875, 0.4875])
+        eps = 1e-6
+        dJ = ieq.jacobian(x)[0]
+        for i in range(2):
+            dx = numpy.zeros(2)
+            dx[i] = eps
+            fd = (ieq.function(x + dx)[0] - ieq.function(x - dx)[0]) / (2 * eps)
+            assert abs(fd - dJ[i]) < 1e-6
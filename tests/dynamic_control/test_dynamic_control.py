@@ -5,7 +5,11 @@ import pytest
 
 class TestDynamicTurbineControl(object):
 
-    def test_gradient_passes_taylor_test(self, sw_nonlinear_problem_parameters):
+    # The turbine fields of more than two timesteps are not all kept by the
+    # turbine cache, unless they are annotated.
+    @pytest.mark.parametrize("steps", [2, 5])
+    def test_gradient_passes_taylor_test(self, steps,
+                                         sw_nonlinear_problem_parameters):
         problem_params = sw_nonlinear_problem_parameters
         # Load domain
         path = os.path.dirname(__file__)
@@ -18,7 +22,7 @@ class TestDynamicTurbineControl(object):
 
         # Set problem parameters
         problem_params.finish_time = problem_params.start_time + \
-                                     2 * problem_params.dt
+                                     steps * problem_params.dt
 
         # Create Tidalfarm
         basin_x = 640.
@@ -84,3 +88,10 @@ class TestDynamicTurbineControl(object):
                                               seed=seed,
                                               perturbation_direction=p)
         assert minconv > 1.9
+
+        # The annotated turbine fields are reused.
+        fields = farm.friction_function
+        first = fields[0]
+        for field in fields:
+            pass
+        assert fields[0] is first
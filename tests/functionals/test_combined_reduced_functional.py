@@ -0,0 +1,51 @@
+import os
+from opentidalfarm import *
+
+
+class TestCombinedReducedFunctional(object):
+
+    def test_shared_output_files(self, steady_sw_problem_parameters, tmpdir):
+        prob_params = steady_sw_problem_parameters
+        domain = RectangularDomain(x0=0, y0=0, x1=320, y1=160, nx=16, ny=8)
+        prob_params.domain = domain
+
+        bcs = BoundaryConditionSet()
+        bcs.add_bc("u", Constant((2.0, 0)), 1, "strong_dirichlet")
+        bcs.add_bc("eta", Constant(0.0), 2, "strong_dirichlet")
+        bcs.add_bc("u", facet_id=3, bctype="free_slip")
+        prob_params.bcs = bcs
+
+        turbine = BumpTurbine(diameter=20.0, friction=12.0)
+        farm = RectangularFarm(domain, site_x_start=80, site_x_end=240,
+                                       site_y_start=40, site_y_end=120, turbine=turbine)
+        farm.add_regular_turbine_layout(num_x=2, num_y=1)
+        prob_params.tidal_farm = farm
+        problem = SteadySWProblem(prob_params)
+
+        solver_params = CoupledSWSolver.default_parameters()
+        solver_params.dump_period = 1
+        solver_params.output_j = True
+        solver_params.output_dir = str(tmpdir)
+        solver = CoupledSWSolver(problem, solver_params)
+
+        rf_params = ReducedFunctional.default_parameters()
+        rf_params.automatic_scaling = False
+        control = TurbineFarmControl(farm)
+        power_rf = ReducedFunctional(PowerFunctional(problem), control, solver,
+                                     rf_params)
+        cost_rf = ReducedFunctional(CostFunctional(problem), control, solver,
+                                    rf_params)
+
+        j_file = os.path.join(str(tmpdir), "iter_0", "j.txt")
+        with open(j_file, "w") as f:
+            f.write("1.0\n")
+
+        combined_rf = power_rf - cost_rf
+        shared_rf = combined_rf.shared_reduced_functional()
+
+        # The shared reduced functional neither recreates the output files
+        # nor truncates the functional values written so far.
+        assert shared_rf is not None
+        assert shared_rf.turbine_file is power_rf.turbine_file
+        with open(j_file) as f:
+            assert f.read() == "1.0\n"
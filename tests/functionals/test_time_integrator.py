@@ -0,0 +1,47 @@
+from opentidalfarm import *
+
+class TestTimeIntegrator(object):
+
+    def create_problem(self):
+        prob_params = SteadySWProblem.default_parameters()
+        domain = RectangularDomain(x0=0, y0=0, x1=320, y1=160, nx=64, ny=32)
+        prob_params.domain = domain
+
+        turbine = BumpTurbine(diameter=20.0, friction=12.0)
+        farm = RectangularFarm(domain, site_x_start=80, site_x_end=240,
+                                       site_y_start=40, site_y_end=120, turbine=turbine)
+        farm.add_regular_turbine_layout(num_x=2, num_y=1)
+        prob_params.tidal_farm = farm
+        return SteadySWProblem(prob_params)
+
+    def test_combined_functional_components(self):
+        problem = self.create_problem()
+        farm = problem.parameters.tidal_farm
+
+        cost = CostFunctional(problem)
+        functional = cost - 0.5*cost
+
+        integrator = TimeIntegrator(problem, functional, final_only=False)
+        state = Constant((0, 0))
+        for time in range(3):
+            integrator.add(time, state, farm.friction_function, time == 2)
+
+        j_cost, j_scaled = integrator.integrate_components()
+        assert abs(j_scaled + 0.5*j_cost) < 1e-10*abs(j_cost)
+        assert abs(integrator.integrate() - (j_cost + j_scaled)) < 1e-10*abs(j_cost)
+
+    def test_non_uniform_timesteps(self):
+        problem = self.create_problem()
+        farm = problem.parameters.tidal_farm
+
+        cost = CostFunctional(problem)
+        j_cost = assemble(cost.Jt(Constant((0, 0)), farm.friction_function))
+
+        integrator = TimeIntegrator(problem, cost, final_only=False)
+        state = Constant((0, 0))
+        times = [0., 1., 3., 3.5]
+        for time in times:
+            integrator.add(Constant(time), state, farm.friction_function,
+                           time == times[-1])
+
+        assert abs(integrator.integrate() - 3.5*j_cost) < 1e-10*abs(j_cost)
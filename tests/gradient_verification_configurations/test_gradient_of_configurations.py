@@ -51,7 +51,7 @@ class TestConfigurations(object):
         # Create the shallow water problem
         return SteadySWProblem(problem_params)
 
-    def create_sw_problem(self, problem_params):
+    def create_sw_problem(self, problem_params, steps=2):
         basin_x = 500.
         basin_y = 500.
 
@@ -61,7 +61,7 @@ class TestConfigurations(object):
 
         # Temporal settings
         problem_params.finish_time = problem_params.start_time + \
-                                     2*problem_params.dt
+                                     steps*problem_params.dt
 
         # Boundary conditions
         bcs = BoundaryConditionSet()
@@ -101,8 +101,16 @@ class TestConfigurations(object):
         # Create the shallow water problem
         return SWProblem(problem_params)
 
-    @pytest.mark.parametrize(("steady"), [False, True])
-    def test_gradient_passes_taylor_test(self, steady,
+    @pytest.mark.parametrize(("steady", "continuation", "modified_newton",
+                              "adaptive"),
+                             [(False, None, False, False),
+                              (True, None, False, False),
+                              (True, "viscosity", False, False),
+                              (False, None, True, False),
+                              (True, None, True, False),
+                              (False, None, False, True)])
+    def test_gradient_passes_taylor_test(self, steady, continuation,
+                                         modified_newton, adaptive,
                                          sw_linear_problem_parameters,
                                          steady_sw_problem_parameters):
 
@@ -112,6 +120,10 @@ class TestConfigurations(object):
         # Define the discrete domain
         if steady:
             problem = self.create_steady_sw_problem(steady_sw_problem_parameters)
+        elif adaptive:
+            # Enough timesteps for the controller to change the timestep
+            problem = self.create_sw_problem(sw_linear_problem_parameters,
+                                             steps=20)
         else:
             problem = self.create_sw_problem(sw_linear_problem_parameters)
 
@@ -119,6 +131,9 @@ class TestConfigurations(object):
         solver_params = CoupledSWSolver.default_parameters()
         solver_params.dump_period = -1
         solver_params.cache_forward_state = True
+        solver_params.continuation = continuation
+        solver_params.modified_newton = modified_newton
+        solver_params.adaptive_timestepping = adaptive
         solver = CoupledSWSolver(problem, solver_params)
 
         functional = PowerFunctional(problem)
@@ -137,3 +152,7 @@ class TestConfigurations(object):
 
         print minconv
         assert minconv > 1.85
+
+        if adaptive:
+            # The timesteps of the first solve are used by all solves.
+            assert len(set(solver.adaptive_timesteps)) > 1
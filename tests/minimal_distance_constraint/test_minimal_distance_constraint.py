@@ -28,6 +28,86 @@ class TestMinimalDistanceConstraint(object):
 
         assert minconv > 1.99
 
+    def test_cutoff(self):
+        controls = Controls(position=True)
+        x = numpy.array([1., 2., 3., 4., 7., 1., 6., 9.])
+
+        ieq = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                         controls)
+        ieq_cutoff = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                                controls, cutoff=5.5)
+
+        # Only the pairs (1, 0) and (2, 1) are closer than the cutoff distance,
+        # the remaining constraints are filled with the cutoff value.
+        values = ieq.function(x)
+        values_cutoff = ieq_cutoff.function(x)
+        assert len(values_cutoff) == ieq_cutoff.length()
+        assert numpy.allclose(values_cutoff[:2], values[[0, 2]])
+        assert numpy.allclose(values_cutoff[2:], 5.5**2 - 2.**2)
+
+        jacobian = ieq.jacobian_sparse(x).toarray()
+        jacobian_cutoff = ieq_cutoff.jacobian(x)
+        assert numpy.allclose(jacobian_cutoff[:2], jacobian[[0, 2]])
+        assert numpy.allclose(jacobian_cutoff[2:], 0)
+
+    def test_cutoff_pairs_are_fixed(self):
+        controls = Controls(position=True)
+        x = numpy.array([1., 2., 3., 4., 7., 1., 6., 9.])
+
+        ieq = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                         controls)
+        ieq_cutoff = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                                controls, cutoff=5.5)
+
+        # Move turbine 3 within the cutoff distance of turbines 0, 1 and 2,
+        # but not within the minimum distance. The constraints still refer to
+        # the pairs (1, 0) and (2, 1) until the active set is updated.
+        y = x.copy()
+        y[6:] = [4., 2.]
+        values = ieq.function(y)
+        assert numpy.allclose(ieq_cutoff.function(y)[:2], values[[0, 2]])
+
+        ieq_cutoff.update_active_set(y)
+        assert numpy.allclose(ieq_cutoff.function(y)[:5],
+                              values[[0, 3, 2, 4, 5]])
+
+    def test_cutoff_pairs_violating_minimum_distance(self):
+        controls = Controls(position=True)
+        x = numpy.array([1., 2., 3., 4., 7., 1., 6., 9.])
+
+        ieq = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                         controls)
+        ieq_cutoff = MinimumDistanceConstraints(numpy.reshape(x, (-1, 2)), 2.,
+                                                controls, cutoff=5.5)
+
+        # Move turbine 3 within the minimum distance of turbine 0 between
+        # updates of the active set. The violated pair is constrained.
+        y = x.copy()
+        y[6:] = [2., 2.]
+        values = ieq.function(y)
+        values_cutoff = ieq_cutoff.function(y)
+        assert (values_cutoff <= 0).any()
+        assert numpy.allclose(values_cutoff[:5], values[[0, 3, 2, 4, 5]])
+
+        jacobian = ieq.jacobian_sparse(y).toarray()
+        assert numpy.allclose(ieq_cutoff.jacobian(y)[:5],
+                              jacobian[[0, 3, 2, 4, 5]])
+
+    def test_large_arrays_derivative(self):
+        controls = Controls(position=True)
+        x = numpy.array([1., 2., 3., 4., 7., 1., 6., 9.])
+
+        for smooth in [False, True]:
+            ieq = MinimumDistanceConstraintsLargeArrays(
+                numpy.reshape(x, (-1, 2)), 4., controls, smooth=smooth)
+
+            ieqcons_J = lambda m: ieq.function(m)[0]
+            ieqcons_dJ = lambda m, forget=False: ieq.jacobian(m)[0]
+
+            minconv = helpers.test_gradient_array(ieqcons_J, ieqcons_dJ, x)
+
+            assert minconv > 1.99
+
     def test_site_constraint(self):
 
         farm = self.get_farm()
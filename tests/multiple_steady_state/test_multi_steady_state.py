@@ -1,90 +1,113 @@
 import os
+import functools
 import pytest
 from opentidalfarm import *
 
+
+def create_solver(steps, ensemble_workers=1):
+    # Some domain information
+    basin_x = 640.
+    basin_y = 320.
+
+    # Load domain
+    path = os.path.dirname(__file__)
+    meshfile = os.path.join(path, "mesh_coarse.xml")
+    domain = FileDomain(meshfile)
+
+    # Set parameters
+    problem_params = MultiSteadySWProblem.default_parameters()
+    problem_params.include_advection = True
+    problem_params.include_viscosity = True
+    problem_params.linear_divergence = False
+    problem_params.friction = Constant(0.0025)
+    problem_params.depth = Constant(50)
+    problem_params.g = Constant(9.81)
+    problem_params.functional_final_time_only = False
+    problem_params.start_time = Constant(0.)
+    problem_params.dt = Constant(1.)
+    problem_params.finish_time = Constant(steps * problem_params.dt)
+    problem_params.viscosity = Constant(16)
+    problem_params.domain = domain
+    problem_params.initial_condition = Constant((1, 1, 1))
+
+    # Compute the expected eta jump for a free-stream of 2.5 m/s (without
+    # turbines) by assuming balance between the pressure and friction terms
+    u_free_stream = 2.5
+    log(INFO, "Target free-stream velocity (without turbines): %s" % u_free_stream)
+    delta_eta = problem_params.friction/problem_params.depth/problem_params.g
+    delta_eta *= u_free_stream**2
+    delta_eta *= basin_x
+    delta_eta = float(delta_eta)
+    log(INFO, "Derived head-loss difference to achieve target free-stream: %s" % delta_eta)
+
+    # Set Boundary conditions
+    bcs = BoundaryConditionSet()
+    expl = Expression("-delta_eta/2*cos(pi/steps*(t-1))",
+            delta_eta=delta_eta, t=Constant(0), steps=steps)
+    expr = Expression("delta_eta/2*cos(pi/steps*(t-1))",
+            delta_eta=delta_eta, t=Constant(0), steps=steps)
+    bcs.add_bc("eta", expl, 1, "strong_dirichlet")
+    bcs.add_bc("eta", expr, 2, "strong_dirichlet")
+    bcs.add_bc("u", facet_id=3, bctype="free_slip")
+    problem_params.bcs = bcs
+
+    # Create a turbine specification.
+    turbine = BumpTurbine(diameter=20., friction=21.0)
+
+    # Create the farm.
+    site_x = 320.
+    site_y = 160.
+    site_x_start = (basin_x - site_x)/2
+    site_y_start = (basin_y - site_y)/2
+    farm = RectangularFarm(domain,
+                           site_x_start=site_x_start,
+                           site_x_end=site_x_start+site_x,
+                           site_y_start=site_y_start,
+                           site_y_end=site_y_start+site_y,
+                           turbine=turbine,
+                           site_ids=(0,1))
+
+    farm.add_regular_turbine_layout(num_x=8, num_y=4)
+    problem_params.tidal_farm = farm
+
+    # Create problem
+    problem = MultiSteadySWProblem(problem_params)
+
+    solver_params = CoupledSWSolver.default_parameters()
+    solver_params.cache_forward_state = True
+    solver_params.dump_period = -1
+    solver_params.dolfin_solver["newton_solver"]["relative_tolerance"] = 1e-15
+    solver_params.ensemble_workers = ensemble_workers
+    if ensemble_workers > 1:
+        # The workers build their own solver of the same problem.
+        solver_params.ensemble_factory = functools.partial(create_solver,
+                                                           steps)
+    return CoupledSWSolver(problem, solver_params)
+
+
+def create_reduced_functional(steps, ensemble_workers=1):
+    solver = create_solver(steps, ensemble_workers)
+    problem = solver.problem
+    farm = problem.parameters.tidal_farm
+
+    functional = PowerFunctional(problem)
+    control = TurbineFarmControl(farm)
+    rf_params = ReducedFunctionalParameters()
+    rf_params.automatic_scaling = 5.
+    return ReducedFunctional(functional, control, solver, rf_params)
+
+
 class TestMultiSteadyState(object):
 
-    @pytest.mark.parametrize(("steps"), [1, 3])
-    def test_gradient_passes_taylor_test(self, steps,
-            multi_steady_sw_problem_parameters):
+    @pytest.mark.parametrize(("steps", "ensemble_workers"),
+                             [(1, 1), (3, 1), (3, 3)])
+    def test_gradient_passes_taylor_test(self, steps, ensemble_workers):
         
         # Fix the random seed to obtain consistent results
         numpy.random.seed(1)
 
-        # Some domain information
-        basin_x = 640.
-        basin_y = 320.
-
-        # Load domain
-        path = os.path.dirname(__file__)
-        meshfile = os.path.join(path, "mesh_coarse.xml")
-        domain = FileDomain(meshfile)
-
-        # Set parameters
-        problem_params = multi_steady_sw_problem_parameters
-        problem_params.start_time = Constant(0.)
-        problem_params.dt = Constant(1.)
-        problem_params.finish_time = Constant(steps * problem_params.dt)
-        problem_params.viscosity = Constant(16)
-        k = Constant(pi/basin_x)
-        problem_params.domain = domain
-        problem_params.initial_condition = Constant((1, 1, 1))
-
-        # Compute the expected eta jump for a free-stream of 2.5 m/s (without
-        # turbines) by assuming balance between the pressure and friction terms
-        u_free_stream = 2.5
-        log(INFO, "Target free-stream velocity (without turbines): %s" % u_free_stream)
-        delta_eta = problem_params.friction/problem_params.depth/problem_params.g
-        delta_eta *= u_free_stream**2
-        delta_eta *= basin_x
-        delta_eta = float(delta_eta)
-        log(INFO, "Derived head-loss difference to achieve target free-stream: %s" % delta_eta)
-
-        # Set Boundary conditions
-        bcs = BoundaryConditionSet()
-        expl = Expression("-delta_eta/2*cos(pi/steps*(t-1))",
-                delta_eta=delta_eta, t=Constant(0), steps=steps)
-        expr = Expression("delta_eta/2*cos(pi/steps*(t-1))",
-                delta_eta=delta_eta, t=Constant(0), steps=steps)
-        bcs.add_bc("eta", expl, 1, "strong_dirichlet")
-        bcs.add_bc("eta", expr, 2, "strong_dirichlet")
-        bcs.add_bc("u", facet_id=3, bctype="free_slip")
-        problem_params.bcs = bcs
-
-        # Create a turbine specification.
-        turbine = BumpTurbine(diameter=20., friction=21.0)
-
-        # Create the farm.
-        site_x = 320.
-        site_y = 160.
-        site_x_start = (basin_x - site_x)/2
-        site_y_start = (basin_y - site_y)/2
-        farm = RectangularFarm(domain,
-                               site_x_start=site_x_start,
-                               site_x_end=site_x_start+site_x,
-                               site_y_start=site_y_start,
-                               site_y_end=site_y_start+site_y,
-                               turbine=turbine,
-                               site_ids=(0,1))
-
-        farm.add_regular_turbine_layout(num_x=8, num_y=4)
-        problem_params.tidal_farm = farm
-
-        # Create problem
-        problem = MultiSteadySWProblem(problem_params)
-
-        solver_params = CoupledSWSolver.default_parameters()
-        solver_params.cache_forward_state = True
-        solver_params.dump_period = -1
-        solver_params.dolfin_solver["newton_solver"]["relative_tolerance"] = 1e-15
-        solver = CoupledSWSolver(problem, solver_params)
-
-        functional = PowerFunctional(problem)
-        control = TurbineFarmControl(farm)
-        rf_params = ReducedFunctionalParameters()
-        rf_params.automatic_scaling = 5.
-        rf = ReducedFunctional(functional, control, solver, rf_params)
-        m0 = farm.control_array
+        rf = create_reduced_functional(steps, ensemble_workers)
+        m0 = rf.solver.problem.parameters.tidal_farm.control_array
 
         p = numpy.random.rand(len(m0))
         seed = 0.1
@@ -92,3 +115,27 @@ class TestMultiSteadyState(object):
                 seed=seed, perturbation_direction=p)
 
         assert minconv > 1.9
+
+    def test_derivative_with_check_in_workers(self):
+        numpy.random.seed(1)
+
+        rf = create_reduced_functional(1)
+        m0 = rf.solver.problem.parameters.tidal_farm.control_array
+
+        # The perturbed functionals are evaluated in spawned workers while
+        # the gradient is computed, and stored in the cache.
+        factory = functools.partial(create_reduced_functional, 1)
+        dj = rf.derivative_with_check(m0, seed=0.1, workers=2,
+                                      factory=factory)
+
+        assert (dj == rf.derivative(m0)).all()
+        assert len(rf._compute_functional_mem.memo) == 6
+
+    def test_ensemble_solve_does_not_factorise(self):
+        solver = create_solver(3, ensemble_workers=3)
+        for s in solver.solve():
+            pass
+
+        # The annotated solves start from the concurrently computed states.
+        assert all(its == 0 for its, predicted in solver.newton_iterations)
+        assert solver._setup_cache["converged_solver"].factorisations == 0
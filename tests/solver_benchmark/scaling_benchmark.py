@@ -0,0 +1,59 @@
+''' This benchmark compares the scaling of the "direct" (MUMPS) and
+"fieldsplit" (GMRES with a Schur complement field-split preconditioner) solver
+presets of the CoupledSWSolver for a steady channel flow over increasingly
+fine meshes. Run it with different numbers of processes to measure the
+parallel scaling, e.g.:
+
+    for n in 1 2 4 8; do mpirun -n $n python scaling_benchmark.py; done
+
+The direct solver is expected to be faster on small meshes, while the time of
+the fieldsplit preset should grow roughly linearly with the number of degrees
+of freedom and decrease with the number of processes. '''
+
+from opentidalfarm import *
+import numpy
+
+
+def steady_channel_problem(nx, ny):
+    domain = RectangularDomain(x0=0, y0=0, x1=3000, y1=1000, nx=nx, ny=ny)
+
+    prob_params = SteadySWProblem.default_parameters()
+    prob_params.domain = domain
+    prob_params.viscosity = Constant(3)
+    prob_params.depth = Constant(50)
+    prob_params.friction = Constant(0.0025)
+    prob_params.initial_condition = Constant((1e-7, 0, 0))
+
+    bcs = BoundaryConditionSet()
+    bcs.add_bc("u", Constant((2, 0)), facet_id=1)
+    bcs.add_bc("eta", Constant(0), facet_id=2)
+    bcs.add_bc("u", facet_id=3, bctype="free_slip")
+    prob_params.bcs = bcs
+
+    return SteadySWProblem(prob_params)
+
+
+def solve(problem, preset):
+    sol_params = CoupledSWSolver.default_parameters()
+    sol_params.set_solver_preset(preset)
+    sol_params.dump_period = -1
+    solver = CoupledSWSolver(problem, sol_params)
+
+    timer = Timer("Solve with the %s preset" % preset)
+    for s in solver.solve(annotate=False):
+        pass
+    return timer.stop(), s["state"]
+
+
+comm = mpi_comm_world()
+info_green("Processes: %i" % MPI.size(comm))
+info_green("Dofs     | direct [s] | fieldsplit [s] | difference")
+for nx in [60, 120, 240, 480]:
+    problem = steady_channel_problem(nx, nx/3)
+
+    t_direct, state_direct = solve(problem, "direct")
+    t_fieldsplit, state_fieldsplit = solve(problem, "fieldsplit")
+
+    dofs = state_direct.function_space().dim()
+    diff = errornorm(state_direct, state_fieldsplit)
+    info_green("%8i | %10f | %14f | %e" % (dofs, t_direct, t_fieldsplit, diff))
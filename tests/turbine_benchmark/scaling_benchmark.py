@@ -0,0 +1,60 @@
+''' This benchmark shows how the evaluation of the turbine friction field scales
+with the number of turbines. The TurbineFunction only evaluates the bump
+function on the dofs inside the support of each turbine, which are found with a
+spatial index over the dof coordinates. For comparison, the benchmark also times
+the evaluation over all dofs for every turbine, which is what TurbineFunction
+did before. The spatially indexed evaluation should scale with the number of
+turbines times the number of dofs per turbine, independently of the mesh
+size. '''
+
+from opentidalfarm import *
+import numpy
+
+
+def dense_turbine_field(turbines, farm):
+    """ Evaluates the turbine field by looping over all dofs for every turbine.
+    """
+    radius = farm.turbine_specification.radius
+    eps = 1e-12
+    ff = numpy.zeros(len(turbines.x))
+    numpy.seterr(divide="ignore")
+    for (x_pos, y_pos), fric in zip(farm.turbine_positions,
+                                    farm.turbine_frictions):
+        x_unit = numpy.minimum(
+            numpy.maximum((turbines.x-x_pos)/radius, -1+eps), 1-eps)
+        y_unit = numpy.minimum(
+            numpy.maximum((turbines.y-y_pos)/radius, -1+eps), 1-eps)
+        ff += numpy.exp(-1./(1-x_unit**2)-1./(1-y_unit**2)+2)*fric
+    numpy.seterr(divide="warn")
+    return ff
+
+
+def create_farm(domain, number_of_turbines):
+    turbine = BumpTurbine(diameter=20., friction=12.0,
+                          controls=Controls(position=True, friction=True))
+    farm = RectangularFarm(domain, site_x_start=100, site_x_end=2900,
+                           site_y_start=100, site_y_end=900, turbine=turbine)
+    farm.add_lhs_turbine_layout(number_of_turbines)
+    return farm
+
+
+domain = RectangularDomain(0, 0, 3000, 1000, 600, 200)
+
+log(INFO, "Turbines | indexed evaluation [s] | dense evaluation [s]")
+for number_of_turbines in [8, 32, 128, 256]:
+    farm = create_farm(domain, number_of_turbines)
+    turbines = TurbineFunction(farm, farm._turbine_function_space,
+                               farm.turbine_specification)
+
+    timer = Timer("Indexed turbine field")
+    tf = turbines()
+    t_indexed = timer.stop()
+
+    timer = Timer("Dense turbine field")
+    ff = dense_turbine_field(turbines, farm)
+    t_dense = timer.stop()
+
+    if abs(tf.vector().array() - ff).max() > 1e-12:
+        log(ERROR, "The indexed and dense turbine fields differ.")
+
+    log(INFO, "%8i | %22f | %20f" % (number_of_turbines, t_indexed, t_dense))
@@ -0,0 +1,24 @@
+from opentidalfarm.reduced_functional_prototype import \
+    TestReducedFunctional as SumReducedFunctional
+
+
+class FusedReducedFunctional(SumReducedFunctional):
+
+    def __init__(self, controls):
+        SumReducedFunctional.__init__(self, controls)
+        self.fused_evaluation = False
+
+
+def test_fused_evaluation():
+    rf1 = FusedReducedFunctional("controls")
+    rf2 = FusedReducedFunctional("controls")
+    rf3 = SumReducedFunctional("controls")
+    combined = rf1 + 2*(rf2 - rf3)
+
+    assert not combined.fused_evaluation
+    combined.fused_evaluation = True
+    assert combined.fused_evaluation
+    assert rf1.fused_evaluation and rf2.fused_evaluation
+
+    combined.fused_evaluation = False
+    assert not rf1.fused_evaluation and not rf2.fused_evaluation
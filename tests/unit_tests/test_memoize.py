@@ -0,0 +1,115 @@
+from opentidalfarm.memoize import MemoizeMutable, ResultStore, fingerprint
+import numpy
+
+class TestMemoize(object):
+
+    def test_digest_keys(self):
+        calls = []
+        def f(m, forget=True):
+            calls.append(m)
+            return m.sum()
+
+        memo = MemoizeMutable(f, digest_keys=True)
+        m = numpy.random.rand(1000)
+
+        assert memo(m, True) == m.sum()
+        assert memo(m.copy(), True) == m.sum()
+        assert memo(m, False) == m.sum()
+        assert len(calls) == 2
+        assert memo.hits == 1
+        assert memo.misses == 2
+
+    def test_lru_eviction(self):
+        memo = MemoizeMutable(lambda m: 2*m, digest_keys=True, max_entries=2)
+        a, b, c = numpy.ones(10), 2*numpy.ones(10), 3*numpy.ones(10)
+
+        memo(a)
+        memo(b)
+        memo(a)
+        memo(c)
+
+        # b was the least recently used entry.
+        assert memo.has_cache(a)
+        assert not memo.has_cache(b)
+        assert memo.has_cache(c)
+
+        memo = MemoizeMutable(lambda m: 2*m, digest_keys=True,
+                              max_memory=2*a.nbytes)
+        memo(a)
+        memo(b)
+        memo(c)
+        assert not memo.has_cache(a)
+        assert memo.has_cache(b)
+        assert memo.has_cache(c)
+
+    def test_key_args(self):
+        calls = []
+        def f(m, forget=True):
+            calls.append(m)
+            return m.sum()
+
+        memo = MemoizeMutable(f, digest_keys=True, key_args=1)
+        m = numpy.random.rand(1000)
+
+        assert memo(m, True) == m.sum()
+        assert memo(m, False) == m.sum()
+        assert memo(m, forget=False) == m.sum()
+        assert memo.has_cache(m, True)
+        assert len(calls) == 1
+
+    def test_store(self):
+        calls = []
+        memo = MemoizeMutable(calls.append, digest_keys=True, key_args=1)
+        m = numpy.random.rand(10)
+
+        memo.store(3., m, True)
+
+        # Stored values are used for any value of the other arguments.
+        assert memo.has_cache(m, False)
+        assert memo(m, False) == 3.
+        assert len(calls) == 0
+
+    def test_result_store(self, tmpdir):
+        store = ResultStore(str(tmpdir))
+        assert store.get("a", "j") is None
+
+        store.put("a", j=numpy.array(1.))
+        store.put("a", dj=numpy.ones(3))
+        entry = ResultStore(str(tmpdir)).get("a", "dj")
+        assert entry["j"] == 1.
+        assert (entry["dj"] == numpy.ones(3)).all()
+
+        # The least recently used entries are removed first.
+        store = ResultStore(str(tmpdir.join("bounded")), max_size=1)
+        store.put("a", j=numpy.array(1.))
+        store.put("b", j=numpy.array(2.))
+        assert store.get("a", "j") is None
+        assert store.get("b", "j")["j"] == 2.
+
+    def test_fingerprint(self):
+        class Parameters(object):
+            pass
+
+        a, b = Parameters(), Parameters()
+        a.depth, a.output = 50., "a"
+        b.depth, b.output = 50., "b"
+        assert (fingerprint(a, exclude=["output"]).hexdigest() ==
+                fingerprint(b, exclude=["output"]).hexdigest())
+
+        b.depth = 51.
+        assert (fingerprint(a, exclude=["output"]).hexdigest() !=
+                fingerprint(b, exclude=["output"]).hexdigest())
+
+    def test_fingerprint_expression(self):
+        from dolfin import Expression
+        a = Expression("A*x[0]", A=1., t=0., degree=1)
+        b = Expression("A*x[0]", A=2., t=0., degree=1)
+
+        # The parameters of compiled expressions are fingerprinted.
+        assert (fingerprint(a, exclude=["t"]).hexdigest() !=
+                fingerprint(b, exclude=["t"]).hexdigest())
+
+        b.A = 1.
+        b.t = 5.
+        assert (fingerprint(a, exclude=["t"]).hexdigest() ==
+                fingerprint(b, exclude=["t"]).hexdigest())
@@ -0,0 +1,85 @@
+from opentidalfarm.helpers import parallel_map, parallel_map_async, spawn_map
+from opentidalfarm.helpers import spawn_map_async
+from opentidalfarm import helpers
+import os
+import functools
+import numpy
+
+class TestParallelMap(object):
+
+    def test_order(self):
+        offset = numpy.arange(3)
+        items = [numpy.ones(3)*i for i in range(7)]
+
+        # The workers see the state of the calling process.
+        results = parallel_map(lambda x: x + offset, items, workers=3)
+
+        assert len(results) == len(items)
+        for item, result in zip(items, results):
+            assert (result == item + offset).all()
+
+    def test_state(self):
+        state = {"calls": 0}
+        def f(x):
+            state["calls"] += 1
+            return os.getpid()
+
+        pids = parallel_map(f, range(4), workers=2)
+
+        # The changes of the workers are not seen by the calling process.
+        assert state["calls"] == 0
+        assert os.getpid() not in pids
+
+    def test_async(self):
+        pending = parallel_map_async(lambda x: 2*x, range(5), workers=2)
+        assert pending.get() == [0, 2, 4, 6, 8]
+
+        # Serial evaluations are deferred until the results are requested.
+        calls = []
+        pending = parallel_map_async(calls.append, range(5), workers=1)
+        assert len(calls) == 0
+        pending.get()
+        assert calls == range(5)
+
+    def test_spawn(self):
+        items = [numpy.ones(3)*i for i in range(5)]
+
+        # Each worker builds its own state and runs in a new process.
+        results = spawn_map(make_offset, add_offset, items, workers=2)
+
+        assert len(results) == len(items)
+        for item, (result, pid) in zip(items, results):
+            assert (result == item + numpy.arange(3)).all()
+            assert pid != os.getpid()
+
+    def test_spawn_async(self):
+        pending = spawn_map_async(make_offset, add_offset, range(3), workers=2)
+
+        # The results are collected once.
+        assert pending.get() is pending.get()
+        assert [result[0][0] for result in pending.get()] == range(3)
+
+    def test_gradient_array(self):
+        offset = make_offset()
+        J = lambda x: quadratic(offset, x)
+        dJ = lambda x, forget=True: 2*(x - offset)
+
+        # The perturbed functionals are evaluated in spawned workers.
+        evaluate_async = functools.partial(spawn_map_async, make_offset,
+                                           quadratic, workers=2)
+        minconv = helpers.test_gradient_array(J, dJ, numpy.ones(3),
+                                              number_of_tests=3,
+                                              evaluate_async=evaluate_async)
+        assert minconv > 1.9
+
+
+def make_offset():
+    return numpy.arange(3)
+
+
+def add_offset(offset, x):
+    return x + offset, os.getpid()
+
+
+def quadratic(offset, x):
+    return ((x - offset)**2).sum()
@@ -0,0 +1,26 @@
+from opentidalfarm import *
+from opentidalfarm.helpers import PointProbes
+import numpy
+
+class TestPointProbes(object):
+
+    def test_evaluation(self):
+        mesh = RectangleMesh(Point(0, 0), Point(3, 2), 6, 4)
+        points = numpy.array([[0.1, 0.2], [1.5, 1.], [2.9, 1.7], [4., 1.]])
+        probes = PointProbes(mesh, points)
+
+        # Probes outside the domain evaluate to nan.
+        assert (probes.inside == [True, True, True, False]).all()
+
+        V = FunctionSpace(mesh, "CG", 2)
+        f = interpolate(Expression("x[0]*x[0] + x[1]", degree=2), V)
+        values = probes(f)
+        assert numpy.allclose(values[:3], points[:3, 0]**2 + points[:3, 1])
+        assert numpy.isnan(values[3])
+
+        W = VectorFunctionSpace(mesh, "CG", 1)
+        g = interpolate(Expression(("x[1]", "2*x[0]"), degree=1), W)
+        values = probes(g)
+        assert values.shape == (4, 2)
+        assert numpy.allclose(values[:3, 0], points[:3, 1])
+        assert numpy.allclose(values[:3, 1], 2*points[:3, 0])
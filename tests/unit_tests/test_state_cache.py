@@ -0,0 +1,46 @@
+from opentidalfarm import *
+from opentidalfarm.solvers.state_cache import StateCache
+import pytest
+import numpy
+
+class TestStateCache(object):
+
+    def _functions(self, n):
+        mesh = UnitSquareMesh(4, 4)
+        V = FunctionSpace(mesh, "CG", 1)
+        functions = []
+        for i in range(n):
+            f = Function(V)
+            f.vector()[:] = float(i)
+            functions.append(f)
+        return V, functions
+
+    @pytest.mark.parametrize("policy", ["lru", "strided"])
+    def test_spill(self, policy):
+        V, functions = self._functions(8)
+        nbytes = functions[0].vector().array().nbytes
+
+        cache = StateCache(max_memory=3*nbytes, policy=policy)
+        for i, f in enumerate(functions):
+            cache.store(float(i), f)
+        assert cache._memory <= 3*nbytes
+
+        # All states are still available.
+        g = Function(V)
+        for i, f in enumerate(functions):
+            assert float(i) in cache
+            cache.load(float(i), g)
+            assert (g.vector().array() == f.vector().array()).all()
+
+    def test_discard(self):
+        V, functions = self._functions(4)
+        nbytes = functions[0].vector().array().nbytes
+
+        # Two states fit into the memory budget in single precision.
+        cache = StateCache(max_memory=nbytes, spill=False,
+                           single_precision=True)
+        for i, f in enumerate(functions):
+            cache.store(float(i), f)
+        assert len(cache) == 2
+        assert 1. not in cache
+        assert 3. in cache
@@ -0,0 +1,148 @@
+from opentidalfarm import *
+import pytest
+import numpy
+
+
+def create_farm(controls, n_time_steps=None):
+    domain = RectangularDomain(0, 0, 1000, 500, 20, 10)
+    turbine = BumpTurbine(diameter=100., friction=12., controls=controls)
+    farm = RectangularFarm(domain, site_x_start=100, site_x_end=900,
+                           site_y_start=100, site_y_end=400, turbine=turbine,
+                           n_time_steps=n_time_steps)
+    farm.add_regular_turbine_layout(num_x=3, num_y=2)
+    farm.update()
+    return farm
+
+
+def fresh_field(farm):
+    """ Builds the turbine field of the farm from scratch. """
+    turbines = TurbineFunction(farm.turbine_cache,
+                               farm._turbine_function_space,
+                               farm.turbine_specification)
+    return numpy.asarray(turbines.sparse().sum(axis=1)).ravel()
+
+
+class TestTurbineCache(object):
+
+    def test_incremental_updates(self):
+        numpy.random.seed(3)
+        farm = create_farm(Controls(position=True, friction=True))
+        position = numpy.array(farm.turbine_positions, dtype=float)
+        friction = numpy.array(farm.turbine_frictions, dtype=float)
+
+        # Move one turbine or change one friction at a time, so that the
+        # turbine field is updated incrementally.
+        for i in range(250):
+            n = numpy.random.randint(len(position))
+            if i % 2 == 0:
+                position[n] += numpy.random.uniform(-10, 10, 2)
+                farm._parameters["position"] = position.tolist()
+            else:
+                friction[n] = numpy.random.uniform(1, 20)
+                farm._parameters["friction"] = friction.tolist()
+            farm.update()
+
+            field = farm.turbine_cache["turbine_field"].vector().array()
+            assert abs(field - fresh_field(farm)).max() < 1e-12
+
+    def test_dynamic_fields(self):
+        numpy.random.seed(4)
+        farm = create_farm(Controls(dynamic_friction=True), n_time_steps=5)
+        friction = numpy.random.uniform(1, 20, (6, farm.number_of_turbines))
+        farm._parameters["friction"] = friction.tolist()
+        farm.update()
+
+        fields = farm.turbine_cache["turbine_field"]
+        turbines = TurbineFunction(farm.turbine_cache,
+                                   farm._turbine_function_space,
+                                   farm.turbine_specification)
+        assert len(fields) == 6
+        for t, field in enumerate(fields):
+            expected = turbines(timestep=t).vector().array()
+            assert abs(field.vector().array() - expected).max() < 1e-12
+
+        # Only the recently accessed fields are kept, unless they are used in
+        # an annotated solve.
+        first = fields[0]
+        annotated = fields.get(1, annotate=True)
+        for field in fields:
+            pass
+        assert fields[0] is not first
+        assert (fields[0].vector().array() == first.vector().array()).all()
+        assert fields[1] is annotated
+
+        # The individual fields use the frictions of the final timestep.
+        individual = farm.turbine_cache["turbine_field_individual"]
+        assert len(individual) == farm.number_of_turbines
+        for n, field in enumerate(individual):
+            expected = friction[-1, n]*turbines(
+                derivative_index=n,
+                derivative_var="turbine_friction").vector().array()
+            assert abs(field.vector().array() - expected).max() < 1e-12
+
+    def test_derivative_rows(self):
+        numpy.random.seed(5)
+        farm = create_farm(Controls(position=True, friction=True))
+        friction = numpy.random.uniform(1, 20, farm.number_of_turbines)
+        farm._parameters["friction"] = friction.tolist()
+        farm.update()
+
+        # The rows are ordered as [friction, x position, y position], for
+        # turbines with unit friction.
+        derivatives = farm.turbine_cache["turbine_derivatives"].toarray()
+        turbines = TurbineFunction(farm.turbine_cache,
+                                   farm._turbine_function_space,
+                                   farm.turbine_specification)
+        n_turbines = farm.number_of_turbines
+        assert derivatives.shape[0] == 3*n_turbines
+
+        for i, var in enumerate(["turbine_friction", "turbine_pos_x",
+                                 "turbine_pos_y"]):
+            for n in range(n_turbines):
+                expected = turbines(derivative_index=n,
+                                    derivative_var=var).vector().array()
+                if var != "turbine_friction":
+                    expected /= friction[n]
+                row = derivatives[i*n_turbines + n]
+                assert abs(row - expected).max() < 1e-12*abs(expected).max()
+
+    @pytest.mark.parametrize("dynamic", [False, True])
+    def test_gradient(self, dynamic):
+        numpy.random.seed(6)
+        if dynamic:
+            farm = create_farm(Controls(position=True, dynamic_friction=True),
+                               n_time_steps=3)
+        else:
+            farm = create_farm(Controls(position=True, friction=True))
+        n_turbines = farm.number_of_turbines
+        friction = numpy.random.uniform(1, 20, numpy.shape(
+            farm.turbine_frictions))
+        farm._parameters["friction"] = friction.tolist()
+        farm.update()
+
+        turbines = TurbineFunction(farm.turbine_cache,
+                                   farm._turbine_function_space,
+                                   farm.turbine_specification)
+        timesteps = [None]
+        if dynamic:
+            timesteps = range(len(friction))
+        djdtf = numpy.random.rand(len(timesteps), len(turbines.x))
+
+        def dense(n, var, t):
+            return turbines(derivative_index=n, derivative_var=var,
+                            timestep=t).vector().array()
+
+        # The frictions are ordered by timestep, followed by the positions
+        # [x_1, y_1, x_2, y_2, ...], which are summed over the timesteps.
+        expected = [djdtf[i].dot(dense(n, "turbine_friction", t))
+                    for i, t in enumerate(timesteps)
+                    for n in range(n_turbines)]
+        for n in range(n_turbines):
+            for var in ["turbine_pos_x", "turbine_pos_y"]:
+                expected.append(sum(djdtf[i].dot(dense(n, var, t))
+                                    for i, t in enumerate(timesteps)))
+        expected = numpy.array(expected)
+
+        dj = farm.turbine_cache.gradient(djdtf)
+        assert len(dj) == len(farm.control_array)
+        assert abs(dj - expected).max() < 1e-12*abs(expected).max()